@@ -1,28 +1,113 @@
 import sys
 import os
+import io
 import json
 import ast
+import re
+import html
+import hashlib
+import time
+import threading
+import queue
 import webbrowser
+import subprocess
+import random
+import tempfile
+import shutil
+import argparse
+import getpass
+import base64
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+STARTUP_TIME = time.perf_counter()
 
 from PyQt5.QtWidgets import (
     QApplication, QWidget, QVBoxLayout, QPushButton, QLabel, QDesktopWidget,
     QTextEdit, QHBoxLayout, QMessageBox, QComboBox, QSizePolicy,
-    QInputDialog, QLineEdit, QFileDialog, QDialog, QDialogButtonBox
+    QInputDialog, QLineEdit, QFileDialog, QDialog, QDialogButtonBox,
+    QAbstractScrollArea, QStyledItemDelegate, QStyleOptionViewItem, QMenu, QShortcut, QPlainTextEdit
 )
 from PyQt5.QtCore import (
-    Qt, QTimer, QThread, pyqtSignal, QSize, QPropertyAnimation, QEasingCurve,
-    QPoint, QEvent, QByteArray, QBuffer, QIODevice, QCoreApplication, QRect
+    Qt, QObject, QTimer, QThread, pyqtSignal, QSize, QPropertyAnimation, QEasingCurve,
+    QPoint, QEvent, QByteArray, QBuffer, QIODevice, QCoreApplication, QRect,
+    QAbstractListModel, QModelIndex, QEventLoop
 )
-from PyQt5.QtGui import QPixmap, QImage, QCursor, QFont, QTextDocument, QTextCursor, QCloseEvent, QIcon
+from PyQt5.QtGui import (
+    QPixmap, QImage, QCursor, QFont, QTextDocument, QTextCursor, QCloseEvent, QIcon,
+    QPainter, QPalette, QAbstractTextDocumentLayout, QTextDocumentFragment, QImageReader, QImageWriter,
+    QColor, QPen, QKeySequence
+)
+from PyQt5.QtNetwork import QLocalServer, QLocalSocket
+
+
+class LazyModule:
+    """Модуль, который импортируется при первом обращении, а не при запуске программы.
+
+    loader — функция с обычным import внутри, чтобы PyInstaller по-прежнему видел зависимость.
+    Если модуль не установлен, объект ложен в условиях (if not pyaudio: ...).
+    """
+
+    def __init__(self, loader):
+        self._loader = loader
+        self._module = None
+        self._error = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    if self._error is not None:
+                        raise self._error
+                    try:
+                        self._module = self._loader()
+                    except ImportError as e:
+                        self._error = e
+                        raise
+        return self._module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __bool__(self):
+        try:
+            self._load()
+            return True
+        except ImportError:
+            return False
+
+
+def _import_speech_recognition():
+    import speech_recognition
+    return speech_recognition
 
-import speech_recognition as sr
-try:
-    import pyaudio
-except ImportError:
-    pyaudio = None
-    print("Внимание: PyAudio не найден. Функции работы с микрофоном могут быть недоступны.")
 
-import google.genai as genai
+def _import_pyaudio():
+    try:
+        import pyaudio
+    except ImportError:
+        print("Внимание: PyAudio не найден. Функции работы с микрофоном могут быть недоступны.")
+        raise
+    return pyaudio
+
+
+def _import_numpy():
+    # Без numpy хэш кадров в режиме наблюдения считается обычным циклом
+    import numpy
+    return numpy
+
+
+def _import_genai():
+    import google.genai
+    return google.genai
+
+
+# Тяжёлые модули импортируются при первом использовании, чтобы окно появлялось быстрее
+sr = LazyModule(_import_speech_recognition)
+pyaudio = LazyModule(_import_pyaudio)
+np = LazyModule(_import_numpy)
+genai = LazyModule(_import_genai)
 
 GOOGLE_API_KEY = "YOUR_GOOGLE_GEMINI_API_KEY"
 
@@ -37,6 +122,61 @@ if GOOGLE_API_KEY == "YOUR_GOOGLE_GEMINI_API_KEY":
         print("Предупреждение: API ключ Win-AI не установлен. Функции Win-AI будут отключены.")
 
 GEMINI_API_KEY = GOOGLE_API_KEY
+GEMINI_MODEL_NAME = 'gemini-2.5-flash-preview-05-20'
+# Модель, заменяющая Gemini (например, SimulatedBackend при запуске с --stub-model)
+MODEL_OVERRIDE = None
+
+# Имя локального сервера для запросов из других программ; своё у каждого пользователя
+LOCAL_SERVER_NAME = f"win-ai-{getpass.getuser()}"
+# Отдельное имя для второго запуска: работает всегда, даже если local_endpoint отключён в настройках
+INSTANCE_SERVER_NAME = f"win-ai-instance-{getpass.getuser()}"
+
+# Файлы больше этого размера загружаются через File API, а не передаются в запросе байтами.
+# Запрос к Gemini ограничен ~20 МБ, а base64 увеличивает данные на треть: 14 МБ дают ~18,7 МБ,
+# остальное остаётся на текст запроса и историю
+INLINE_FILE_LIMIT = 14 * 1024 * 1024
+# Загруженные файлы хранятся на стороне API 48 часов; берём с запасом
+REMOTE_FILE_TTL = 46 * 3600
+
+TEXT_FILE_EXTENSIONS = (".txt", ".py", ".json", ".xml", ".html", ".css", ".js", ".md", ".csv", ".tsv", ".log", ".ini", ".cfg", ".conf")
+MIME_TYPES = {
+    ".pdf": "application/pdf",
+    ".docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    ".xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    ".pptx": "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".gif": "image/gif",
+    ".bmp": "image/bmp",
+    ".tiff": "image/tiff",
+    ".webp": "image/webp",
+    ".mp4": "video/mp4",
+    ".avi": "video/x-msvideo",
+    ".mov": "video/quicktime",
+    ".wmv": "video/x-ms-wmv",
+    ".flv": "video/x-flv",
+    ".webm": "video/webm",
+    ".mp3": "audio/mpeg",
+    ".wav": "audio/wav",
+    ".flac": "audio/flac",
+    ".ogg": "audio/ogg",
+    ".aac": "audio/aac",
+}
+
+
+# Ответ модели на кадр наблюдения, когда сообщать не о чем; такие ответы в чат не выводятся
+WATCH_IDLE_REPLY = "NOTHING_TO_REPORT"
+
+# Эти изображения перед отправкой уменьшаются и перекодируются (GIF не трогаем — он может быть анимирован)
+PREPROCESSED_IMAGE_TYPES = ("image/jpeg", "image/png", "image/bmp", "image/tiff", "image/webp")
+
+
+def mime_type_for(file_name):
+    file_extension = os.path.splitext(file_name)[1].lower()
+    if file_extension in TEXT_FILE_EXTENSIONS:
+        return "text/plain"
+    return MIME_TYPES.get(file_extension, "application/octet-stream")
 
 LANGUAGES = {
     "RU": {
@@ -58,6 +198,7 @@ UI_TEXTS = {
         "thinking": "Думаю...",
         "listening": "Слушаю...",
         "recording_stopped": "Запись аудио остановлена.",
+        "phrases_dropped": "Распознавание не успевало за речью, пропущено фраз: {count}.",
         "file_sent": "Файл '{file}' отправлен в Win-AI для анализа...",
         "file_cancel": "Выбор файла отменен.",
         "model_not_init": "Ошибка: Модель Win-AI не инициализирована.",
@@ -66,6 +207,36 @@ UI_TEXTS = {
         "api_not_set": "API ключ не установлен.",
         "mic_off": "Аудио",
         "mic_on": "Выключить микрофон",
+        "stopped": "Генерация остановлена.",
+        "queue_full": "Слишком много запросов в очереди, дождитесь ответа.",
+        "cached": "из кэша",
+        "uploading": "Загрузка файла: {percent}% ({sent:.1f} / {total:.1f} МБ)",
+        "chunk_split": "Разбиение файла на части...",
+        "image_saved": "Изображение сжато перед отправкой: {before:.2f} → {after:.2f} МБ (−{percent}%)",
+        "chunk_progress": "Анализ частей файла: {done}/{total} (из кэша: {cached})",
+        "chunk_reduce": "Объединение результатов ({total} частей)...",
+        "screenshot_prompt": "Что изображено на этом снимке экрана?",
+        "screenshot_failed": "Не удалось сделать снимок экрана: {error}",
+        "watch": "наблюдение",
+        "voice_message": "[голосовой запрос]",
+        "batch_file_prompt": "Проанализируй содержимое этого файла: {name}",
+        # Инструкция для голосового запроса, отправленного модели без отдельного распознавания речи
+        "voice_instruction": "В аудио — голосовой запрос пользователя. Сначала одной строкой выпиши его "
+                             "расшифровку в формате «Запрос: ...», затем ответь на него.",
+        "voice_direct": "Отправлять голос напрямую в модель",
+        "microphone": "Микрофон",
+        "mic_default": "По умолчанию",
+        "mic_searching": "Поиск микрофонов...",
+        "mic_recalibrate": "Перекалибровать по фоновому шуму",
+        "mic_calibrated": "Микрофон «{device}» откалиброван, порог громкости {threshold:.0f}.",
+        "mic_calibration_failed": "Не удалось откалибровать микрофон: {error}",
+        "watch_default": "Сообщи, если на экране появится что-то важное, например ошибка.",
+        "watch_started": "Наблюдение за экраном включено (раз в {seconds:g} с): {question}",
+        "watch_stopped": "Наблюдение остановлено. Снято кадров: {sampled}, отправлено: {sent}.",
+        "watch_failed": "Наблюдение остановлено из-за ошибки: {error}",
+        "watch_prompt": "Это очередной кадр наблюдения за экраном пользователя. Задача: {question}\n"
+                        "Если на кадре нет ничего, о чём нужно сообщить, ответь ровно {idle}.",
+        "diagnostics_columns": "запрос|итог|очередь|сборка|загрузка|TTFT|модель|отрисовка|всего, мс",
         "you": "Вы",
         "ai": "Win-AI"
     },
@@ -74,6 +245,7 @@ UI_TEXTS = {
         "thinking": "Thinking...",
         "listening": "Listening...",
         "recording_stopped": "Audio recording stopped.",
+        "phrases_dropped": "Recognition could not keep up with speech, phrases skipped: {count}.",
         "file_sent": "File '{file}' sent to Win-AI for analysis...",
         "file_cancel": "File selection cancelled.",
         "model_not_init": "Error: Win-AI model not initialized.",
@@ -82,6 +254,35 @@ UI_TEXTS = {
         "api_not_set": "API key not set.",
         "mic_off": "Audio",
         "mic_on": "Turn off microphone",
+        "stopped": "Generation stopped.",
+        "queue_full": "Too many queued requests, please wait for a reply.",
+        "cached": "cached",
+        "uploading": "Uploading file: {percent}% ({sent:.1f} / {total:.1f} MB)",
+        "chunk_split": "Splitting the file into parts...",
+        "image_saved": "Image compressed before upload: {before:.2f} → {after:.2f} MB (−{percent}%)",
+        "chunk_progress": "Analyzing file parts: {done}/{total} (cached: {cached})",
+        "chunk_reduce": "Merging results ({total} parts)...",
+        "screenshot_prompt": "What is shown in this screenshot?",
+        "screenshot_failed": "Failed to take a screenshot: {error}",
+        "watch": "watch",
+        "voice_message": "[voice request]",
+        "batch_file_prompt": "Analyze the contents of this file: {name}",
+        "voice_instruction": "The audio contains the user's spoken request. First write its transcript on one "
+                             "line as \"Request: ...\", then answer it.",
+        "voice_direct": "Send voice directly to the model",
+        "microphone": "Microphone",
+        "mic_default": "Default",
+        "mic_searching": "Looking for microphones...",
+        "mic_recalibrate": "Recalibrate to ambient noise",
+        "mic_calibrated": "Microphone \"{device}\" calibrated, energy threshold {threshold:.0f}.",
+        "mic_calibration_failed": "Failed to calibrate the microphone: {error}",
+        "watch_default": "Tell me if something important appears on the screen, such as an error.",
+        "watch_started": "Screen watch enabled (every {seconds:g} s): {question}",
+        "watch_stopped": "Screen watch stopped. Frames sampled: {sampled}, sent: {sent}.",
+        "watch_failed": "Screen watch stopped because of an error: {error}",
+        "watch_prompt": "This is the next frame of watching the user's screen. Task: {question}\n"
+                        "If there is nothing on the frame worth reporting, answer exactly {idle}.",
+        "diagnostics_columns": "request|outcome|queue|build|upload|TTFT|model|render|total, ms",
         "you": "You",
         "ai": "Win-AI"
     }
@@ -215,6 +416,2180 @@ class ApiKeyInputDialog(QDialog):
         """)
 
 
+class ChatJournal:
+    """Append-only JSONL-журнал сообщений чата: одна строка на сообщение."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def exists(self):
+        return os.path.exists(self.path) and os.path.getsize(self.path) > 0
+
+    def append(self, record):
+        if self._file is None:
+            self._file = open(self.path, 'a', encoding='utf-8')
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def read_tail(self, count, end=None):
+        """Читает не более count записей, заканчивающихся на смещении end (по умолчанию конец файла).
+
+        Возвращает (записи, смещение первой из них) — его передают как end для следующей страницы.
+        """
+        if not os.path.exists(self.path):
+            return [], 0
+        if self._file is not None:
+            self._file.flush()
+        with open(self.path, 'rb') as f:
+            if end is None:
+                f.seek(0, os.SEEK_END)
+                end = f.tell()
+            pos = end
+            data = b""
+            while pos > 0 and data.count(b"\n") <= count:
+                step = min(65536, pos)
+                pos -= step
+                f.seek(pos)
+                data = f.read(step) + data
+
+        pieces = data.split(b"\n")
+        tail = pieces.pop()
+        start = pos
+        if pos > 0:
+            # Первый кусок может быть хвостом более старой записи
+            start += len(pieces.pop(0)) + 1
+        lines = [(piece, len(piece) + 1) for piece in pieces]
+        if tail.strip():
+            lines.append((tail, len(tail)))
+        if len(lines) > count:
+            start += sum(length for _, length in lines[:-count])
+            lines = lines[-count:]
+
+        records = []
+        for line, _ in lines:
+            try:
+                records.append(json.loads(line.decode('utf-8')))
+            except ValueError:
+                # Оборванная строка после аварийного завершения — пропускаем
+                continue
+        return records, start
+
+    def rewrite(self, transform):
+        """Построчно переписывает журнал через временный файл."""
+        if not os.path.exists(self.path):
+            return
+        self.close()
+        tmp_path = self.path + ".tmp"
+        with open(self.path, 'r', encoding='utf-8') as src, open(tmp_path, 'w', encoding='utf-8') as dst:
+            for line in src:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                dst.write(json.dumps(transform(record), ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        self.close()
+        open(self.path, 'w', encoding='utf-8').close()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class SettingsWriter(QObject):
+    """Отложенная запись settings.json: изменения копятся, файл пишется в фоне после паузы."""
+
+    def __init__(self, path, delay_ms=500, parent=None):
+        super().__init__(parent)
+        self.path = path
+        self._pending = None
+        self._last_written = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(delay_ms)
+        self._timer.timeout.connect(self._flush_async)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, 'r') as f:
+            data = f.read()
+        settings = json.loads(data) if data.strip() else {}
+        self._last_written = json.dumps(settings, indent=4)
+        return settings
+
+    def schedule(self, settings):
+        self._pending = dict(settings)
+        self._timer.start()
+
+    def _take_changed(self):
+        if self._pending is None:
+            return None
+        data = json.dumps(self._pending, indent=4)
+        self._pending = None
+        if data == self._last_written:
+            return None
+        self._last_written = data
+        return data
+
+    def _flush_async(self):
+        data = self._take_changed()
+        if data is not None:
+            self._executor.submit(self._write, data)
+
+    def flush(self):
+        """Синхронно дописывает всё накопленное (при закрытии приложения)."""
+        self._timer.stop()
+        data = self._take_changed()
+        if data is not None:
+            self._executor.submit(self._write, data)
+        self._executor.shutdown(wait=True)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def _write(self, data):
+        # Пишем во временный файл и атомарно подменяем, чтобы сбой не оставил обрезанный settings.json
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Ошибка при сохранении настроек: {e}")
+
+
+def estimate_tokens(text):
+    # Грубая оценка без обращения к API: около четырёх символов на токен
+    return len(text) // 4 + 1
+
+
+class ConversationContext:
+    """Контекст для многошаговых запросов.
+
+    Последние реплики, укладывающиеся в бюджет токенов, отправляются дословно,
+    более старые сжимаются в краткое содержание, которое хранится на диске.
+    """
+
+    def __init__(self, path, token_budget=4000):
+        self.path = path
+        self.token_budget = token_budget
+        self.summary = ""
+        self.summary_ts = None
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.summary = data.get("text", "")
+            self.summary_ts = data.get("upto_ts")
+        except (OSError, ValueError) as e:
+            print(f"Ошибка при загрузке краткого содержания чата: {e}")
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"text": self.summary, "upto_ts": self.summary_ts}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        self.summary = ""
+        self.summary_ts = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def update_summary(self, text, upto_ts):
+        self.summary = text.strip()
+        self.summary_ts = upto_ts
+        self.save()
+
+    def split(self, records, reserved_tokens=0):
+        """Возвращает (реплики для дословной отправки, старые реплики, ещё не попавшие в краткое содержание).
+
+        reserved_tokens — часть бюджета, уже занятая текущим запросом.
+        """
+        budget = self.token_budget - estimate_tokens(self.summary) - reserved_tokens
+        start = len(records)
+        while start > 0:
+            cost = estimate_tokens(records[start - 1].get("text", ""))
+            if cost > budget:
+                break
+            budget -= cost
+            start -= 1
+        pending = [record for record in records[:start]
+                   if self.summary_ts is None or record.get("ts", 0) > self.summary_ts]
+        return records[start:], pending
+
+    @staticmethod
+    def _append_turn(contents, role, parts):
+        # Соседние реплики одной роли склеиваем: API ожидает чередование user/model
+        if contents and contents[-1]["role"] == role:
+            contents[-1]["parts"].extend(parts)
+        elif contents or role == "user":
+            contents.append({"role": role, "parts": list(parts)})
+
+    def build_contents(self, records, current_parts):
+        reserved = sum(estimate_tokens(part) for part in current_parts if isinstance(part, str))
+        window, _ = self.split(records, reserved)
+        contents = []
+        if self.summary:
+            self._append_turn(contents, "user", [f"Summary of the earlier conversation:\n{self.summary}"])
+            self._append_turn(contents, "model", ["OK."])
+        for record in window:
+            text = record.get("text", "")
+            # Остановленный ответ без текста дал бы пустую реплику, которую API отклоняет
+            if not text.strip():
+                continue
+            role = "user" if record.get("role") == "user" else "model"
+            self._append_turn(contents, role, [text])
+        self._append_turn(contents, "user", current_parts)
+        return contents
+
+    def summary_prompt(self, pending):
+        lines = []
+        for record in pending:
+            speaker = "User" if record.get("role") == "user" else "Assistant"
+            lines.append(f"{speaker}: {record.get('text', '')}")
+        return (
+            "Update the running summary of a conversation between a user and an assistant. "
+            "Keep facts, decisions, names and open questions; be concise. "
+            "Write the summary in the language of the conversation and output only the summary.\n\n"
+            f"Current summary:\n{self.summary or '(empty)'}\n\n"
+            "New messages:\n" + "\n".join(lines)
+        )
+
+    def needs_compaction(self, records):
+        _, pending = self.split(records)
+        pending_tokens = sum(estimate_tokens(record.get("text", "")) for record in pending)
+        return pending if pending_tokens >= self.token_budget // 4 else []
+
+
+def migrate_record_colors(record):
+    message = record.get("html", "")
+    message = message.replace("<p style='color:#ADD8E6;'>", "<p style='color:#8A2BE2;'>")
+    record["html"] = message.replace("<p style='color:green;'>", "<p style='color:#8A2BE2;'>")
+    return record
+
+
+def ai_message_html(text, suffix=""):
+    """HTML ответа модели: текст экранируется, переводы строк становятся <br> — одинаково в потоке и в итоге."""
+    body = html.escape(text).replace("\n", "<br>")
+    return f"<p style='color:#8A2BE2;'>Win-AI: {body}{suffix}</p>"
+
+
+def make_chat_record(role, text, html_text):
+    return {"ts": time.time(), "role": role, "text": text, "html": html_text}
+
+
+def legacy_chat_record(html_text):
+    """Запись журнала из HTML-строки старого формата chat_history."""
+    role = "user" if "color:#FFFFFF" in html_text else "ai"
+    text = html.unescape(re.sub(r"<[^>]+>", "", html_text)).strip()
+    if ": " in text:
+        text = text.split(": ", 1)[1]
+    return migrate_record_colors({"ts": 0, "role": role, "text": text, "html": html_text})
+
+
+class ChatItem:
+    __slots__ = ("html", "layout_width", "height")
+
+    def __init__(self, html_text):
+        self.html = html_text
+        # Высота кэшируется только для последней ширины раскладки
+        self.layout_width = -1
+        self.height = 0
+
+
+class ChatListModel(QAbstractListModel):
+    """Сообщения чата. Идентификатор сообщения не меняется при вставке строк сверху."""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._items = []
+        self._first_id = 0
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._items)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or role != Qt.DisplayRole:
+            return None
+        return self._items[index.row()].html
+
+    def item(self, row):
+        return self._items[row]
+
+    def row_for_id(self, msg_id):
+        row = msg_id - self._first_id
+        return row if 0 <= row < len(self._items) else -1
+
+    def append_message(self, html_text):
+        row = len(self._items)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self._items.append(ChatItem(html_text))
+        self.endInsertRows()
+        return self._first_id + row
+
+    def append_messages(self, html_list):
+        if not html_list:
+            return
+        row = len(self._items)
+        self.beginInsertRows(QModelIndex(), row, row + len(html_list) - 1)
+        self._items.extend(ChatItem(html_text) for html_text in html_list)
+        self.endInsertRows()
+
+    def prepend_messages(self, html_list):
+        if not html_list:
+            return
+        self.beginInsertRows(QModelIndex(), 0, len(html_list) - 1)
+        self._items[:0] = [ChatItem(html_text) for html_text in html_list]
+        self._first_id -= len(html_list)
+        self.endInsertRows()
+
+    def set_message(self, msg_id, html_text):
+        row = self.row_for_id(msg_id)
+        if row < 0:
+            return False
+        item = self._items[row]
+        item.html = html_text
+        item.layout_width = -1
+        index = self.index(row)
+        self.dataChanged.emit(index, index)
+        return True
+
+    def clear(self):
+        self.beginResetModel()
+        # Старые идентификаторы становятся недействительными, новые не пересекаются с ними
+        self._first_id += len(self._items)
+        self._items = []
+        self.endResetModel()
+
+
+class ChatMessageDelegate(QStyledItemDelegate):
+    """Рисует HTML сообщения одним общим QTextDocument и кэширует высоту в ChatItem."""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._doc = QTextDocument()
+        self._doc.setDocumentMargin(4)
+
+    def _layout(self, html_text, width, font):
+        self._doc.setDefaultFont(font)
+        self._doc.setHtml(html_text)
+        self._doc.setTextWidth(width)
+
+    def sizeHint(self, option, index):
+        item = index.model().item(index.row())
+        width = option.rect.width()
+        if item.layout_width != width:
+            self._layout(item.html, width, option.font)
+            item.layout_width = width
+            item.height = int(self._doc.size().height()) + 1
+        return QSize(width, item.height)
+
+    def paint(self, painter, option, index):
+        self._layout(index.data(), option.rect.width(), option.font)
+        painter.save()
+        painter.translate(option.rect.topLeft())
+        painter.setClipRect(QRect(0, 0, option.rect.width(), option.rect.height()))
+        context = QAbstractTextDocumentLayout.PaintContext()
+        context.palette.setColor(QPalette.Text, option.palette.color(QPalette.Text))
+        self._doc.documentLayout().draw(painter, context)
+        painter.restore()
+
+
+class ChatView(QAbstractScrollArea):
+    """Виртуализированная лента чата.
+
+    Положение прокрутки хранится как (первая видимая строка, смещение в пикселях),
+    поэтому раскладываются и рисуются только видимые сообщения, сколько бы их ни было.
+    """
+    reached_top = pyqtSignal()
+    SPACING = 6
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._model = None
+        self._delegate = ChatMessageDelegate(self)
+        self._top_row = 0
+        self._top_offset = 0
+        self._stick_to_bottom = True
+        self._syncing_scrollbar = False
+        self.copy_text = "Копировать"
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.verticalScrollBar().valueChanged.connect(self._on_scrollbar_moved)
+
+    def setModel(self, model):
+        self._model = model
+        model.rowsInserted.connect(self._on_rows_inserted)
+        model.dataChanged.connect(self._on_data_changed)
+        model.modelReset.connect(self._on_model_reset)
+        self._sync_scrollbar()
+
+    def model(self):
+        return self._model
+
+    def _row_count(self):
+        return self._model.rowCount() if self._model is not None else 0
+
+    def _view_option(self):
+        option = QStyleOptionViewItem()
+        option.initFrom(self.viewport())
+        option.font = self.font()
+        option.palette = self.palette()
+        option.rect = QRect(0, 0, self.viewport().width(), 0)
+        return option
+
+    def _row_height(self, row):
+        hint = self._delegate.sizeHint(self._view_option(), self._model.index(row))
+        return hint.height() + self.SPACING
+
+    def _anchor_to_bottom(self):
+        remaining = self.viewport().height()
+        row = self._row_count() - 1
+        while row >= 0:
+            height = self._row_height(row)
+            if height >= remaining:
+                self._top_row = row
+                self._top_offset = height - remaining
+                return
+            remaining -= height
+            row -= 1
+        self._top_row = 0
+        self._top_offset = 0
+
+    def _visible_rows(self):
+        count = self._row_count()
+        if count == 0:
+            return []
+        if self._stick_to_bottom:
+            self._anchor_to_bottom()
+        viewport_height = self.viewport().height()
+        rows = []
+        y = -self._top_offset
+        row = self._top_row
+        while row < count and y < viewport_height:
+            height = self._row_height(row)
+            rows.append((row, y, height))
+            y += height
+            row += 1
+        return rows
+
+    def _rest_fits_viewport(self):
+        count = self._row_count()
+        viewport_height = self.viewport().height()
+        y = -self._top_offset
+        row = self._top_row
+        while row < count:
+            y += self._row_height(row)
+            if y > viewport_height:
+                return False
+            row += 1
+        return True
+
+    def scroll_by(self, dy):
+        count = self._row_count()
+        if count == 0:
+            return
+        if self._stick_to_bottom:
+            if dy >= 0:
+                return
+            self._anchor_to_bottom()
+            self._stick_to_bottom = False
+
+        row = self._top_row
+        offset = self._top_offset + dy
+        while offset < 0 and row > 0:
+            row -= 1
+            offset += self._row_height(row)
+        offset = max(0, offset)
+        while row < count - 1 and offset >= self._row_height(row):
+            offset -= self._row_height(row)
+            row += 1
+        self._top_row = row
+        self._top_offset = offset
+
+        if dy > 0 and self._rest_fits_viewport():
+            self._stick_to_bottom = True
+        self._sync_scrollbar()
+        self.viewport().update()
+        if dy < 0 and row == 0 and offset == 0:
+            self.reached_top.emit()
+
+    def scroll_to_bottom(self):
+        self._stick_to_bottom = True
+        self._sync_scrollbar()
+        self.viewport().update()
+
+    def _sync_scrollbar(self):
+        count = self._row_count()
+        bar = self.verticalScrollBar()
+        self._syncing_scrollbar = True
+        bar.setRange(0, max(0, count - 1))
+        bar.setPageStep(max(1, self.viewport().height() // max(1, self.fontMetrics().height() * 2)))
+        bar.setValue(bar.maximum() if self._stick_to_bottom else self._top_row)
+        self._syncing_scrollbar = False
+
+    def _on_scrollbar_moved(self, value):
+        if self._syncing_scrollbar:
+            return
+        if value >= self.verticalScrollBar().maximum():
+            self._stick_to_bottom = True
+        else:
+            self._stick_to_bottom = False
+            self._top_row = value
+            self._top_offset = 0
+        self.viewport().update()
+        if value == 0:
+            self.reached_top.emit()
+
+    def _on_rows_inserted(self, parent, first, last):
+        # Строки, вставленные выше видимой области, не должны сдвигать картинку
+        if not self._stick_to_bottom and first <= self._top_row:
+            self._top_row += last - first + 1
+        self._sync_scrollbar()
+        self.viewport().update()
+
+    def _on_data_changed(self, top_left, bottom_right):
+        self.viewport().update()
+
+    def _on_model_reset(self):
+        self._top_row = 0
+        self._top_offset = 0
+        self._stick_to_bottom = True
+        self._sync_scrollbar()
+        self.viewport().update()
+
+    def paintEvent(self, event):
+        if self._model is None:
+            return
+        painter = QPainter(self.viewport())
+        option = self._view_option()
+        width = self.viewport().width()
+        for row, y, height in self._visible_rows():
+            option.rect = QRect(0, y, width, height - self.SPACING)
+            self._delegate.paint(painter, option, self._model.index(row))
+        painter.end()
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self._sync_scrollbar()
+
+    def wheelEvent(self, event):
+        steps = event.angleDelta().y() / 120
+        self.scroll_by(int(-steps * 3 * self.fontMetrics().lineSpacing()))
+        event.accept()
+
+    def keyPressEvent(self, event):
+        if event.key() == Qt.Key_PageUp:
+            self.scroll_by(-self.viewport().height())
+        elif event.key() == Qt.Key_PageDown:
+            self.scroll_by(self.viewport().height())
+        elif event.key() == Qt.Key_End:
+            self.scroll_to_bottom()
+        else:
+            super().keyPressEvent(event)
+
+    def contextMenuEvent(self, event):
+        # События контекстного меню приходят из viewport, координаты уже в его системе
+        for row, y, height in self._visible_rows():
+            if y <= event.pos().y() < y + height:
+                menu = QMenu(self)
+                copy_action = menu.addAction(self.copy_text)
+                if menu.exec_(event.globalPos()) is copy_action:
+                    html_text = self._model.item(row).html
+                    QApplication.clipboard().setText(QTextDocumentFragment.fromHtml(html_text).toPlainText())
+                return
+
+
+class ResponseCache:
+    """Кэш ответов модели: LRU в памяти и ограниченный по размеру каталог на диске со сроком жизни записей.
+
+    Методы потокобезопасны: поиск на диске и запись выполняются в потоках RequestExecutor.
+    """
+
+    def __init__(self, directory, memory_entries=128, disk_bytes=50 * 1024 * 1024, ttl_seconds=7 * 24 * 3600):
+        self.directory = directory
+        self.memory_entries = memory_entries
+        self.disk_bytes = disk_bytes
+        self.ttl_seconds = ttl_seconds
+        self._memory = OrderedDict()
+        self._disk_index = None
+        self._disk_size = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model_name, language_instruction, text, attachments=(), digests=()):
+        """attachments — байты вложений, digests — уже посчитанные SHA-256 (hex) больших файлов."""
+        digest = hashlib.sha256()
+        for field in (model_name, language_instruction, text):
+            digest.update(field.encode('utf-8'))
+            digest.update(b"\0")
+        for data in attachments:
+            digest.update(hashlib.sha256(data).digest())
+        for file_digest in digests:
+            digest.update(bytes.fromhex(file_digest))
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def _expired(self, created):
+        return time.time() - created > self.ttl_seconds
+
+    def _remember(self, key, created, text):
+        with self._lock:
+            self._memory[key] = (created, text)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+
+    def get_memory(self, key):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                return None
+            created, text = entry
+            if self._expired(created):
+                del self._memory[key]
+                return None
+            self._memory.move_to_end(key)
+            return text
+
+    def get(self, key):
+        text = self.get_memory(key)
+        if text is not None:
+            return text
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if self._expired(entry.get("created", 0)):
+            with self._lock:
+                self._remove_disk_entry(key)
+            return None
+        self._remember(key, entry["created"], entry["text"])
+        return entry["text"]
+
+    def put(self, key, text):
+        created = time.time()
+        self._remember(key, created, text)
+        data = json.dumps({"created": created, "text": text}, ensure_ascii=False)
+        with self._lock:
+            index = self._load_disk_index()
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                tmp_path = self._path(key) + ".tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    f.write(data)
+                os.replace(tmp_path, self._path(key))
+            except OSError as e:
+                print(f"Ошибка записи в кэш ответов: {e}")
+                return
+            self._disk_size += len(data.encode('utf-8')) - index.get(key, 0)
+            index[key] = len(data.encode('utf-8'))
+            index.move_to_end(key)
+            while self._disk_size > self.disk_bytes and len(index) > 1:
+                self._remove_disk_entry(next(iter(index)))
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            for key in list(self._load_disk_index()):
+                self._remove_disk_entry(key)
+
+    def _load_disk_index(self):
+        # Каталог сканируется один раз; порядок — от самых старых файлов к новым
+        if self._disk_index is None:
+            entries = []
+            if os.path.isdir(self.directory):
+                for name in os.listdir(self.directory):
+                    if name.endswith(".json"):
+                        stat = os.stat(os.path.join(self.directory, name))
+                        entries.append((stat.st_mtime, name[:-5], stat.st_size))
+            entries.sort()
+            self._disk_index = OrderedDict((key, size) for _, key, size in entries)
+            self._disk_size = sum(size for _, _, size in entries)
+        return self._disk_index
+
+    def _remove_disk_entry(self, key):
+        index = self._load_disk_index()
+        self._disk_size -= index.pop(key, 0)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+
+class FileAttachment:
+    """Часть запроса с файлом, который загружается через File API в потоке запроса."""
+
+    def __init__(self, path, mime_type):
+        self.path = path
+        self.mime_type = mime_type
+        self.size = os.path.getsize(path)
+        self.digest = None
+
+
+def image_output_format(image_format):
+    """Формат кодирования и его MIME-тип; WebP заменяется на JPEG, если нет плагина Qt."""
+    image_format = image_format.upper()
+    if image_format == "WEBP" and b"webp" in QImageWriter.supportedImageFormats():
+        return "WEBP", "image/webp"
+    return "JPEG", "image/jpeg"
+
+
+def encode_image(image, max_side, image_format, quality):
+    """Уменьшает QImage до max_side по большей стороне и кодирует его. Возвращает (байты, MIME-тип) или None.
+
+    Изображение перерисовывается в новый QImage, поэтому EXIF и текстовые метаданные в результат не попадают.
+    """
+    image_format, mime_type = image_output_format(image_format)
+    if max(image.width(), image.height()) > max_side:
+        image = image.scaled(max_side, max_side, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+    clean = QImage(image.size(), QImage.Format_RGB32)
+    clean.fill(Qt.white)
+    painter = QPainter(clean)
+    painter.drawImage(0, 0, image)
+    painter.end()
+
+    output = QByteArray()
+    output_buffer = QBuffer(output)
+    output_buffer.open(QIODevice.WriteOnly)
+    if not clean.save(output_buffer, image_format, quality):
+        return None
+    return bytes(output), mime_type
+
+
+def percentile(values, fraction):
+    """Перцентиль по отсортированной выборке (без интерполяции)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class ImageAttachment(FileAttachment):
+    """Изображение, которое перед отправкой проходит через ImagePreprocessor."""
+
+
+class ImagePreprocessor:
+    """Уменьшает и перекодирует изображения перед отправкой.
+
+    Работает в потоках RequestExecutor (QImage, в отличие от QPixmap, можно использовать
+    вне потока интерфейса). Результаты кэшируются на диске по хэшу исходника.
+    """
+    MAX_CACHED_FILES = 200
+
+    def __init__(self, cache_dir, max_side=2048, image_format="JPEG", quality=85):
+        self.cache_dir = cache_dir
+        self.max_side = max_side
+        self.image_format = image_format
+        self.quality = quality
+        self._lock = threading.Lock()
+
+    def _cache_path(self, digest, image_format):
+        name = f"{digest}_{self.max_side}_{self.quality}.{image_format.lower()}"
+        return os.path.join(self.cache_dir, name)
+
+    def process(self, attachment):
+        """Возвращает (байты, MIME-тип) или None, если перекодирование не уменьшает файл."""
+        image_format, mime_type = image_output_format(self.image_format)
+        cache_path = self._cache_path(attachment.digest, image_format)
+        if os.path.exists(cache_path):
+            with open(cache_path, 'rb') as f:
+                return f.read(), mime_type
+
+        with open(attachment.path, 'rb') as f:
+            source = QByteArray(f.read())
+        source_buffer = QBuffer(source)
+        source_buffer.open(QIODevice.ReadOnly)
+        reader = QImageReader(source_buffer)
+        # Учитываем ориентацию из EXIF до того, как метаданные будут отброшены
+        reader.setAutoTransform(True)
+        image = reader.read()
+        if image.isNull():
+            return None
+        encoded = encode_image(image, self.max_side, image_format, self.quality)
+        if encoded is None or len(encoded[0]) >= attachment.size:
+            return None
+        data = encoded[0]
+
+        with self._lock:
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                with open(cache_path, 'wb') as f:
+                    f.write(data)
+                self._trim_cache()
+            except OSError as e:
+                print(f"Ошибка записи в кэш изображений: {e}")
+        return data, mime_type
+
+    def _trim_cache(self):
+        paths = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir)]
+        if len(paths) <= self.MAX_CACHED_FILES:
+            return
+        paths.sort(key=os.path.getmtime)
+        for path in paths[:len(paths) - self.MAX_CACHED_FILES]:
+            os.remove(path)
+
+
+class UploadCancelled(Exception):
+    pass
+
+
+class ProgressReader(io.RawIOBase):
+    """Обёртка над файлом, сообщающая о прогрессе чтения во время загрузки."""
+
+    def __init__(self, fileobj, total, progress=None, cancel_event=None):
+        super().__init__()
+        self._fileobj = fileobj
+        self.total = total
+        self._progress = progress
+        self._cancel_event = cancel_event
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self._fileobj.seek(offset, whence)
+
+    def tell(self):
+        return self._fileobj.tell()
+
+    def readinto(self, buffer):
+        if self._cancel_event is not None and self._cancel_event.is_set():
+            raise UploadCancelled()
+        count = self._fileobj.readinto(buffer)
+        if self._progress is not None:
+            self._progress(self._fileobj.tell(), self.total)
+        return count
+
+
+class FileUploader:
+    """Потоковая загрузка больших файлов с дедупликацией по SHA-256 содержимого.
+
+    Соответствие хэш -> имя файла на стороне API хранится в JSON, поэтому повторный
+    анализ того же файла использует уже загруженную копию.
+    """
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, registry_path):
+        self.registry_path = registry_path
+        self._lock = threading.Lock()
+        self._registry = {}
+        if os.path.exists(registry_path):
+            try:
+                with open(registry_path, 'r', encoding='utf-8') as f:
+                    self._registry = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Ошибка при загрузке списка загруженных файлов: {e}")
+
+    @classmethod
+    def file_digest(cls, path, cancel_event=None):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(cls.CHUNK_SIZE), b""):
+                if cancel_event is not None and cancel_event.is_set():
+                    raise UploadCancelled()
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _save_registry(self):
+        tmp_path = self.registry_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._registry, f)
+        os.replace(tmp_path, self.registry_path)
+
+    def _find_remote(self, digest):
+        with self._lock:
+            entry = self._registry.get(digest)
+        if not entry or time.time() - entry.get("uploaded", 0) > REMOTE_FILE_TTL:
+            return None
+        try:
+            remote = genai.get_file(entry["name"])
+        except Exception:
+            return None
+        return remote if remote.state.name == "ACTIVE" else None
+
+    def upload(self, attachment, progress=None, cancel_event=None):
+        if attachment.digest is None:
+            attachment.digest = self.file_digest(attachment.path, cancel_event)
+        remote = self._find_remote(attachment.digest)
+        if remote is not None:
+            return remote
+
+        with open(attachment.path, 'rb') as f:
+            reader = ProgressReader(f, attachment.size, progress, cancel_event)
+            remote = genai.upload_file(reader, mime_type=attachment.mime_type,
+                                       display_name=os.path.basename(attachment.path))
+        # Видео и аудио API обрабатывает после загрузки; в запросе их можно использовать только в состоянии ACTIVE
+        while remote.state.name == "PROCESSING":
+            if cancel_event is not None and cancel_event.is_set():
+                raise UploadCancelled()
+            time.sleep(2)
+            remote = genai.get_file(remote.name)
+        if remote.state.name != "ACTIVE":
+            raise RuntimeError(f"File processing failed: {remote.state.name}")
+
+        with self._lock:
+            self._registry[attachment.digest] = {"name": remote.name, "uploaded": time.time()}
+            self._save_registry()
+        return remote
+
+
+def iter_attachments(contents):
+    for item in contents:
+        parts = item["parts"] if isinstance(item, dict) and "parts" in item else [item]
+        for part in parts:
+            if isinstance(part, FileAttachment):
+                yield part
+
+
+def replace_attachments(contents, resolved):
+    """Подставляет загруженные файлы вместо FileAttachment."""
+    def resolve(part):
+        return resolved.get(id(part), part)
+    result = []
+    for item in contents:
+        if isinstance(item, dict) and "parts" in item:
+            result.append(dict(item, parts=[resolve(part) for part in item["parts"]]))
+        else:
+            result.append(resolve(item))
+    return result
+
+
+def split_text_chunks(lines, max_chars):
+    """Делит строки на части не длиннее max_chars и возвращает [(номер первой строки, текст)].
+
+    Разрыв допускается только перед непустой строкой без отступа: строки с отступом
+    (тело функции, стек вызовов в логе) остаются вместе с началом своей записи,
+    декоратор — со своей функцией. Части считаются от начала файла, поэтому при дописывании
+    в конец лога меняются только последние части. Запись длиннее 2 * max_chars режется по строкам.
+    """
+    chunks = []
+    current = []
+    current_len = 0
+    start_line = 1
+    previous = ""
+    for line_number, line in enumerate(lines, 1):
+        is_boundary = line[:1] not in (" ", "\t") and line.strip() and not previous.startswith("@")
+        if current and ((is_boundary and current_len + len(line) > max_chars) or current_len + len(line) > 2 * max_chars):
+            chunks.append((start_line, "".join(current)))
+            current = []
+            current_len = 0
+            start_line = line_number
+        current.append(line)
+        current_len += len(line)
+        if line.strip():
+            previous = line
+    if current:
+        chunks.append((start_line, "".join(current)))
+    return chunks
+
+
+def group_partials(partials, max_chars):
+    """Делит частичные результаты на группы для этапа reduce.
+
+    В каждой группе не меньше двух результатов, поэтому каждый раунд reduce как минимум вдвое
+    сокращает их число. Если группа не укладывается в max_chars, каждый её результат обрезается
+    до равной доли лимита.
+    """
+    groups = []
+    current = []
+    current_len = 0
+    for text in partials:
+        if len(current) >= 2 and current_len + len(text) > max_chars:
+            groups.append(current)
+            current = []
+            current_len = 0
+        current.append(text)
+        current_len += len(text)
+    if len(current) == 1 and groups:
+        groups[-1].append(current[0])
+    else:
+        groups.append(current)
+    return [trim_partials(group, max_chars) for group in groups]
+
+
+def trim_partials(partials, max_chars):
+    if sum(len(text) for text in partials) <= max_chars:
+        return list(partials)
+    share = max(1, max_chars // len(partials))
+    return [text if len(text) <= share else text[:share] + "\n[...]" for text in partials]
+
+
+class ChunkedAnalysisJob(QObject):
+    """Map-reduce анализ большого текстового файла через общий RequestExecutor.
+
+    Части анализируются параллельно (не больше max_parallel запросов одновременно),
+    затем частичные результаты объединяются. Запросы к частям кэшируются по их тексту,
+    поэтому при повторном анализе дописанного лога заново обрабатывается только хвост.
+    """
+    # (этап: "split" | "map" | "reduce", готово, всего, из кэша)
+    progress = pyqtSignal(str, int, int, int)
+    finished = pyqtSignal(str)
+    failed = pyqtSignal(str)
+    _chunks_ready = pyqtSignal(list)
+    _split_failed = pyqtSignal(str)
+
+    def __init__(self, executor, file_path, language_instruction, chunk_chars=60000, max_parallel=3, parent=None):
+        super().__init__(parent)
+        self.executor = executor
+        self.file_path = file_path
+        self.file_name = os.path.basename(file_path)
+        self.language_instruction = language_instruction
+        self.chunk_chars = chunk_chars
+        self.max_parallel = max(1, max_parallel)
+        self.cancelled = False
+        self._queue = []
+        self._in_flight = {}
+        self._results = []
+        self._done = 0
+        self._cached = 0
+        self._stage = "split"
+        self._on_stage_done = None
+        # Сколько результатов было на входе предыдущего раунда reduce
+        self._reduce_inputs = None
+
+        executor.response_received.connect(self._on_response)
+        executor.error_occurred.connect(self._on_error)
+        self._chunks_ready.connect(self._on_chunks_ready)
+        self._split_failed.connect(self._fail)
+
+    def start(self):
+        self.progress.emit("split", 0, 0, 0)
+        threading.Thread(target=self._split, daemon=True).start()
+
+    def cancel(self):
+        self.cancelled = True
+        for request_id in list(self._in_flight):
+            self.executor.cancel(request_id)
+        self._in_flight.clear()
+        self._queue = []
+
+    def _split(self):
+        # Чтение и разбиение большого файла — не в потоке интерфейса
+        try:
+            with open(self.file_path, 'r', encoding='utf-8', errors='replace') as f:
+                header = ""
+                if os.path.splitext(self.file_name)[1].lower() in (".csv", ".tsv"):
+                    header = f.readline()
+                chunks = split_text_chunks(f, self.chunk_chars)
+        except OSError as e:
+            self._split_failed.emit(str(e))
+            return
+        if header:
+            # Заголовок CSV повторяется в каждой части, нумерация строк — с учётом заголовка
+            chunks = [(start + 1, header + text) for start, text in chunks]
+        self._chunks_ready.emit(chunks)
+
+    def _map_prompt(self, start_line, text):
+        return (
+            f"{self.language_instruction}\n"
+            f"This is a fragment of the file {self.file_name} starting at line {start_line}. "
+            "Analyze this fragment: briefly summarize its content and list notable errors, anomalies "
+            "or findings with line numbers.\n\n" + text
+        )
+
+    def _reduce_prompt(self, partials):
+        body = "\n\n".join(f"--- Part {index} ---\n{text}" for index, text in enumerate(partials, 1))
+        return (
+            f"{self.language_instruction}\n"
+            f"Below are analyses of consecutive parts of the file {self.file_name}. "
+            "Merge them into a single coherent analysis of the whole file, "
+            "removing duplicates and keeping the important findings.\n\n" + body
+        )
+
+    def _on_chunks_ready(self, chunks):
+        if self.cancelled:
+            return
+        if not chunks:
+            self.finished.emit("")
+            return
+        prompts = [self._map_prompt(start_line, text) for start_line, text in chunks]
+        self._run_stage("map", prompts, self._reduce)
+
+    def _run_stage(self, stage, prompts, on_done):
+        self._stage = stage
+        self._queue = list(enumerate(prompts))
+        self._results = [None] * len(prompts)
+        self._done = 0
+        self._cached = 0
+        self._on_stage_done = on_done
+        self.progress.emit(stage, 0, len(prompts), 0)
+        self._pump()
+
+    def _pump(self):
+        while self._queue and len(self._in_flight) < self.max_parallel:
+            index, prompt = self._queue[0]
+            cache_key = ResponseCache.make_key(GEMINI_MODEL_NAME, self.language_instruction, prompt)
+            request_id = self.executor.submit([prompt], cache_key=cache_key)
+            if request_id is None:
+                # Очередь исполнителя занята другими запросами — повторим позже
+                if not self._in_flight:
+                    QTimer.singleShot(500, self._pump)
+                return
+            self._queue.pop(0)
+            self._in_flight[request_id] = index
+
+    def _on_response(self, request_id, text, cached):
+        index = self._in_flight.pop(request_id, None)
+        if index is None or self.cancelled:
+            return
+        self._results[index] = text
+        self._done += 1
+        self._cached += int(cached)
+        self.progress.emit(self._stage, self._done, len(self._results), self._cached)
+        if self._done == len(self._results):
+            self._on_stage_done(self._results)
+        else:
+            self._pump()
+
+    def _on_error(self, request_id, error_message):
+        if self._in_flight.pop(request_id, None) is None or self.cancelled:
+            return
+        self._fail(error_message)
+
+    def _fail(self, error_message):
+        self.cancel()
+        self.failed.emit(error_message)
+
+    def _reduce(self, partials):
+        if len(partials) == 1:
+            self.finished.emit(partials[0])
+            return
+        # Если частичные результаты не помещаются в один запрос, объединяем их группами
+        groups = group_partials(partials, self.chunk_chars)
+        stalled = self._reduce_inputs is not None and len(partials) >= self._reduce_inputs
+        self._reduce_inputs = len(partials)
+        if len(groups) == 1 or stalled:
+            # Раунд не уменьшил число результатов — один итоговый запрос с обрезанными результатами
+            final = groups[0] if len(groups) == 1 else trim_partials(partials, self.chunk_chars)
+            self._run_stage("reduce", [self._reduce_prompt(final)], lambda results: self.finished.emit(results[0]))
+        else:
+            self._run_stage("reduce", [self._reduce_prompt(group) for group in groups], self._reduce)
+
+
+def create_gemini_model(api_key):
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel(GEMINI_MODEL_NAME)
+
+
+def language_instruction_for(language):
+    if language == "ru":
+        return "Ответь на русском языке."
+    return "Answer in English."
+
+
+def file_prompt_kwargs(file_path):
+    """Аргументы send_message для файла: большие файлы и изображения читаются в потоке запроса, остальные — сразу."""
+    file_name = os.path.basename(file_path)
+    mime_type = mime_type_for(file_name)
+    kwargs = {"file_name": file_name, "file_mime_type": mime_type}
+    if os.path.getsize(file_path) > INLINE_FILE_LIMIT or mime_type in PREPROCESSED_IMAGE_TYPES:
+        kwargs["file_path"] = file_path
+    else:
+        with open(file_path, 'rb') as f:
+            kwargs["file_data"] = f.read()
+    return kwargs
+
+
+def build_prompt_parts(text, language_instruction, file_path=None, file_data=None, file_name=None,
+                       file_mime_type=None, image_data=None, image_mime_type="image/jpeg", audio_data=None,
+                       audio_mime_type="audio/flac", voice_instruction=None):
+    """Части запроса к модели; одинаковы для окна чата и пакетного режима.
+
+    voice_instruction — текст запроса к аудио (UI_TEXTS voice_instruction на языке интерфейса).
+    """
+    prompt_parts = []
+    if file_path and file_name and file_mime_type:
+        if file_mime_type in PREPROCESSED_IMAGE_TYPES:
+            prompt_parts.append(ImageAttachment(file_path, file_mime_type))
+        else:
+            prompt_parts.append(FileAttachment(file_path, file_mime_type))
+        prompt_parts.append(f"{language_instruction}\nAnalyze file {file_name}: {text}")
+    elif file_data and file_name and file_mime_type:
+        prompt_parts.append({"mime_type": file_mime_type, "data": file_data})
+        prompt_parts.append(f"{language_instruction}\nAnalyze file {file_name}: {text}")
+
+    elif image_data:
+        prompt_parts.append({"mime_type": image_mime_type, "data": image_data})
+        prompt_parts.append(f"{language_instruction}\n{text}")
+    elif audio_data:
+        prompt_parts.append({"mime_type": audio_mime_type, "data": audio_data})
+        prompt_parts.append(f"{language_instruction}\n{voice_instruction or text}")
+    else:
+        prompt_parts.append(f"{language_instruction}\n{text}")
+    return prompt_parts
+
+
+def prompt_cache_key(text, language_instruction, file_path=None, attachments=()):
+    """Возвращает (cache_key, cache_fields) для RequestExecutor.submit."""
+    if file_path:
+        # Хэш большого файла посчитает поток запроса
+        return None, (GEMINI_MODEL_NAME, language_instruction, text)
+    return ResponseCache.make_key(GEMINI_MODEL_NAME, language_instruction, text, attachments), None
+
+
+class RequestTrace:
+    """Замеры одного запроса: длительность этапов в миллисекундах.
+
+    queue_wait — ожидание свободного потока, payload_build — хэши, ключ кэша и чтение вложений,
+    upload — File API, ttft — от вызова модели до первого фрагмента, model — весь вызов модели,
+    total — от постановки в очередь до конца. Для сообщений чата окно добавляет отрисовку (render)
+    и сборку запроса в GUI-потоке, а total считает от отправки до показа ответа.
+    """
+    SPANS = ("queue_wait", "payload_build", "upload", "ttft", "model", "render", "total")
+
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.spans = {}
+        # ok, cached, error или cancelled
+        self.outcome = None
+        self.error = None
+        # Повторы после ошибок и был ли отправлен дублирующий запрос
+        self.retries = 0
+        self.hedged = False
+
+    def add(self, name, started):
+        """Добавляет к этапу name время от started до текущего момента; возвращает текущий момент."""
+        now = time.perf_counter()
+        self.spans[name] = self.spans.get(name, 0.0) + (now - started) * 1000
+        return now
+
+    def to_record(self, kind):
+        record = {"ts": time.time(), "request_id": self.request_id, "kind": kind, "outcome": self.outcome,
+                  "spans": {name: round(self.spans[name], 1) for name in self.SPANS if name in self.spans}}
+        if self.error:
+            record["error"] = self.error
+        if self.retries:
+            record["retries"] = self.retries
+        if self.hedged:
+            record["hedged"] = True
+        return record
+
+
+class TraceLog:
+    """JSONL-файл с замерами запросов для разбора вне приложения; при переполнении сдвигается в .1, .2, ..."""
+
+    def __init__(self, path, max_bytes=1024 * 1024, backups=3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._file = None
+
+    def append(self, record):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        try:
+            if self._file is None:
+                self._file = open(self.path, 'a', encoding='utf-8')
+            if self._file.tell() + len(line) > self.max_bytes > 0:
+                self._rotate()
+            self._file.write(line)
+            self._file.flush()
+        except OSError as e:
+            print(f"Не удалось записать замеры запроса: {e}")
+
+    def _rotate(self):
+        self.close()
+        for index in range(self.backups, 0, -1):
+            source = self.path if index == 1 else f"{self.path}.{index - 1}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index}")
+        if self.backups <= 0 and os.path.exists(self.path):
+            os.remove(self.path)
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+RETRYABLE_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+# Временные ошибки google.api_core.exceptions и подобных библиотек, если у исключения нет числового code
+RETRYABLE_ERROR_NAMES = ("RequestTimeout", "TooManyRequests", "ResourceExhausted", "InternalServerError",
+                         "BadGateway", "ServiceUnavailable", "GatewayTimeout", "DeadlineExceeded")
+
+
+def is_retryable_error(error):
+    """Временные ошибки, после которых запрос имеет смысл повторить: 5xx, 429, обрывы соединения.
+
+    Решение принимается по коду статуса или типу исключения — текст сообщения не разбирается.
+    """
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    for attribute in ('code', 'status_code'):
+        code = getattr(error, attribute, None)
+        if isinstance(code, int) and not isinstance(code, bool):
+            return code in RETRYABLE_STATUS_CODES
+    return any(cls.__name__ in RETRYABLE_ERROR_NAMES for cls in type(error).__mro__)
+
+
+class ModelAttempt:
+    """Один вызов модели в отдельном потоке. Запрос может сделать несколько: повтор после ошибки или дубль.
+
+    События попадают в общую очередь запроса: ("chunk", attempt, text), ("done", attempt, text) и
+    ("error", attempt, exception). Отменённая попытка перестаёт читать поток, но сам HTTP-вызов
+    прервать нельзя — поток дорабатывает в фоне до срока request_options["timeout"], и его результат
+    отбрасывается. Место slot в лимите одновременных вызовов освобождается, только когда вызов
+    действительно завершился.
+    """
+
+    def __init__(self, model, contents, stream, events, slot=None, request_options=None):
+        self.model = model
+        self.contents = contents
+        self.stream = stream
+        self.events = events
+        self.slot = slot
+        self.request_options = request_options
+        self.cancel_event = threading.Event()
+        self.started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="win-ai-attempt")
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        try:
+            if not self.stream:
+                response = self.model.generate_content(self.contents, stream=False,
+                                                       request_options=self.request_options)
+                response.resolve()
+                result = ("done", self, response.text)
+            else:
+                response = self.model.generate_content(self.contents, stream=True,
+                                                       request_options=self.request_options)
+                for chunk in response:
+                    if self.cancelled:
+                        return
+                    try:
+                        text = chunk.text
+                    except ValueError:
+                        # Фрагмент без текста (например, только метаданные безопасности)
+                        continue
+                    if text:
+                        self.events.put(("chunk", self, text))
+                result = ("done", self, None)
+        except Exception as e:
+            result = ("error", self, e)
+        finally:
+            if self.slot is not None:
+                self.slot.release()
+        # Место освобождено до события, чтобы повтор после ошибки мог сразу его занять
+        self.events.put(result)
+
+
+class ModelRequest:
+    """Один запрос к модели: идентификатор, содержимое и флаг отмены."""
+
+    def __init__(self, request_id, contents, stream=False, cache_key=None, force_refresh=False, cache_fields=None):
+        self.request_id = request_id
+        self.contents = contents
+        self.stream = stream
+        self.cache_key = cache_key
+        # Для файлов, загружаемых через File API, ключ кэша считается в потоке запроса по хэшу содержимого
+        self.cache_fields = cache_fields
+        self.force_refresh = force_refresh
+        self.created_at = time.perf_counter()
+        self.cancel_event = threading.Event()
+        self.trace = RequestTrace(request_id)
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+
+class RequestExecutor(QObject):
+    """Долгоживущий исполнитель запросов к модели.
+
+    Один пул потоков и один объект модели на всё приложение, ограниченная очередь,
+    лимит одновременных запросов и отмена по идентификатору. Все сигналы несут
+    идентификатор запроса, чтобы ответ попал в своё сообщение.
+
+    Если модель молчит timeout_seconds (до первого фрагмента или между фрагментами; 0 — без срока),
+    запрос прерывается; весь вызов вместе с повторами ограничен total_timeout_seconds, этот же срок
+    передаётся SDK как таймаут HTTP-вызова. Временные ошибки повторяются до max_retries раз
+    с экспоненциальной паузой со случайным разбросом. Одновременных вызовов модели, включая
+    дубли и брошенные попытки, не больше ATTEMPTS_PER_REQUEST * max_concurrency. При hedge_requests, если
+    первый фрагмент не пришёл за p95 прошлых запросов, отправляется дубль: побеждает тот, кто ответит
+    первым, второй отменяется.
+    """
+    # Сколько последних TTFT хранить для p95 и с какого количества начинать дублировать запросы
+    LATENCY_SAMPLES = 100
+    MIN_HEDGE_SAMPLES = 20
+    # Основная попытка и дубль (или ещё не завершившаяся брошенная попытка) на каждый выполняемый запрос
+    ATTEMPTS_PER_REQUEST = 2
+    chunk_received = pyqtSignal(int, str)
+    first_token_received = pyqtSignal(int, float)
+    # (request_id, отправлено байт, всего байт)
+    upload_progress = pyqtSignal(int, int, int)
+    # (request_id, исходный размер, размер после сжатия)
+    image_preprocessed = pyqtSignal(int, int, int)
+    # (request_id, текст, ответ взят из кэша)
+    response_received = pyqtSignal(int, str, bool)
+    error_occurred = pyqtSignal(int, str)
+    # (request_id, RequestTrace) — последним сигналом запроса, в том числе после отмены
+    request_traced = pyqtSignal(int, object)
+
+    def __init__(self, model=None, max_concurrency=2, max_queued=8, response_cache=None, file_uploader=None,
+                 parent=None):
+        super().__init__(parent)
+        self.model = model
+        self.response_cache = response_cache
+        self.file_uploader = file_uploader
+        self.image_preprocessor = None
+        self.timeout_seconds = 120.0
+        self.total_timeout_seconds = 600.0
+        self.max_retries = 2
+        self.retry_backoff = 0.5
+        self.retry_backoff_max = 8.0
+        self.hedge_requests = False
+        self.hedge_min_delay = 1.0
+        self._ttft_samples = []
+        self._random = random.Random()
+        self._lock = threading.Lock()
+        self._requests = {}
+        self._next_id = 1
+        self._pool = None
+        self.configure(max_concurrency, max_queued)
+
+    def configure(self, max_concurrency, max_queued):
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.max_queued = max(0, int(max_queued))
+        old_pool = self._pool
+        self._pool = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="win-ai-request")
+        # Попытки освобождают тот семафор, из которого взяли место, поэтому замена безопасна
+        self._attempt_slots = threading.BoundedSemaphore(self.ATTEMPTS_PER_REQUEST * self.max_concurrency)
+        if old_pool is not None:
+            old_pool.shutdown(wait=False)
+
+    def is_full(self):
+        with self._lock:
+            return len(self._requests) >= self.max_concurrency + self.max_queued
+
+    def submit(self, contents, stream=False, cache_key=None, force_refresh=False, cache_fields=None):
+        """Ставит запрос в очередь. Возвращает его идентификатор или None, если очередь заполнена."""
+        with self._lock:
+            if len(self._requests) >= self.max_concurrency + self.max_queued:
+                return None
+            request = ModelRequest(self._next_id, contents, stream, cache_key, force_refresh, cache_fields)
+            self._next_id += 1
+            self._requests[request.request_id] = request
+        self._pool.submit(self._run, request)
+        return request.request_id
+
+    def cancel(self, request_id):
+        with self._lock:
+            request = self._requests.pop(request_id, None)
+        if request is not None:
+            request.cancel_event.set()
+
+    def cancel_all(self):
+        with self._lock:
+            requests = list(self._requests.values())
+            self._requests.clear()
+        for request in requests:
+            request.cancel_event.set()
+
+    def shutdown(self):
+        self.cancel_all()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, request):
+        trace = request.trace
+        started = trace.add("queue_wait", request.created_at)
+        try:
+            if request.cancelled:
+                return
+            attachments = list(iter_attachments(request.contents))
+            for attachment in attachments:
+                if attachment.digest is None:
+                    attachment.digest = FileUploader.file_digest(attachment.path, request.cancel_event)
+            if request.cache_key is None and request.cache_fields is not None:
+                request.cache_key = ResponseCache.make_key(
+                    *request.cache_fields, digests=[attachment.digest for attachment in attachments])
+            trace.add("payload_build", started)
+
+            cache = self.response_cache if request.cache_key else None
+            if cache is not None and not request.force_refresh:
+                cached_text = cache.get(request.cache_key)
+                if cached_text is not None:
+                    if not request.cancelled:
+                        trace.outcome = "cached"
+                        self.response_received.emit(request.request_id, cached_text, True)
+                    return
+            if attachments:
+                self._resolve_attachments(request, attachments)
+            text = self._generate(request)
+            if text is not None and not request.cancelled:
+                if cache is not None and text:
+                    cache.put(request.cache_key, text)
+                trace.outcome = "ok"
+                self.response_received.emit(request.request_id, text, False)
+        except UploadCancelled:
+            pass
+        except Exception as e:
+            if not request.cancelled:
+                trace.outcome = "error"
+                trace.error = str(e)
+                self.error_occurred.emit(request.request_id, str(e))
+        finally:
+            with self._lock:
+                self._requests.pop(request.request_id, None)
+            if trace.outcome is None:
+                trace.outcome = "cancelled"
+            trace.add("total", request.created_at)
+            self.request_traced.emit(request.request_id, trace)
+
+    def _resolve_attachments(self, request, attachments):
+        last_percent = [-1]
+
+        def progress(sent, total):
+            # Не чаще одного сигнала на процент
+            percent = sent * 100 // max(1, total)
+            if percent != last_percent[0]:
+                last_percent[0] = percent
+                self.upload_progress.emit(request.request_id, sent, total)
+
+        resolved = {}
+        # Лимит общий для всех вложений запроса, которые передаются байтами
+        inline_budget = INLINE_FILE_LIMIT
+        for attachment in attachments:
+            started = time.perf_counter()
+            if isinstance(attachment, ImageAttachment) and self.image_preprocessor is not None:
+                processed = self.image_preprocessor.process(attachment)
+                if processed is not None:
+                    data, mime_type = processed
+                    resolved[id(attachment)] = {"mime_type": mime_type, "data": data}
+                    inline_budget -= len(data)
+                    request.trace.add("payload_build", started)
+                    self.image_preprocessed.emit(request.request_id, attachment.size, len(data))
+                    continue
+            if attachment.size <= inline_budget:
+                with open(attachment.path, 'rb') as f:
+                    resolved[id(attachment)] = {"mime_type": attachment.mime_type, "data": f.read()}
+                inline_budget -= attachment.size
+                request.trace.add("payload_build", started)
+                continue
+            if self.file_uploader is None:
+                raise RuntimeError("File upload is not available.")
+            resolved[id(attachment)] = self.file_uploader.upload(attachment, progress, request.cancel_event)
+            request.trace.add("upload", started)
+        request.contents = replace_attachments(request.contents, resolved)
+
+    def hedge_delay(self):
+        """Через сколько секунд без первого фрагмента отправлять дубль; None — не дублировать."""
+        with self._lock:
+            samples = list(self._ttft_samples)
+        if not self.hedge_requests or len(samples) < self.MIN_HEDGE_SAMPLES:
+            return None
+        return max(self.hedge_min_delay, percentile(samples, 0.95))
+
+    def retry_delay(self, retry):
+        # "Full jitter": случайная пауза до экспоненциально растущего предела
+        return self._random.uniform(0, min(self.retry_backoff_max, self.retry_backoff * 2 ** retry))
+
+    def _record_ttft(self, seconds):
+        with self._lock:
+            self._ttft_samples = (self._ttft_samples + [seconds])[-self.LATENCY_SAMPLES:]
+
+    def _start_attempt(self, model, request, events, deadline, wait=True):
+        """Запускает попытку, когда освободится место в лимите вызовов.
+
+        Без wait возвращает None, если места нет (так поступает дубль); с wait ждёт места до отмены
+        запроса (None) или до общего срока (TimeoutError).
+        """
+        slots = self._attempt_slots
+        while not slots.acquire(timeout=0.1 if wait else 0):
+            if not wait or request.cancelled:
+                return None
+            if deadline is not None and time.perf_counter() >= deadline:
+                raise TimeoutError(f"No response from the model within {self.total_timeout_seconds:g} s.")
+        request_options = None
+        if deadline is not None:
+            request_options = {"timeout": max(1.0, deadline - time.perf_counter())}
+        return ModelAttempt(model, request.contents, request.stream, events, slots, request_options).start()
+
+    def _generate(self, request):
+        model = self.model
+        if model is None:
+            raise RuntimeError("Win-AI model not initialized.")
+
+        started = time.perf_counter()
+        deadline = started + self.total_timeout_seconds if self.total_timeout_seconds > 0 else None
+        events = queue.Queue()
+        attempts = []
+        attempt = self._start_attempt(model, request, events, deadline)
+        if attempt is None:
+            return None
+        attempts.append(attempt)
+        # Срок тишины отсчитывается от начала попытки и сдвигается с каждым фрагментом
+        last_activity = time.perf_counter()
+        hedge_delay = self.hedge_delay()
+        hedge_at = started + hedge_delay if hedge_delay is not None else None
+        winner = None
+        chunks = []
+        try:
+            while True:
+                if request.cancelled:
+                    return None
+                now = time.perf_counter()
+                if deadline is not None and now >= deadline:
+                    raise TimeoutError(f"No response from the model within {self.total_timeout_seconds:g} s.")
+                idle_deadline = last_activity + self.timeout_seconds if self.timeout_seconds > 0 else None
+                if idle_deadline is not None and now >= idle_deadline:
+                    raise TimeoutError(f"The model sent nothing for {self.timeout_seconds:g} s.")
+                if hedge_at is not None and now >= hedge_at:
+                    hedge_at = None
+                    if winner is None and len(attempts) == 1:
+                        hedge = self._start_attempt(model, request, events, deadline, wait=False)
+                        if hedge is not None:
+                            request.trace.hedged = True
+                            attempts.append(hedge)
+                # Короткое ожидание, чтобы вовремя заметить отмену, срок и момент для дубля
+                wait = 0.1
+                for moment in (deadline, idle_deadline, hedge_at):
+                    if moment is not None:
+                        wait = min(wait, moment - now)
+                try:
+                    kind, attempt, payload = events.get(timeout=max(0.0, wait))
+                except queue.Empty:
+                    continue
+                if attempt.cancelled or attempt not in attempts:
+                    continue
+
+                if kind == "error":
+                    attempts.remove(attempt)
+                    if attempt is winner:
+                        # Часть ответа уже показана — повтор задвоил бы текст
+                        raise payload
+                    if attempts:
+                        # Ещё работает вторая попытка
+                        continue
+                    if not is_retryable_error(payload) or request.trace.retries >= self.max_retries:
+                        raise payload
+                    delay = self.retry_delay(request.trace.retries)
+                    if deadline is not None and time.perf_counter() + delay >= deadline:
+                        raise payload
+                    if request.cancel_event.wait(delay):
+                        return None
+                    request.trace.retries += 1
+                    attempt = self._start_attempt(model, request, events, deadline)
+                    if attempt is None:
+                        return None
+                    attempts.append(attempt)
+                    last_activity = time.perf_counter()
+                    if hedge_delay is not None:
+                        hedge_at = time.perf_counter() + hedge_delay
+                    continue
+
+                last_activity = time.perf_counter()
+                if winner is None:
+                    winner = attempt
+                    for other in attempts:
+                        if other is not winner:
+                            other.cancel_event.set()
+                    attempts = [winner]
+                    self._record_ttft(time.perf_counter() - winner.started)
+                    request.trace.add("ttft", started)
+                    self.first_token_received.emit(request.request_id, time.perf_counter() - request.created_at)
+                if kind == "chunk":
+                    chunks.append(payload)
+                    self.chunk_received.emit(request.request_id, payload)
+                    continue
+                return payload if payload is not None else "".join(chunks)
+        finally:
+            for attempt in attempts:
+                attempt.cancel_event.set()
+            request.trace.add("model", started)
+
+
+def configure_request_resilience(executor, settings):
+    """Срок, повторы и дублирование запросов из settings.json — общие для окна и пакетного режима."""
+    executor.timeout_seconds = settings.get('request_timeout_seconds', 120)
+    executor.total_timeout_seconds = settings.get('request_total_timeout_seconds', 600)
+    executor.max_retries = settings.get('max_retries', 2)
+    executor.retry_backoff = settings.get('retry_backoff_seconds', 0.5)
+    executor.hedge_requests = settings.get('hedge_requests', False)
+    executor.hedge_min_delay = settings.get('hedge_min_delay_seconds', 1.0)
+
+
+class ModelBackend:
+    """Интерфейс модели для RequestExecutor — тот же generate_content, что у genai.GenerativeModel,
+    поэтому модель Gemini подходит под него без обёртки и без наследования.
+
+    Без stream возвращается объект с resolve() и text, со stream=True — итератор фрагментов с полем text.
+    request_options={"timeout": секунды} — срок HTTP-вызова, после которого брошенная попытка завершается.
+    Ошибки передаются исключениями.
+    """
+
+    def generate_content(self, contents, stream=False, request_options=None):
+        raise NotImplementedError
+
+
+class SimulatedResponse:
+    def __init__(self, text):
+        self.text = text
+
+    def resolve(self):
+        pass
+
+
+class SimulatedBackendError(Exception):
+    code = 503
+
+
+class SimulatedBackend(ModelBackend):
+    """Локальная имитация модели для проверок и замеров без API-ключа (--stub-model).
+
+    latency — задержка до первого фрагмента (± jitter в долях), tokens_per_second — скорость генерации,
+    chunk_tokens — токенов во фрагменте потока, error_rate — доля запросов, завершающихся ошибкой 503,
+    reply_tokens — длина ответа; если не задана, модель отвечает эхом последнего текста запроса.
+    tail_rate — доля вызовов, у которых первый фрагмент задерживается до tail_latency (медленный хвост
+    для проверки дублирования). Срок request_options["timeout"] соблюдается так же, как в SDK.
+    """
+
+    def __init__(self, latency=0.05, tokens_per_second=200.0, chunk_tokens=8, error_rate=0.0, reply_tokens=None,
+                 jitter=0.0, seed=None, tail_rate=0.0, tail_latency=0.5):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.chunk_tokens = max(1, chunk_tokens)
+        self.error_rate = error_rate
+        self.reply_tokens = reply_tokens
+        self.jitter = jitter
+        self.tail_rate = tail_rate
+        self.tail_latency = tail_latency
+        self._random = random.Random(seed)
+
+    def _reply_tokens(self, contents):
+        if self.reply_tokens is not None:
+            return [f"token{index}" for index in range(self.reply_tokens)]
+        prompts = [part for part in contents if isinstance(part, str)]
+        if not prompts:
+            prompts = [part for item in contents if isinstance(item, dict)
+                       for part in item.get("parts", []) if isinstance(part, str)]
+        return ("Echo: " + (prompts[-1] if prompts else "")).split(" ")
+
+    def generate_content(self, contents, stream=False, request_options=None):
+        delay = max(0.0, self.latency * (1 + self.jitter * (2 * self._random.random() - 1)))
+        if self._random.random() < self.tail_rate:
+            delay = max(delay, self.tail_latency)
+        timeout = (request_options or {}).get("timeout")
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            raise TimeoutError(f"Simulated call exceeded {timeout:g} s.")
+        time.sleep(delay)
+        if self._random.random() < self.error_rate:
+            raise SimulatedBackendError("503 Service Unavailable (simulated)")
+        tokens = self._reply_tokens(contents)
+        if not stream:
+            time.sleep(len(tokens) / self.tokens_per_second)
+            return SimulatedResponse(" ".join(tokens))
+        return self._stream(tokens)
+
+    def _stream(self, tokens):
+        for start in range(0, len(tokens), self.chunk_tokens):
+            part = tokens[start:start + self.chunk_tokens]
+            time.sleep(len(part) / self.tokens_per_second)
+            last = start + self.chunk_tokens >= len(tokens)
+            yield SimulatedResponse(" ".join(part) + ("" if last else " "))
+
+
+class EndpointReply:
+    """Получатель ответа на запрос, пришедший через LocalEndpoint: пересылает события клиенту."""
+
+    def __init__(self, socket, message_id=None):
+        self.socket = socket
+        self.message_id = message_id
+
+    def send(self, **message):
+        if self.message_id is not None:
+            message["id"] = self.message_id
+        try:
+            if self.socket.state() == QLocalSocket.ConnectedState:
+                self.socket.write((json.dumps(message, ensure_ascii=False) + "\n").encode("utf-8"))
+                self.socket.flush()
+        except RuntimeError:
+            # Клиент отключился, и сокет уже удалён
+            pass
+
+    def chunk(self, text):
+        self.send(event="chunk", text=text)
+
+    def finish(self, text, cached=False):
+        self.send(event="done", text=text, cached=cached)
+
+    def fail(self, error):
+        self.send(event="error", error=error)
+
+
+class LocalEndpoint(QObject):
+    """Локальная точка входа в запущенный Win-AI (QLocalServer, доступ только текущему пользователю).
+
+    Протокол — по одному JSON-объекту в строке. Клиент отправляет
+    {"prompt": "...", "file": "путь", "image_base64": "...", "id": ...}; в ответ приходят
+    {"event": "chunk", "text": ...}, затем {"event": "done", "text": ..., "cached": ...}
+    или {"event": "error", "error": ...}.
+    """
+    # (EndpointReply, сообщение клиента)
+    request_received = pyqtSignal(object, dict)
+
+    def __init__(self, name=None, parent=None):
+        super().__init__(parent)
+        self.name = name or LOCAL_SERVER_NAME
+        self.server = QLocalServer(self)
+        self.server.setSocketOptions(QLocalServer.UserAccessOption)
+        self.server.newConnection.connect(self._on_new_connection)
+
+    def listen(self):
+        if self.server.listen(self.name):
+            return True
+        probe = QLocalSocket()
+        probe.connectToServer(self.name)
+        if probe.waitForConnected(200):
+            # Имя занято работающим экземпляром (например, при замере запуска) — не отбираем его
+            probe.disconnectFromServer()
+            return False
+        # Файл сокета мог остаться после аварийного завершения (на Windows это не нужно)
+        QLocalServer.removeServer(self.name)
+        return self.server.listen(self.name)
+
+    def close(self):
+        self.server.close()
+
+    def _on_new_connection(self):
+        while self.server.hasPendingConnections():
+            socket = self.server.nextPendingConnection()
+            socket.readyRead.connect(lambda socket=socket: self._on_ready_read(socket))
+            socket.disconnected.connect(socket.deleteLater)
+
+    def _on_ready_read(self, socket):
+        while socket.canReadLine():
+            line = bytes(socket.readLine()).decode("utf-8", errors="replace").strip()
+            if not line:
+                continue
+            try:
+                message = json.loads(line)
+                if not isinstance(message, dict):
+                    raise ValueError("ожидается JSON-объект")
+            except ValueError as e:
+                EndpointReply(socket).fail(f"Некорректный запрос: {e}")
+                continue
+            self.request_received.emit(EndpointReply(socket, message.get("id")), message)
+
+
+class PendingReply:
+    """Сообщение в ленте, куда выводится ответ на конкретный запрос."""
+
+    def __init__(self, msg_id, listener=None):
+        # Сначала это "Думаю...", затем в том же сообщении появляется ответ
+        self.msg_id = msg_id
+        # Внешний получатель ответа (например, EndpointReply); получает фрагменты и итог
+        self.listener = listener
+        self.streaming = False
+        self.text = ""
+        self.buffer = []
+        # Замеры на стороне окна: момент отправки, сборка запроса и отрисовка ответа, мс
+        self.started = time.perf_counter()
+        self.build_ms = 0.0
+        self.render_ms = 0.0
+        self.finished = None
+
+    def partial_text(self):
+        return self.text + "".join(self.buffer)
+
+
+def exclude_from_capture(widget):
+    """Скрывает окно приложения со снимков экрана (Windows 10 2004+), чтобы панель не попадала в скриншоты."""
+    if sys.platform != "win32":
+        return
+    import ctypes
+    WDA_EXCLUDEFROMCAPTURE = 0x11
+    ctypes.windll.user32.SetWindowDisplayAffinity(int(widget.winId()), WDA_EXCLUDEFROMCAPTURE)
+
+
+def active_window_rect():
+    """Прямоугольник активного окна другого приложения в логических координатах Qt или None.
+
+    Если активно окно самого Win-AI (например, нажата кнопка на панели), берётся следующее
+    под ним видимое окно. Поддерживается только Windows.
+    """
+    if sys.platform != "win32":
+        return None
+    import ctypes
+    from ctypes import wintypes
+    user32 = ctypes.windll.user32
+    GW_HWNDNEXT = 2
+    GWL_EXSTYLE = -20
+    WS_EX_TOPMOST = 0x8
+    WS_EX_TOOLWINDOW = 0x80
+    DWMWA_EXTENDED_FRAME_BOUNDS = 9
+
+    def is_own(hwnd):
+        pid = wintypes.DWORD()
+        user32.GetWindowThreadProcessId(hwnd, ctypes.byref(pid))
+        return pid.value == os.getpid()
+
+    hwnd = user32.GetForegroundWindow()
+    while hwnd and is_own(hwnd):
+        hwnd = user32.GetWindow(hwnd, GW_HWNDNEXT)
+        while hwnd and (not user32.IsWindowVisible(hwnd) or user32.IsIconic(hwnd)
+                        or user32.GetWindowLongW(hwnd, GWL_EXSTYLE) & (WS_EX_TOPMOST | WS_EX_TOOLWINDOW)):
+            hwnd = user32.GetWindow(hwnd, GW_HWNDNEXT)
+    if not hwnd:
+        return None
+
+    rect = wintypes.RECT()
+    # Границы без невидимой рамки-тени Windows 10
+    if ctypes.windll.dwmapi.DwmGetWindowAttribute(hwnd, DWMWA_EXTENDED_FRAME_BOUNDS, ctypes.byref(rect),
+                                                  ctypes.sizeof(rect)) != 0:
+        user32.GetWindowRect(hwnd, ctypes.byref(rect))
+    # WinAPI возвращает физические пиксели, Qt при AA_EnableHighDpiScaling работает в логических
+    ratio = QApplication.primaryScreen().devicePixelRatio()
+    return QRect(int(rect.left / ratio), int(rect.top / ratio),
+                 int((rect.right - rect.left) / ratio), int((rect.bottom - rect.top) / ratio))
+
+
+class ScreenCapture(QObject):
+    """Снимки экрана для отправки в модель.
+
+    Сам захват (QScreen.grabWindow) выполняется в потоке интерфейса: QPixmap нельзя создавать
+    в других потоках. Обрезка, уменьшение и кодирование выполняются в отдельном фоновом потоке.
+    """
+    # (capture_id, закодированный кадр, MIME-тип, {этап: время})
+    frame_ready = pyqtSignal(int, bytes, str, object)
+    failed = pyqtSignal(int, str)
+
+    def __init__(self, preprocessor, parent=None):
+        super().__init__(parent)
+        # Размер и качество кадра берутся из настроек ImagePreprocessor
+        self.preprocessor = preprocessor
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="capture")
+        self._next_id = 1
+
+    def grab_screen(self, rect=None):
+        """Снимает экран (или прямоугольник rect в глобальных координатах). Возвращает (экран, QPixmap)."""
+        point = rect.center() if rect is not None else QCursor.pos()
+        screen = QApplication.screenAt(point) or QApplication.primaryScreen()
+        geometry = screen.geometry()
+        rect = geometry if rect is None else rect.intersected(geometry)
+        # Для grabWindow(0, ...) координаты задаются относительно экрана
+        pixmap = screen.grabWindow(0, rect.x() - geometry.x(), rect.y() - geometry.y(), rect.width(), rect.height())
+        return screen, pixmap
+
+    def capture(self, rect=None, started=None):
+        """Снимает экран и ставит кадр на кодирование. Возвращает capture_id."""
+        started = started or time.perf_counter()
+        _, pixmap = self.grab_screen(rect)
+        return self.encode(pixmap.toImage(), started=started)
+
+    def encode(self, image, crop=None, started=None):
+        """Кодирует уже снятый кадр в фоне; crop — область в логических координатах кадра."""
+        capture_id = self._next_id
+        self._next_id += 1
+        self._executor.submit(self._encode, capture_id, image, crop, started or time.perf_counter(),
+                              time.perf_counter())
+        return capture_id
+
+    def _encode(self, capture_id, image, crop, started, grabbed):
+        try:
+            if crop is not None:
+                ratio = image.devicePixelRatio()
+                image = image.copy(QRect(int(crop.x() * ratio), int(crop.y() * ratio),
+                                         int(crop.width() * ratio), int(crop.height() * ratio)))
+            encoded = encode_image(image, self.preprocessor.max_side, self.preprocessor.image_format,
+                                   self.preprocessor.quality)
+            if encoded is None:
+                raise RuntimeError("Не удалось закодировать снимок экрана")
+            data, mime_type = encoded
+            timings = {"started": started, "grab_ms": (grabbed - started) * 1000,
+                       "encode_ms": (time.perf_counter() - grabbed) * 1000}
+            self.frame_ready.emit(capture_id, data, mime_type, timings)
+        except Exception as e:
+            self.failed.emit(capture_id, str(e))
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+def perceptual_hash(image, size=32):
+    """Разностный хэш (dHash) кадра: size * size битов, по одному на пару соседних пикселей уменьшенного кадра."""
+    small = image.scaled(size + 1, size, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+    small = small.convertToFormat(QImage.Format_Grayscale8)
+    stride = small.bytesPerLine()
+    data = small.constBits().asstring(stride * size)
+    if np:
+        pixels = np.frombuffer(data, dtype=np.uint8).reshape(size, stride)[:, :size + 1]
+        bits = pixels[:, 1:] > pixels[:, :-1]
+        return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+    value = 0
+    for row in range(size):
+        line = data[row * stride:row * stride + size + 1]
+        for x in range(size):
+            value = (value << 1) | (line[x + 1] > line[x])
+    return value
+
+
+class ScreenWatcher(QObject):
+    """Режим наблюдения: периодически снимает экран и выдаёт только заметно изменившиеся кадры.
+
+    Хэш и кодирование выполняются в одном фоновом потоке. Пока предыдущий кадр обрабатывается
+    или отправленный кадр ждёт ответа (paused), новые снимки не делаются, поэтому в памяти
+    не больше одного кадра, а неизменный экран не приводит к запросам к модели.
+    """
+    HASH_SIZE = 32
+    # (кадр, MIME-тип, отличие от последнего отправленного кадра в долях)
+    frame_changed = pyqtSignal(bytes, str, float)
+    failed = pyqtSignal(str)
+
+    def __init__(self, capture, interval_ms=2000, threshold=0.03, parent=None):
+        super().__init__(parent)
+        self.capture = capture
+        self.interval_ms = interval_ms
+        # Доля отличающихся битов хэша, начиная с которой кадр считается изменившимся
+        self.threshold = threshold
+        self.paused = False
+        self.frames_sampled = 0
+        self.frames_sent = 0
+        self._rect = None
+        self._last_hash = None
+        self._busy = False
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="watch")
+        self._timer = QTimer(self)
+        self._timer.timeout.connect(self._sample)
+
+    def is_active(self):
+        return self._timer.isActive()
+
+    def start(self):
+        screen = QApplication.screenAt(QCursor.pos()) or QApplication.primaryScreen()
+        # Снимаем один и тот же экран, даже если курсор переходит на другой монитор
+        self._rect = screen.geometry()
+        self._last_hash = None
+        self.paused = False
+        self.frames_sampled = 0
+        self.frames_sent = 0
+        self._timer.start(self.interval_ms)
+        self._sample()
+
+    def stop(self):
+        self._timer.stop()
+
+    def _sample(self):
+        if self._busy or self.paused:
+            return
+        self._busy = True
+        try:
+            _, pixmap = self.capture.grab_screen(self._rect)
+            self._executor.submit(self._process, pixmap.toImage())
+        except Exception as e:
+            self._busy = False
+            self.failed.emit(str(e))
+
+    def _process(self, image):
+        try:
+            self.frames_sampled += 1
+            frame_hash = perceptual_hash(image, self.HASH_SIZE)
+            difference = 1.0
+            if self._last_hash is not None:
+                difference = bin(frame_hash ^ self._last_hash).count("1") / (self.HASH_SIZE * self.HASH_SIZE)
+                if difference < self.threshold:
+                    return
+            preprocessor = self.capture.preprocessor
+            encoded = encode_image(image, preprocessor.max_side, preprocessor.image_format, preprocessor.quality)
+            if encoded is None:
+                raise RuntimeError("Не удалось закодировать кадр")
+            self._last_hash = frame_hash
+            self.frames_sent += 1
+            # Кадр ждёт ответа модели; следующие снимки начнутся после resume()
+            self.paused = True
+            self.frame_changed.emit(encoded[0], encoded[1], difference)
+        except Exception as e:
+            self.failed.emit(str(e))
+        finally:
+            self._busy = False
+
+    def resume(self):
+        self.paused = False
+
+    def shutdown(self):
+        self._timer.stop()
+        self._executor.shutdown(wait=False)
+
+
+class RegionSelector(QWidget):
+    """Выбор области на застывшем снимке экрана: снимок делается до показа окна, поэтому оно в него не попадает."""
+    # Область в логических координатах экрана
+    selected = pyqtSignal(QRect)
+    cancelled = pyqtSignal()
+
+    def __init__(self, screen, pixmap):
+        super().__init__(None)
+        self.setWindowFlags(Qt.FramelessWindowHint | Qt.WindowStaysOnTopHint | Qt.Tool)
+        self.setAttribute(Qt.WA_DeleteOnClose)
+        self.setGeometry(screen.geometry())
+        self.setCursor(Qt.CrossCursor)
+        self.pixmap = pixmap
+        self._origin = None
+        self._selection = QRect()
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.drawPixmap(self.rect(), self.pixmap)
+        painter.fillRect(self.rect(), QColor(0, 0, 0, 110))
+        if not self._selection.isNull():
+            ratio = self.pixmap.devicePixelRatio()
+            source = QRect(int(self._selection.x() * ratio), int(self._selection.y() * ratio),
+                           int(self._selection.width() * ratio), int(self._selection.height() * ratio))
+            painter.drawPixmap(self._selection, self.pixmap, source)
+            painter.setPen(QPen(QColor("#8A2BE2"), 2))
+            painter.drawRect(self._selection)
+
+    def mousePressEvent(self, event):
+        if event.button() == Qt.LeftButton:
+            self._origin = event.pos()
+            self._selection = QRect(self._origin, self._origin)
+
+    def mouseMoveEvent(self, event):
+        if self._origin is not None:
+            self._selection = QRect(self._origin, event.pos()).normalized()
+            self.update()
+
+    def mouseReleaseEvent(self, event):
+        if event.button() != Qt.LeftButton or self._origin is None:
+            return
+        selection = QRect(self._origin, event.pos()).normalized()
+        self.close()
+        if selection.width() > 4 and selection.height() > 4:
+            self.selected.emit(selection)
+        else:
+            self.cancelled.emit()
+
+    def keyPressEvent(self, event):
+        if event.key() == Qt.Key_Escape:
+            self.close()
+            self.cancelled.emit()
+
+
 class TogglePanel(QWidget):
     show_main_panel_signal = pyqtSignal()
 
@@ -290,15 +2665,72 @@ class OverlayPanel(QWidget):
     BORDER_WIDTH = 8
     MIN_WIDTH = 500
     MIN_HEIGHT = 350
+    HISTORY_PAGE_SIZE = 200
+    # (API-ключ, модель) — результат фоновой инициализации; ключ позволяет отбросить устаревший результат
+    model_ready = pyqtSignal(str, object)
+    model_failed = pyqtSignal(str, str)
 
     def __init__(self, toggle_panel, parent=None):
         super().__init__(parent)
         self.setObjectName("OverlayPanel")
         self.toggle_panel = toggle_panel
         self.settings_file = "settings.json"
+        self.settings_writer = SettingsWriter(self.settings_file, parent=self)
+        self.chat_journal = ChatJournal(os.path.join(os.path.dirname(self.settings_file), "chat_history.jsonl"))
+        self.conversation = ConversationContext(os.path.join(os.path.dirname(self.settings_file), "chat_summary.json"))
+        self._summary_request_id = None
+        self._summary_upto_ts = None
+
+        self.response_cache = ResponseCache(os.path.join(os.path.dirname(self.settings_file), "response_cache"))
+        self._last_prompt = None
+        self.file_uploader = FileUploader(os.path.join(os.path.dirname(self.settings_file), "uploads.json"))
+        self.request_executor = RequestExecutor(response_cache=self.response_cache, file_uploader=self.file_uploader,
+                                                parent=self)
+        self.request_executor.upload_progress.connect(self.handle_upload_progress)
+        self.image_preprocessor = ImagePreprocessor(os.path.join(os.path.dirname(self.settings_file), "image_cache"))
+        self.request_executor.image_preprocessor = self.image_preprocessor
+        self.request_executor.image_preprocessed.connect(self.handle_image_preprocessed)
+        self.screen_capture = ScreenCapture(self.image_preprocessor, parent=self)
+        self.screen_capture.frame_ready.connect(self.handle_screenshot)
+        self.screen_capture.failed.connect(self.handle_screenshot_error)
+        # Снимки, которые ещё кодируются: capture_id -> текст запроса
+        self._captures = {}
+        self._region_selector = None
+        self.capture_timings = []
+        self.screen_watcher = ScreenWatcher(self.screen_capture, parent=self)
+        self.screen_watcher.frame_changed.connect(self.handle_watch_frame)
+        self.screen_watcher.failed.connect(self.handle_watch_error)
+        self._watch_question = None
+        self._watch_request_id = None
+        # Задачи поблочного анализа файлов: ChunkedAnalysisJob -> id сообщения с прогрессом
+        self._analysis_jobs = {}
+        self.request_executor.chunk_received.connect(self.handle_gemini_chunk)
+        self.request_executor.first_token_received.connect(self.handle_first_token)
+        self.request_executor.response_received.connect(self.handle_gemini_response)
+        self.request_executor.error_occurred.connect(self.handle_gemini_error)
+        self.request_executor.request_traced.connect(self.handle_request_traced)
+        self.trace_log = TraceLog(os.path.join(os.path.dirname(self.settings_file), "request_traces.jsonl"))
+        # Замеры окна для завершённых ответов, ждущие сигнала request_traced: request_id -> PendingReply
+        self._traced_replies = {}
+        self.recent_traces = []
 
         self.chat_history = []
+        self._history_offset = 0
         self.selected_microphone_index = None
+        self.microphones = MicrophoneManager(self)
+        self.microphones.devices_ready.connect(self.handle_devices_ready)
+        self.microphones.calibrated.connect(self.handle_microphone_calibrated)
+        self.microphones.calibration_failed.connect(self.handle_calibration_failed)
+        self._selected_microphone_name = None
+        self._legacy_microphone_index = None
+        self.stream_responses = True
+        # Движок распознавания речи по языкам и модели офлайн-движков: {движок: {язык: путь или имя}}
+        self.speech_backends = {"ru-RU": "google", "en-US": "google"}
+        self.speech_models = {}
+        self.voice_direct = False
+        self.chunked_analysis_threshold = 512 * 1024
+        self.chunked_analysis_chars = 60000
+        self.chunked_analysis_parallel = 3
 
         self.setMouseTracking(True)
         self.resizing = False
@@ -307,29 +2739,70 @@ class OverlayPanel(QWidget):
         self.old_pos_global = None
         self.current_language = "ru"
 
+        # Ответы на запросы, которые ещё выполняются: request_id -> PendingReply
+        self._replies = {}
+        self.ttft_history = []
+
+        self.model_ready.connect(self.handle_model_ready)
+        self.model_failed.connect(self.handle_model_failed)
+        self.local_endpoint = LocalEndpoint(parent=self)
+        self._launch_request = None
+        self.local_endpoint.request_received.connect(self.handle_endpoint_request)
+        self.instance_endpoint = LocalEndpoint(INSTANCE_SERVER_NAME, parent=self)
+        self.instance_endpoint.request_received.connect(self.handle_instance_message)
+
         self._setup_ui()
+        exclude_from_capture(self)
+        exclude_from_capture(self.toggle_panel)
 
         self.load_settings()
-        self.initialize_gemini()
-        self.populate_devices()
+        if self.settings.get('local_endpoint', True) and not self.local_endpoint.listen():
+            print(f"Не удалось открыть локальную точку входа {self.local_endpoint.name}")
+        if not self.instance_endpoint.listen():
+            print(f"Не удалось открыть точку входа для повторного запуска {self.instance_endpoint.name}")
 
         self.autoscroll_chat()
         self.show()
         self.toggle_panel.hide()
+        # Проверка модели и поиск микрофонов не задерживают первое появление окна
+        QTimer.singleShot(0, self.initialize_gemini)
+        QTimer.singleShot(0, self.populate_devices)
 
     def update_ui_language(self):
         if self.current_language == "ru":
             self.send_button.setText("Отправить")
+            self.stop_button.setText("Стоп")
+            self.refresh_button.setText("Обновить")
+            self.refresh_button.setToolTip("Повторить последний запрос без кэша")
             self.open_file_button.setText("Файл")
             self.toggle_audio_button.setText("Аудио")
+            self.screenshot_button.setText("Скрин")
+            self.screenshot_screen_action.setText("Весь экран\tCtrl+Shift+S")
+            self.screenshot_window_action.setText("Активное окно\tCtrl+Shift+W")
+            self.screenshot_region_action.setText("Область\tCtrl+Shift+A")
+            self.screenshot_watch_action.setText("Наблюдение за экраном")
             self.clear_chat_button.setText("Очистить чат")
+            self.diagnostics_button.setText("Замеры")
+            self.diagnostics_button.setToolTip("Время этапов последних запросов (Ctrl+Shift+D)")
             self.chat_input.setPlaceholderText("Введите сообщение...")
+            self.chat_display.copy_text = "Копировать"
         else:
             self.send_button.setText("Send")
+            self.stop_button.setText("Stop")
+            self.refresh_button.setText("Refresh")
+            self.refresh_button.setToolTip("Repeat the last request bypassing the cache")
             self.open_file_button.setText("File")
             self.toggle_audio_button.setText("Audio")
+            self.screenshot_button.setText("Screen")
+            self.screenshot_screen_action.setText("Full screen\tCtrl+Shift+S")
+            self.screenshot_window_action.setText("Active window\tCtrl+Shift+W")
+            self.screenshot_region_action.setText("Region\tCtrl+Shift+A")
+            self.screenshot_watch_action.setText("Watch the screen")
             self.clear_chat_button.setText("Clear chat")
+            self.diagnostics_button.setText("Timings")
+            self.diagnostics_button.setToolTip("Stage timings of recent requests (Ctrl+Shift+D)")
             self.chat_input.setPlaceholderText("Input message...")
+            self.chat_display.copy_text = "Copy"
 
     def t(self, key, **kwargs):
         text = UI_TEXTS[self.current_language].get(key, key)
@@ -341,9 +2814,9 @@ class OverlayPanel(QWidget):
         self.save_settings()
         self.update_ui_language()
         if self.current_language == "ru":
-            self.chat_display.append("<p style='color:#8A2BE2;'>Win-AI: Язык переключен на русский.</p>")
+            self.chat_model.append_message("<p style='color:#8A2BE2;'>Win-AI: Язык переключен на русский.</p>")
         else:
-            self.chat_display.append("<p style='color:#8A2BE2;'>Win-AI: Language switched to English.</p>")
+            self.chat_model.append_message("<p style='color:#8A2BE2;'>Win-AI: Language switched to English.</p>")
 
     def _setup_ui(self):
         self.setWindowFlags(Qt.FramelessWindowHint | Qt.WindowStaysOnTopHint | Qt.Tool)
@@ -382,6 +2855,11 @@ class OverlayPanel(QWidget):
 
         self.control_layout.addStretch()
 
+        self.diagnostics_button = QPushButton("Замеры")
+        self.diagnostics_button.setCheckable(True)
+        self.diagnostics_button.toggled.connect(self.toggle_diagnostics)
+        self.control_layout.addWidget(self.diagnostics_button)
+
         self.clear_chat_button = QPushButton("Очистить чат")
         self.clear_chat_button.clicked.connect(self.clear_chat)
         self.control_layout.addWidget(self.clear_chat_button)
@@ -400,12 +2878,21 @@ class OverlayPanel(QWidget):
 
         self.content_layout.addWidget(self.control_panel)
 
-        self.chat_display = QTextEdit()
+        self.chat_model = ChatListModel(self)
+        self.chat_display = ChatView()
         self.chat_display.setObjectName("chatDisplay")
-        self.chat_display.setReadOnly(True)
-        self.chat_display.setLineWrapMode(QTextEdit.WidgetWidth)
+        self.chat_display.setModel(self.chat_model)
+        self.chat_display.reached_top.connect(self.load_older_history)
         self.content_layout.addWidget(self.chat_display, 1)
 
+        self.diagnostics_view = QPlainTextEdit()
+        self.diagnostics_view.setObjectName("diagnosticsView")
+        self.diagnostics_view.setReadOnly(True)
+        self.diagnostics_view.setLineWrapMode(QPlainTextEdit.NoWrap)
+        self.diagnostics_view.setFixedHeight(150)
+        self.diagnostics_view.hide()
+        self.content_layout.addWidget(self.diagnostics_view)
+
         self.input_main_layout = QHBoxLayout()
         self.input_main_layout.setContentsMargins(0, 0, 0, 0)
 
@@ -425,6 +2912,21 @@ class OverlayPanel(QWidget):
         self.send_button.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
         self.right_buttons_container.addWidget(self.send_button)
 
+        self.stop_button = QPushButton("Стоп")
+        self.stop_button.setObjectName("stopButton")
+        self.stop_button.clicked.connect(self.stop_generation)
+        self.stop_button.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
+        self.stop_button.setEnabled(False)
+        self.right_buttons_container.addWidget(self.stop_button)
+
+        self.refresh_button = QPushButton("Обновить")
+        self.refresh_button.setObjectName("refreshButton")
+        self.refresh_button.setToolTip("Повторить последний запрос без кэша")
+        self.refresh_button.clicked.connect(self.refresh_last_message)
+        self.refresh_button.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
+        self.refresh_button.setEnabled(False)
+        self.right_buttons_container.addWidget(self.refresh_button)
+
         self.open_file_button = QPushButton("Файл") #
         self.open_file_button.clicked.connect(self.select_file_for_analysis)
         self.open_file_button.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
@@ -433,18 +2935,52 @@ class OverlayPanel(QWidget):
         self.toggle_audio_button = QPushButton("Аудио")
         self.toggle_audio_button.setObjectName("toggleAudioButton")
         self.toggle_audio_button.clicked.connect(self.toggle_audio_recording)
+        self.toggle_audio_button.setContextMenuPolicy(Qt.CustomContextMenu)
+        self.toggle_audio_button.customContextMenuRequested.connect(self.show_audio_menu)
         self.toggle_audio_button.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
         self.right_buttons_container.addWidget(self.toggle_audio_button)
 
+        self.screenshot_button = QPushButton("Скрин")
+        self.screenshot_button.setObjectName("screenshotButton")
+        self.screenshot_menu = QMenu(self.screenshot_button)
+        self.screenshot_screen_action = self.screenshot_menu.addAction("Весь экран\tCtrl+Shift+S")
+        self.screenshot_screen_action.triggered.connect(lambda: self.capture_screenshot("screen"))
+        self.screenshot_window_action = self.screenshot_menu.addAction("Активное окно\tCtrl+Shift+W")
+        self.screenshot_window_action.triggered.connect(lambda: self.capture_screenshot("window"))
+        self.screenshot_region_action = self.screenshot_menu.addAction("Область\tCtrl+Shift+A")
+        self.screenshot_region_action.triggered.connect(lambda: self.capture_screenshot("region"))
+        self.screenshot_menu.addSeparator()
+        self.screenshot_watch_action = self.screenshot_menu.addAction("Наблюдение за экраном")
+        self.screenshot_watch_action.setCheckable(True)
+        self.screenshot_watch_action.toggled.connect(self.toggle_screen_watch)
+        self.screenshot_button.setMenu(self.screenshot_menu)
+        self.screenshot_button.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
+        self.right_buttons_container.addWidget(self.screenshot_button)
+
+        # Горячие клавиши работают, пока активно любое окно приложения
+        for sequence, mode in (("Ctrl+Shift+S", "screen"), ("Ctrl+Shift+W", "window"), ("Ctrl+Shift+A", "region")):
+            shortcut = QShortcut(QKeySequence(sequence), self)
+            shortcut.setContext(Qt.ApplicationShortcut)
+            shortcut.activated.connect(lambda mode=mode: self.capture_screenshot(mode))
+        diagnostics_shortcut = QShortcut(QKeySequence("Ctrl+Shift+D"), self)
+        diagnostics_shortcut.activated.connect(self.diagnostics_button.toggle)
+
         self.right_buttons_container.addStretch(1)
 
         self.input_main_layout.addLayout(self.right_buttons_container)
         self.content_layout.addLayout(self.input_main_layout)
 
         self.gemini_model = None
+        # Ключ, для которого модель готова или ещё инициализируется
+        self._gemini_key = None
         self.audio_thread = None
         self.recording_in_progress = False
 
+        # Не чаще одной вставки в документ за кадр, чтобы быстрый поток не забивал цикл событий Qt
+        self._stream_flush_timer = QTimer(self)
+        self._stream_flush_timer.setInterval(16)
+        self._stream_flush_timer.timeout.connect(self._flush_stream_buffers)
+
         self.apply_styles()
         self.chat_input.installEventFilter(self)
 
@@ -685,6 +3221,8 @@ class OverlayPanel(QWidget):
             /* Стили для кнопок справа, чтобы они были одного размера с "Отправить" */
             QPushButton[text="Отправить"],
             QPushButton[text="Файл"],
+            QPushButton#stopButton,
+            QPushButton#refreshButton,
             QPushButton#toggleAudioButton {{
                 min-width: 100px; /* Фиксированная минимальная ширина */
                 max-width: 150px; /* Ограничиваем максимальную ширину */
@@ -763,7 +3301,7 @@ class OverlayPanel(QWidget):
                 background: none;
             }}
 
-            QTextEdit#chatDisplay {{
+            ChatView#chatDisplay {{
                 background-color: rgba(45, 45, 45, 0.9);
                 color: #e0e0e0;
                 border: 1px solid rgba(70, 70, 70, 0.7);
@@ -783,6 +3321,16 @@ class OverlayPanel(QWidget):
                 font-size: 18px;
                 font-weight: 500;
             }}
+            QPlainTextEdit#diagnosticsView {{
+                background-color: rgba(35, 35, 35, 0.9);
+                color: #b0b0b0;
+                border: 1px solid rgba(70, 70, 70, 0.7);
+                border-radius: 10px;
+                padding: 6px;
+                font-family: 'Consolas', monospace;
+                font-size: 12px;
+            }}
+
             QTextEdit#chatInput:focus {{
                 border: 1px solid #8A2BE2; /* Фиолетовая рамка при фокусе */
             }}
@@ -811,17 +3359,23 @@ class OverlayPanel(QWidget):
         """)
 
     def clear_chat(self):
-        self.chat_display.clear()
+        self.chat_model.clear()
         self.chat_history = []
-        self.chat_display.append(f"<p style='color:#8A2BE2;'>{self.t('ai')}: {self.t('chat_cleared')}</p>")
-        self.save_settings() #
+        self._history_offset = 0
+        self.chat_journal.clear()
+        self.conversation.clear()
+        if self._summary_request_id is not None:
+            self.request_executor.cancel(self._summary_request_id)
+            self._summary_request_id = None
+        self.chat_model.append_message(f"<p style='color:#8A2BE2;'>{self.t('ai')}: {self.t('chat_cleared')}</p>")
+
+    def record_message(self, role, text, html_text):
+        record = make_chat_record(role, text, html_text)
+        self.chat_history.append(record)
+        self.chat_journal.append(record)
 
     def load_settings(self):
-        if os.path.exists(self.settings_file):
-            with open(self.settings_file, 'r') as f:
-                self.settings = json.load(f)
-        else:
-            self.settings = {}
+        self.settings = self.settings_writer.load()
 
         self.current_language = self.settings.get('language', 'ru')
 
@@ -837,35 +3391,78 @@ class OverlayPanel(QWidget):
         global GEMINI_API_KEY
         if 'api_key' in self.settings and self.settings['api_key'] and self.settings['api_key'] != "YOUR_GOOGLE_GEMINI_API_KEY":
             GEMINI_API_KEY = self.settings['api_key']
-        else:
+        elif MODEL_OVERRIDE is None:
             self.prompt_for_api_key()
 
+        self.chat_display.setFont(QFont('Segoe UI', 18, QFont.Medium))
+        # Переносы сохраняются одним вызовом в конце, когда все поля уже прочитаны: save_settings
+        # записывает текущие значения полей и до этого затёр бы настройки пользователя значениями по умолчанию
+        settings_migrated = False
         if 'chat_history' in self.settings:
-            try:
-                self.chat_display.setFont(QFont('Segoe UI', 18, QFont.Medium))
-                raw_history = self.settings['chat_history']
-                if raw_history.startswith('[') and raw_history.endswith(']'):
-                    parsed_history = ast.literal_eval(raw_history)
-                    for i, msg in enumerate(parsed_history):
-                        if "<p style='color:#ADD8E6;'>" in msg or "<p style='color:green;'>" in msg:
-                            parsed_history[i] = msg.replace("<p style='color:#ADD8E6;'>", "<p style='color:#8A2BE2;'>")
-                            parsed_history[i] = parsed_history[i].replace("<p style='color:green;'>", "<p style='color:#8A2BE2;'>")
-                    self.chat_history = parsed_history
-                else:
-                    if "<p style='color:#ADD8E6;'>" in raw_history or "<p style='color:green;'>" in raw_history:
-                        raw_history = raw_history.replace("<p style='color:#ADD8E6;'>", "<p style='color:#8A2BE2;'>")
-                        raw_history = raw_history.replace("<p style='color:green;'>", "<p style='color:#8A2BE2;'>")
-                    self.chat_history = [raw_history]
-
-                for message in self.chat_history:
-                    self.chat_display.append(message)
-            except (ValueError, SyntaxError) as e:
-                print(f"Ошибка при загрузке истории чата: {e}. История будет очищена.")
-                self.chat_history = []
-        else:
-            self.chat_display.setFont(QFont('Segoe UI', 18, QFont.Medium))
+            self.migrate_legacy_chat_history()
+            settings_migrated = True
+        if not self.settings.get('history_colors_migrated'):
+            self.chat_journal.rewrite(migrate_record_colors)
+            self.settings['history_colors_migrated'] = True
+            settings_migrated = True
+
+        # При запуске показываем только последнюю страницу, остальное — при прокрутке вверх
+        self.chat_history, self._history_offset = self.chat_journal.read_tail(self.HISTORY_PAGE_SIZE)
+        self.chat_model.append_messages([record.get("html", "") for record in self.chat_history])
+
+        # Индекс устройства определяется по имени, когда список микрофонов готов (handle_devices_ready);
+        # до этого запись идёт с микрофона по умолчанию
+        self.selected_microphone_index = None
+        self._selected_microphone_name = self.settings.get('selected_microphone_name')
+        self._legacy_microphone_index = self.settings.get('selected_microphone_index')
+        self.microphones.thresholds = self.settings.get('microphone_thresholds', {})
+        self.stream_responses = self.settings.get('stream_responses', True)
+        self.speech_backends = self.settings.get('speech_backends', {"ru-RU": "google", "en-US": "google"})
+        self.speech_models = self.settings.get('speech_models', {})
+        self.voice_direct = self.settings.get('voice_direct', False)
+        self.conversation.token_budget = self.settings.get('context_token_budget', 4000)
+        self.request_executor.configure(self.settings.get('max_concurrent_requests', 2),
+                                        self.settings.get('max_queued_requests', 8))
+        self.response_cache.memory_entries = self.settings.get('response_cache_entries', 128)
+        self.response_cache.disk_bytes = self.settings.get('response_cache_mb', 50) * 1024 * 1024
+        self.response_cache.ttl_seconds = self.settings.get('response_cache_ttl_hours', 168) * 3600
+        self.image_preprocessor.max_side = self.settings.get('image_max_side', 2048)
+        self.image_preprocessor.image_format = self.settings.get('image_format', "JPEG")
+        self.image_preprocessor.quality = self.settings.get('image_quality', 85)
+        self.screen_watcher.interval_ms = self.settings.get('watch_interval_ms', 2000)
+        self.screen_watcher.threshold = self.settings.get('watch_threshold', 0.03)
+        self.chunked_analysis_threshold = self.settings.get('chunked_analysis_threshold_kb', 512) * 1024
+        self.chunked_analysis_chars = self.settings.get('chunked_analysis_chunk_chars', 60000)
+        self.chunked_analysis_parallel = self.settings.get('chunked_analysis_parallel', 3)
+        configure_request_resilience(self.request_executor, self.settings)
+        self.trace_log.max_bytes = self.settings.get('trace_log_kb', 1024) * 1024
+        self.trace_log.backups = self.settings.get('trace_log_backups', 3)
+        self.diagnostics_button.setChecked(self.settings.get('diagnostics_visible', False))
+        if settings_migrated:
+            self.save_settings()
+
+    def load_older_history(self):
+        if self._history_offset <= 0:
+            return
+        records, self._history_offset = self.chat_journal.read_tail(self.HISTORY_PAGE_SIZE, end=self._history_offset)
+        self.chat_history = records + self.chat_history
+        self.chat_model.prepend_messages([record.get("html", "") for record in records])
 
-        self.selected_microphone_index = self.settings.get('selected_microphone_index', None)
+    def migrate_legacy_chat_history(self):
+        """Однократный перенос chat_history из settings.json в журнал. Сохраняет настройки load_settings."""
+        raw_history = self.settings.pop('chat_history')
+        try:
+            if raw_history.startswith('[') and raw_history.endswith(']'):
+                messages = ast.literal_eval(raw_history)
+            else:
+                messages = [raw_history] if raw_history else []
+        except (ValueError, SyntaxError) as e:
+            print(f"Ошибка при переносе истории чата: {e}. История не будет перенесена.")
+            messages = []
+
+        if not self.chat_journal.exists():
+            for message in messages:
+                self.chat_journal.append(legacy_chat_record(message))
 
     def save_settings(self):
         self.settings['pos_x'] = self.pos().x()
@@ -873,11 +3470,42 @@ class OverlayPanel(QWidget):
         self.settings['width'] = self.width()
         self.settings['height'] = self.height()
         self.settings['api_key'] = GEMINI_API_KEY
-        self.settings['chat_history'] = str(self.chat_history)
-        self.settings['selected_microphone_index'] = self.selected_microphone_index
-
-        with open(self.settings_file, 'w') as f:
-            json.dump(self.settings, f, indent=4)
+        # Пока индекс старых настроек не сопоставлен с именем устройства, он остаётся в файле
+        self.settings['selected_microphone_index'] = (self.selected_microphone_index
+                                                      if self._selected_microphone_name
+                                                      else self._legacy_microphone_index)
+        self.settings['selected_microphone_name'] = self._selected_microphone_name
+        self.settings['microphone_thresholds'] = self.microphones.thresholds
+        self.settings['stream_responses'] = self.stream_responses
+        self.settings['speech_backends'] = self.speech_backends
+        self.settings['speech_models'] = self.speech_models
+        self.settings['voice_direct'] = self.voice_direct
+        self.settings['local_endpoint'] = self.settings.get('local_endpoint', True)
+        self.settings['context_token_budget'] = self.conversation.token_budget
+        self.settings['max_concurrent_requests'] = self.request_executor.max_concurrency
+        self.settings['max_queued_requests'] = self.request_executor.max_queued
+        self.settings['response_cache_entries'] = self.response_cache.memory_entries
+        self.settings['response_cache_mb'] = self.response_cache.disk_bytes // (1024 * 1024)
+        self.settings['response_cache_ttl_hours'] = self.response_cache.ttl_seconds // 3600
+        self.settings['image_max_side'] = self.image_preprocessor.max_side
+        self.settings['image_format'] = self.image_preprocessor.image_format
+        self.settings['image_quality'] = self.image_preprocessor.quality
+        self.settings['watch_interval_ms'] = self.screen_watcher.interval_ms
+        self.settings['watch_threshold'] = self.screen_watcher.threshold
+        self.settings['chunked_analysis_threshold_kb'] = self.chunked_analysis_threshold // 1024
+        self.settings['chunked_analysis_chunk_chars'] = self.chunked_analysis_chars
+        self.settings['chunked_analysis_parallel'] = self.chunked_analysis_parallel
+        self.settings['request_timeout_seconds'] = self.request_executor.timeout_seconds
+        self.settings['request_total_timeout_seconds'] = self.request_executor.total_timeout_seconds
+        self.settings['max_retries'] = self.request_executor.max_retries
+        self.settings['retry_backoff_seconds'] = self.request_executor.retry_backoff
+        self.settings['hedge_requests'] = self.request_executor.hedge_requests
+        self.settings['hedge_min_delay_seconds'] = self.request_executor.hedge_min_delay
+        self.settings['trace_log_kb'] = self.trace_log.max_bytes // 1024
+        self.settings['trace_log_backups'] = self.trace_log.backups
+        self.settings['diagnostics_visible'] = self.diagnostics_button.isChecked()
+
+        self.settings_writer.schedule(self.settings)
 
     def prompt_for_api_key(self):
         global GEMINI_API_KEY
@@ -888,47 +3516,83 @@ class OverlayPanel(QWidget):
                 GEMINI_API_KEY = key
                 self.settings['api_key'] = key
                 self.save_settings()
-                self.chat_display.append("<p style='color:#8A2BE2;'>The API key has been installed. Initializing Win-AI...</p>")
+                self.chat_model.append_message("<p style='color:#8A2BE2;'>The API key has been installed. Initializing Win-AI...</p>")
                 self.initialize_gemini()
             else:
                 QMessageBox.warning(self, "Error", "API key cannot be empty. Win-AI features will be disabled.")
-                self.chat_display.append("<p style='color:red;'>API ключ не установлен.</p>")
+                self.chat_model.append_message("<p style='color:red;'>API ключ не установлен.</p>")
                 self.send_button.setEnabled(False)
                 self.open_file_button.setEnabled(False)
+                self.screenshot_button.setEnabled(False)
                 self.toggle_audio_button.setEnabled(False)
         else:
-            self.chat_display.append("<p style='color:red;'>The API key is not installed. Win-AI features will be disabled.</p>")
+            self.chat_model.append_message("<p style='color:red;'>The API key is not installed. Win-AI features will be disabled.</p>")
             self.send_button.setEnabled(False)
             self.open_file_button.setEnabled(False)
+            self.screenshot_button.setEnabled(False)
             self.toggle_audio_button.setEnabled(False)
 
     def initialize_gemini(self):
         global GEMINI_API_KEY
-        if GEMINI_API_KEY and GEMINI_API_KEY != "YOUR_GOOGLE_GEMINI_API_KEY":
-            try:
-                genai.configure(api_key=GEMINI_API_KEY)
-                self.gemini_model = genai.GenerativeModel('gemini-2.5-flash-preview-05-20')
-                _ = genai.get_model('gemini-2.5-flash-preview-05-20')
-
-                self.send_button.setEnabled(True)
-                self.open_file_button.setEnabled(True)
-                self.toggle_audio_button.setEnabled(True)
-
-            except Exception as e:
-                self.send_button.setEnabled(False)
-                self.open_file_button.setEnabled(False)
-                self.toggle_audio_button.setEnabled(False)
-                self.chat_display.append(
-                    f"<p style='color:red;'>Error: The Win-AI model is not initialized. Check your API key and internet connection: {e}</p>")
+        if MODEL_OVERRIDE is not None:
+            self.handle_model_ready(GEMINI_API_KEY, MODEL_OVERRIDE)
+        elif GEMINI_API_KEY and GEMINI_API_KEY != "YOUR_GOOGLE_GEMINI_API_KEY":
+            # Ключ из диалога при запуске уже инициализируется — отложенный вызов из __init__ ничего не делает
+            if self._gemini_key == GEMINI_API_KEY:
+                return
+            self._gemini_key = GEMINI_API_KEY
+            # Импорт google.genai и сетевая проверка модели идут в фоне, окно к этому моменту уже показано
+            threading.Thread(target=self._initialize_gemini, args=(GEMINI_API_KEY,), daemon=True).start()
         else:
             self.send_button.setEnabled(False)
             self.open_file_button.setEnabled(False)
+            self.screenshot_button.setEnabled(False)
             self.toggle_audio_button.setEnabled(False)
-            self.chat_display.append(
+            self.chat_model.append_message(
                 "<p style='color:red;'>Error: The Google Win-AI API key is not installed. Win-AI and related features will be disabled.</p>")
 
+    def _initialize_gemini(self, api_key):
+        try:
+            model = create_gemini_model(api_key)
+        except Exception as e:
+            self.model_failed.emit(api_key, str(e))
+            return
+        # Модель можно использовать сразу, проверка по сети выполняется следом
+        self.model_ready.emit(api_key, model)
+        try:
+            genai.get_model(GEMINI_MODEL_NAME)
+        except Exception as e:
+            self.model_failed.emit(api_key, str(e))
+
+    def handle_model_ready(self, api_key, model):
+        if api_key != GEMINI_API_KEY:
+            return
+        self.gemini_model = model
+        self.request_executor.model = model
+        self.send_button.setEnabled(True)
+        self.open_file_button.setEnabled(True)
+        self.screenshot_button.setEnabled(True)
+        self.toggle_audio_button.setEnabled(True)
+        if self._launch_request is not None:
+            message, self._launch_request = self._launch_request, None
+            self.handle_endpoint_request(None, message)
+
+    def handle_model_failed(self, api_key, error):
+        if api_key != GEMINI_API_KEY:
+            return
+        self._gemini_key = None
+        self.gemini_model = None
+        self.request_executor.model = None
+        self.send_button.setEnabled(False)
+        self.open_file_button.setEnabled(False)
+        self.screenshot_button.setEnabled(False)
+        self.toggle_audio_button.setEnabled(False)
+        self.chat_model.append_message(
+            f"<p style='color:red;'>Error: The Win-AI model is not initialized. Check your API key and internet connection: {error}</p>")
+        self.autoscroll_chat()
+
     def autoscroll_chat(self):
-        self.chat_display.verticalScrollBar().setValue(self.chat_display.verticalScrollBar().maximum())
+        self.chat_display.scroll_to_bottom()
 
     def hide_panel_animated(self):
         self.save_settings()
@@ -963,17 +3627,27 @@ class OverlayPanel(QWidget):
         self.animation.start()
 
     def closeEvent(self, event: QCloseEvent):
+        self.stop_generation()
+        self.request_executor.shutdown()
+        self.screen_capture.shutdown()
+        self.screen_watcher.shutdown()
+        self.local_endpoint.close()
+        self.instance_endpoint.close()
+
         if self.audio_thread and self.audio_thread.isRunning():
             self.audio_thread.stop()
             self.audio_thread.wait(2000)
 
         self.save_settings()
+        self.settings_writer.flush()
+        self.chat_journal.close()
+        self.trace_log.close()
         event.accept()
         QCoreApplication.instance().quit()
 
     def select_file_for_analysis(self):
         if not self.gemini_model:
-            self.chat_display.append("<p style='color:red;'>Error: Win-AI model not initialized. Unable to parse files.</p>")
+            self.chat_model.append_message("<p style='color:red;'>Error: Win-AI model not initialized. Unable to parse files.</p>")
             return
 
         options = QFileDialog.Options()
@@ -1008,153 +3682,539 @@ class OverlayPanel(QWidget):
         file_path, _ = QFileDialog.getOpenFileName(self, "Выбрать файл для анализа", "", file_filters, options=options)
         if file_path:
             try:
-                with open(file_path, 'rb') as f:
-                    file_data = f.read()
                 file_name = os.path.basename(file_path)
-                file_extension = os.path.splitext(file_name)[1].lower()
-
-                mime_type = "application/octet-stream"
-
-
-                if file_extension in (".txt", ".py", ".json", ".xml", ".html", ".css", ".js", ".md", ".csv", ".tsv", ".log", ".ini", ".cfg", ".conf"):
-                    mime_type = "text/plain"
-                elif file_extension == ".pdf":
-                    mime_type = "application/pdf"
-                elif file_extension == ".docx":
-                    mime_type = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-                elif file_extension == ".xlsx":
-                    mime_type = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                elif file_extension == ".pptx":
-                    mime_type = "application/vnd.openxmlformats-officedocument.presentationml.presentation"
-                elif file_extension in (".jpg", ".jpeg"):
-                    mime_type = "image/jpeg"
-                elif file_extension == ".png":
-                    mime_type = "image/png"
-                elif file_extension == ".gif":
-                    mime_type = "image/gif"
-                elif file_extension == ".bmp":
-                    mime_type = "image/bmp"
-                elif file_extension == ".tiff":
-                    mime_type = "image/tiff"
-                elif file_extension == ".webp":
-                    mime_type = "image/webp"
-                elif file_extension == ".mp4":
-                    mime_type = "video/mp4"
-                elif file_extension == ".avi":
-                    mime_type = "video/x-msvideo"
-                elif file_extension == ".mov":
-                    mime_type = "video/quicktime"
-                elif file_extension == ".wmv":
-                    mime_type = "video/x-ms-wmv"
-                elif file_extension == ".flv":
-                    mime_type = "video/x-flv"
-                elif file_extension == ".webm":
-                    mime_type = "video/webm"
-                elif file_extension == ".mp3":
-                    mime_type = "audio/mpeg"
-                elif file_extension == ".wav":
-                    mime_type = "audio/wav"
-                elif file_extension == ".flac":
-                    mime_type = "audio/flac"
-                elif file_extension == ".ogg":
-                    mime_type = "audio/ogg"
-                elif file_extension == ".aac":
-                    mime_type = "audio/aac"
-
-                self.send_message(f"Проанализируй содержимое этого файла: {file_name}", file_data=file_data, file_name=file_name, file_mime_type=mime_type)
-                self.chat_display.append(
+                mime_type = mime_type_for(file_name)
+                prompt = f"Проанализируй содержимое этого файла: {file_name}"
+
+                if mime_type == "text/plain" and os.path.getsize(file_path) > self.chunked_analysis_threshold:
+                    # Большой текст не помещается в контекст модели: анализируем по частям
+                    self.start_chunked_analysis(prompt, file_path)
+                else:
+                    # Большой файл загружается потоково, изображение предварительно сжимается — в потоке запроса
+                    self.send_message(prompt, **file_prompt_kwargs(file_path))
+                self.chat_model.append_message(
                     f"<p style='color:#8A2BE2;'>{self.t('ai')}: {self.t('file_sent', file=file_name)}</p>"
                 )
 
 
             except Exception as e:
-                self.chat_display.append(
+                self.chat_model.append_message(
                     f"<p style='color:red;'>{self.t('ai')}: {self.t('file_cancel')}</p>"
                 )
 
         else:
-            self.chat_display.append(
+            self.chat_model.append_message(
                 f"<p style='color:red;'>{self.t('ai')}: {self.t('file_cancel')}</p>"
             )
 
+    def language_instruction(self):
+        return language_instruction_for(self.current_language)
+
+    def start_chunked_analysis(self, text, file_path):
+        user_message_html = f"<p style='color:#FFFFFF;'>{self.t('you')}: {html.escape(text)}</p>"
+        self.chat_model.append_message(user_message_html)
+        self.record_message("user", text, user_message_html)
+        msg_id = self.chat_model.append_message(f"<p style='color:#8A2BE2;'>{self.t('ai')}: {self.t('thinking')}</p>")
+
+        job = ChunkedAnalysisJob(self.request_executor, file_path, self.language_instruction(),
+                                 chunk_chars=self.chunked_analysis_chars,
+                                 max_parallel=self.chunked_analysis_parallel, parent=self)
+        job.progress.connect(self.handle_analysis_progress)
+        job.finished.connect(self.handle_analysis_finished)
+        job.failed.connect(self.handle_analysis_failed)
+        self._analysis_jobs[job] = msg_id
+        self.stop_button.setEnabled(True)
+        job.start()
+        self.autoscroll_chat()
+
+    def handle_analysis_progress(self, stage, done, total, cached):
+        job = self.sender()
+        if job not in self._analysis_jobs:
+            return
+        if stage == "split":
+            status = self.t('chunk_split')
+        elif stage == "map":
+            status = self.t('chunk_progress', done=done, total=total, cached=cached)
+        else:
+            status = self.t('chunk_reduce', total=total)
+        self._analysis_jobs[job] = self._show_in_slot(self._analysis_jobs[job],
+                                                      f"<p style='color:#8A2BE2;'>{self.t('ai')}: {status}</p>")
+
+    def _finish_analysis(self, job):
+        msg_id = self._analysis_jobs.pop(job)
+        job.deleteLater()
+        self._update_stop_button()
+        return msg_id
+
+    def handle_analysis_finished(self, result_text):
+        job = self.sender()
+        if job not in self._analysis_jobs:
+            return
+        self._show_response(self._finish_analysis(job), result_text)
+        self.autoscroll_chat()
+
+    def handle_analysis_failed(self, error_message):
+        job = self.sender()
+        if job not in self._analysis_jobs:
+            return
+        self._show_in_slot(self._finish_analysis(job), f"<p style='color:#8A2BE2;'>{self.t('ai')}: {error_message}</p>")
+        self.autoscroll_chat()
+
+    def capture_screenshot(self, mode="screen"):
+        started = time.perf_counter()
+        if not self.gemini_model:
+            self.chat_model.append_message(f"<p style='color:red;'>{self.t('model_not_init')}</p>")
+            return
+        prompt = self.chat_input.toPlainText().strip() or self.t('screenshot_prompt')
+        try:
+            if mode == "region":
+                if self._region_selector is not None:
+                    return
+                screen, pixmap = self.screen_capture.grab_screen()
+                self._region_selector = RegionSelector(screen, pixmap)
+                self._region_selector.selected.connect(
+                    lambda rect: self._capture_region(pixmap, rect, prompt))
+                self._region_selector.cancelled.connect(self._capture_region_cancelled)
+                self._region_selector.show()
+                self._region_selector.activateWindow()
+                return
+            rect = active_window_rect() if mode == "window" else None
+            capture_id = self.screen_capture.capture(rect, started)
+        except Exception as e:
+            self.handle_screenshot_error(0, str(e))
+            return
+        self._captures[capture_id] = prompt
+
+    def _capture_region(self, pixmap, rect, prompt):
+        self._region_selector = None
+        capture_id = self.screen_capture.encode(pixmap.toImage(), crop=rect)
+        self._captures[capture_id] = prompt
+
+    def _capture_region_cancelled(self):
+        self._region_selector = None
+
+    def handle_screenshot(self, capture_id, data, mime_type, timings):
+        prompt = self._captures.pop(capture_id, None)
+        if prompt is None:
+            return
+        # Текст из поля ввода ушёл вместе со снимком; если пользователь успел его изменить, не трогаем
+        if self.chat_input.toPlainText().strip() == prompt:
+            self.chat_input.clear()
+        self.send_message(prompt, image_data=data, image_mime_type=mime_type)
+        total_ms = (time.perf_counter() - timings["started"]) * 1000
+        self.capture_timings = (self.capture_timings + [total_ms])[-50:]
+
+    def handle_screenshot_error(self, capture_id, error):
+        self._captures.pop(capture_id, None)
+        self.chat_model.append_message(
+            f"<p style='color:red;'>{self.t('ai')}: {self.t('screenshot_failed', error=html.escape(error))}</p>")
+        self.autoscroll_chat()
+
+    def toggle_screen_watch(self, enabled):
+        if enabled == self.screen_watcher.is_active():
+            return
+        if not enabled:
+            self.screen_watcher.stop()
+            self._watch_question = None
+            # Поздний ответ не должен возобновить наблюдение или попасть в перезапущенное
+            if self._watch_request_id is not None:
+                self.request_executor.cancel(self._watch_request_id)
+                self._watch_request_id = None
+            self.chat_model.append_message(
+                f"<p style='color:#888888;'>{self.t('ai')}: {self.t('watch_stopped', sampled=self.screen_watcher.frames_sampled, sent=self.screen_watcher.frames_sent)}</p>")
+            self.autoscroll_chat()
+            return
+        if not self.gemini_model:
+            self.screenshot_watch_action.setChecked(False)
+            self.chat_model.append_message(f"<p style='color:red;'>{self.t('model_not_init')}</p>")
+            return
+        self._watch_question = self.chat_input.toPlainText().strip() or self.t('watch_default')
+        self.chat_input.clear()
+        self.chat_model.append_message(
+            f"<p style='color:#888888;'>{self.t('ai')}: {self.t('watch_started', seconds=self.screen_watcher.interval_ms / 1000, question=html.escape(self._watch_question))}</p>")
+        self.autoscroll_chat()
+        self.screen_watcher.start()
+
+    def handle_watch_frame(self, data, mime_type, difference):
+        if self._watch_question is None:
+            return
+        prompt = (f"{self.language_instruction()}\n"
+                  f"{self.t('watch_prompt', question=self._watch_question, idle=WATCH_IDLE_REPLY)}")
+        request_id = self.request_executor.submit([{"mime_type": mime_type, "data": data}, prompt])
+        if request_id is None:
+            # Очередь занята: кадр будет снят заново на следующем такте
+            self.screen_watcher.resume()
+            return
+        self._watch_request_id = request_id
+
+    def handle_watch_error(self, error):
+        self._watch_request_id = None
+        self.screen_watcher.stop()
+        self.screenshot_watch_action.setChecked(False)
+        self._watch_question = None
+        self.chat_model.append_message(
+            f"<p style='color:red;'>{self.t('ai')}: {self.t('watch_failed', error=html.escape(error))}</p>")
+        self.autoscroll_chat()
+
+    def handle_endpoint_request(self, reply, message):
+        """Запрос через LocalEndpoint или из аргументов запуска (тогда reply равен None)."""
+        if message.get("show"):
+            self.bring_to_front()
+        prompt = message.get("prompt", "")
+        file_path = message.get("file")
+        if message.get("show") and not prompt and not file_path:
+            if reply is not None:
+                reply.finish("")
+            return
+        try:
+            if file_path:
+                kwargs = file_prompt_kwargs(file_path)
+                prompt = prompt or self.t('batch_file_prompt', name=kwargs['file_name'])
+            elif message.get("image_base64"):
+                kwargs = {"image_data": base64.b64decode(message["image_base64"]),
+                          "image_mime_type": message.get("mime_type", "image/png")}
+            else:
+                kwargs = {}
+        except (OSError, ValueError) as e:
+            if reply is not None:
+                reply.fail(str(e))
+            else:
+                self.chat_model.append_message(f"<p style='color:red;'>{self.t('ai')}: {html.escape(str(e))}</p>")
+            return
+        if not prompt and not kwargs:
+            if reply is not None:
+                reply.fail("Пустой запрос")
+            return
+        self.send_message(prompt, listener=reply, **kwargs)
+
+    def handle_instance_message(self, reply, message):
+        """Аргументы повторного запуска, переданные forward_to_running_instance."""
+        if message.get("show"):
+            self.bring_to_front()
+        self.queue_launch_request(dict(message, show=False))
+
+    def queue_launch_request(self, message):
+        """Запрос из аргументов командной строки выполняется, как только модель будет готова."""
+        if message.get("prompt") or message.get("file"):
+            if self.gemini_model:
+                self.handle_endpoint_request(None, message)
+            else:
+                self._launch_request = message
+
+    def bring_to_front(self):
+        if self.isVisible():
+            self.raise_()
+            self.activateWindow()
+        else:
+            self.show_panel_animated()
+
     def send_message_from_input(self):
         message_text = self.chat_input.toPlainText().strip()
         if message_text:
             self.send_message(message_text)
         self.chat_input.clear()
 
-    def send_message(self, text, image_data=None, file_data=None, file_name=None, file_mime_type=None):
+    def refresh_last_message(self):
+        if self._last_prompt is not None:
+            text, kwargs = self._last_prompt
+            self.send_message(text, force_refresh=True, **kwargs)
+
+    def send_message(self, text, image_data=None, file_data=None, file_name=None, file_mime_type=None,
+                     force_refresh=False, file_path=None, image_mime_type="image/jpeg", audio_data=None,
+                     audio_mime_type="audio/flac", listener=None):
         if not self.gemini_model:
-            self.chat_display.append("<p style='color:red;'>Error: Win-AI model not initialized.</p>")
+            self.chat_model.append_message("<p style='color:red;'>Error: Win-AI model not initialized.</p>")
+            if listener is not None:
+                listener.fail("Win-AI model not initialized.")
+            return
+        if self.request_executor.is_full():
+            self.chat_model.append_message(f"<p style='color:red;'>{self.t('ai')}: {self.t('queue_full')}</p>")
+            self.autoscroll_chat()
+            if listener is not None:
+                listener.fail(self.t('queue_full'))
             return
 
-        self.send_button.setEnabled(False)
+        user_message_html = f"<p style='color:#FFFFFF;'>{self.t('you')}: {html.escape(text)}</p>"
+        self.chat_model.append_message(user_message_html)
+        self.record_message("user", text, user_message_html)
+
+        thinking_id = self.chat_model.append_message(f"<p style='color:#8A2BE2;'>{self.t('ai')}: {self.t('thinking')}</p>")
+
+        reply = PendingReply(thinking_id, listener)
+        language_instruction = self.language_instruction()
+        prompt_parts = build_prompt_parts(text, language_instruction, file_path=file_path, file_data=file_data,
+                                          file_name=file_name, file_mime_type=file_mime_type,
+                                          image_data=image_data, image_mime_type=image_mime_type,
+                                          audio_data=audio_data, audio_mime_type=audio_mime_type,
+                                          voice_instruction=self.t('voice_instruction'))
+
+        self._last_prompt = (text, {"image_data": image_data, "file_data": file_data, "file_path": file_path,
+                                    "file_name": file_name, "file_mime_type": file_mime_type,
+                                    "image_mime_type": image_mime_type, "audio_data": audio_data,
+                                    "audio_mime_type": audio_mime_type})
+        self.refresh_button.setEnabled(True)
+        attachments = [data for data in (file_data, image_data, audio_data) if data]
+        cache_key, cache_fields = prompt_cache_key(text, language_instruction, file_path, attachments)
+        if cache_key is not None and not force_refresh:
+            cached_text = self.response_cache.get_memory(cache_key)
+            if cached_text is not None:
+                # Ответ из кэша в памяти не проходит через RequestExecutor, замер записывается здесь
+                trace = RequestTrace(None)
+                trace.outcome = "cached"
+                render_started = trace.add("payload_build", reply.started)
+                self._show_response(thinking_id, cached_text, cached=True)
+                self.autoscroll_chat()
+                trace.add("render", render_started)
+                trace.add("total", reply.started)
+                self._record_trace(trace, "chat")
+                if listener is not None:
+                    listener.finish(cached_text, True)
+                return
+
+        # Последняя запись истории — только что добавленное сообщение пользователя
+        contents = self.conversation.build_contents(self.chat_history[:-1], prompt_parts)
+        reply.build_ms = (time.perf_counter() - reply.started) * 1000
+
+        request_id = self.request_executor.submit(contents, stream=self.stream_responses, cache_key=cache_key,
+                                                  force_refresh=force_refresh, cache_fields=cache_fields)
+        if request_id is None:
+            self.chat_model.set_message(thinking_id, f"<p style='color:red;'>{self.t('ai')}: {self.t('queue_full')}</p>")
+            if listener is not None:
+                listener.fail(self.t('queue_full'))
+            return
+        self._replies[request_id] = reply
+        self.stop_button.setEnabled(True)
+        self.autoscroll_chat()
 
-        user_message_html = f"<p style='color:#FFFFFF;'>{self.t('you')}: {text}</p>"
-        self.chat_display.append(user_message_html)
-        self.chat_history.append(user_message_html)
+    def _show_in_slot(self, msg_id, html_text):
+        # Если чат очистили, пока запрос выполнялся, ответ просто добавляется в конец
+        if not self.chat_model.set_message(msg_id, html_text):
+            return self.chat_model.append_message(html_text)
+        return msg_id
 
-        self.chat_display.append(f"<p style='color:#8A2BE2;'>{self.t('ai')}: {self.t('thinking')}</p>")
+    def handle_upload_progress(self, request_id, sent, total):
+        reply = self._replies.get(request_id)
+        if reply is None or reply.streaming:
+            return
+        progress = self.t('uploading', percent=sent * 100 // max(1, total),
+                          sent=sent / (1024 * 1024), total=total / (1024 * 1024))
+        reply.msg_id = self._show_in_slot(reply.msg_id, f"<p style='color:#8A2BE2;'>{self.t('ai')}: {progress}</p>")
 
-        prompt_parts = []
+    def handle_image_preprocessed(self, request_id, original_size, new_size):
+        if request_id not in self._replies:
+            return
+        saved = self.t('image_saved', before=original_size / (1024 * 1024), after=new_size / (1024 * 1024),
+                       percent=100 - new_size * 100 // max(1, original_size))
+        self.chat_model.append_message(f"<p style='color:#888888;'>{self.t('ai')}: {saved}</p>")
 
-        if self.current_language == "ru":
-            language_instruction = "Ответь на русском языке."
-        else:
-            language_instruction = "Answer in English."
-        if file_data and file_name and file_mime_type:
-            prompt_parts.append({"mime_type": file_mime_type, "data": file_data})
-            prompt_parts.append(f"{language_instruction}\nAnalyze file {file_name}: {text}")
+    def handle_first_token(self, request_id, seconds):
+        if request_id not in self._replies:
+            return
+        self.ttft_history = (self.ttft_history + [seconds])[-100:]
+        self.title_label.setToolTip(f"TTFT: {seconds * 1000:.0f} ms")
 
+    def handle_gemini_chunk(self, request_id, text):
+        reply = self._replies.get(request_id)
+        if reply is None:
+            return
+        if not reply.streaming:
+            reply.streaming = True
+            reply.msg_id = self._show_in_slot(reply.msg_id, "<p style='color:#8A2BE2;'>Win-AI:</p>")
+            self._stream_flush_timer.start()
+        reply.buffer.append(text)
+        if reply.listener is not None:
+            reply.listener.chunk(text)
+
+    def _flush_reply(self, reply):
+        if not reply.buffer:
+            return
+        started = time.perf_counter()
+        reply.text = reply.partial_text()
+        reply.buffer = []
+        reply.msg_id = self._show_in_slot(reply.msg_id, ai_message_html(reply.text))
+        reply.render_ms += (time.perf_counter() - started) * 1000
+
+    def _flush_stream_buffers(self):
+        flushed = False
+        for reply in self._replies.values():
+            if reply.buffer:
+                self._flush_reply(reply)
+                flushed = True
+        if flushed:
+            self.autoscroll_chat()
+
+    def _show_response(self, msg_id, response_text, cached=False):
+        response_html = ai_message_html(response_text)
+        if cached:
+            label = f" <span style='color:#888888;'>({self.t('cached')})</span>"
+            self._show_in_slot(msg_id, ai_message_html(response_text, label))
         else:
-            prompt_parts.append(f"{language_instruction}\n{text}")
+            self._show_in_slot(msg_id, response_html)
+        self.record_message("ai", response_text, response_html)
 
-        self.worker_thread = WorkerThread(self.gemini_model, prompt_parts)
-        self.worker_thread.response_received.connect(self.handle_gemini_response)
-        self.worker_thread.error_occurred.connect(self.handle_gemini_error)
-        self.worker_thread.start()
+    def _complete_reply(self, request_id, response_text=None, notice_html=None, cached=False, error=None):
+        """Завершает ответ: текст модели (если есть) сохраняется в истории, notice_html — служебное сообщение."""
+        reply = self._replies.pop(request_id, None)
+        if reply is None:
+            return
+        if reply.listener is not None:
+            if error is not None:
+                reply.listener.fail(error)
+            else:
+                reply.listener.finish(response_text or "", cached)
+        started = time.perf_counter()
+        if response_text:
+            self._show_response(reply.msg_id, response_text, cached)
+            if notice_html:
+                self.chat_model.append_message(notice_html)
+        else:
+            self._show_in_slot(reply.msg_id, notice_html or "<p style='color:#8A2BE2;'>Win-AI:</p>")
 
-        self.chat_input.clear()
+        if not self._replies:
+            self._stream_flush_timer.stop()
+        self._update_stop_button()
         self.autoscroll_chat()
+        reply.render_ms += (time.perf_counter() - started) * 1000
+        reply.finished = time.perf_counter()
+        self._traced_replies[request_id] = reply
+        self.compact_history()
 
-    def handle_gemini_response(self, response_text):
-        html_content = self.chat_display.toHtml()
-        think_html = "<p style=\"color:#8A2BE2;\">Win-AI: Думаю...</p>"
-        if html_content.strip().endswith(think_html.strip()):
-            last_think_index = html_content.rfind(think_html)
-            if last_think_index != -1:
-                html_content = html_content[:last_think_index]
-                self.chat_display.setHtml(html_content)
-        self.chat_display.append(f"<p style='color:#8A2BE2;'>Win-AI: {response_text}</p>")
+    def _update_stop_button(self):
+        self.stop_button.setEnabled(bool(self._replies or self._analysis_jobs))
 
-        if self.chat_history and self.chat_history[-1].strip() == think_html.strip():
-            self.chat_history.pop()
-        self.chat_history.append(f"<p style='color:#8A2BE2;'>Win-AI: {response_text}</p>")
+    def compact_history(self):
+        """Фоном дописывает в краткое содержание реплики, выпавшие из окна контекста."""
+        if self._summary_request_id is not None or not self.gemini_model:
+            return
+        pending = self.conversation.needs_compaction(self.chat_history)
+        if not pending:
+            return
+        request_id = self.request_executor.submit([self.conversation.summary_prompt(pending)])
+        if request_id is not None:
+            self._summary_request_id = request_id
+            self._summary_upto_ts = pending[-1].get("ts", 0)
+
+    def stop_generation(self):
+        stopped_html = f"<p style='color:#8A2BE2;'>{self.t('ai')}: {self.t('stopped')}</p>"
+        for request_id in list(self._replies):
+            self.request_executor.cancel(request_id)
+            self._complete_reply(request_id, self._replies[request_id].partial_text(), stopped_html,
+                                 error=self.t('stopped'))
+        for job in list(self._analysis_jobs):
+            job.cancel()
+            self._show_in_slot(self._finish_analysis(job), stopped_html)
+
+    def handle_gemini_response(self, request_id, response_text, cached=False):
+        if request_id == self._summary_request_id:
+            self._summary_request_id = None
+            self.conversation.update_summary(response_text, self._summary_upto_ts)
+            return
+        if request_id == self._watch_request_id:
+            self._watch_request_id = None
+            self.screen_watcher.resume()
+            if self._watch_question is not None and WATCH_IDLE_REPLY not in response_text:
+                response_html = f"<p style='color:#8A2BE2;'>{self.t('ai')} ({self.t('watch')}): {response_text}</p>"
+                self.chat_model.append_message(response_html)
+                self.record_message("ai", response_text, response_html)
+                self.autoscroll_chat()
+            return
+        self._complete_reply(request_id, response_text, cached=cached)
 
-        self.send_button.setEnabled(True)
-        self.autoscroll_chat()
+    def handle_gemini_error(self, request_id, error_message):
+        if request_id == self._summary_request_id:
+            self._summary_request_id = None
+            print(f"Не удалось обновить краткое содержание чата: {error_message}")
+            return
+        if request_id == self._watch_request_id:
+            self.handle_watch_error(error_message)
+            return
+        reply = self._replies.get(request_id)
+        if reply is None:
+            return
+        error_html = f"<p style='color:#8A2BE2;'>{self.t('ai')}: {error_message}</p>"
+        self._complete_reply(request_id, reply.partial_text(), error_html, error=error_message)
+
+    def handle_request_traced(self, request_id, trace):
+        reply = self._traced_replies.pop(request_id, None)
+        if reply is not None:
+            kind = "chat"
+            trace.spans["payload_build"] = trace.spans.get("payload_build", 0.0) + reply.build_ms
+            trace.spans["render"] = reply.render_ms
+            trace.spans["total"] = (reply.finished - reply.started) * 1000
+        else:
+            kind = "background"
+        self._record_trace(trace, kind)
+
+    def _record_trace(self, trace, kind):
+        record = trace.to_record(kind)
+        self.trace_log.append(record)
+        self.recent_traces = (self.recent_traces + [record])[-50:]
+        if self.diagnostics_view.isVisible():
+            self.refresh_diagnostics()
+
+    def toggle_diagnostics(self, visible):
+        self.diagnostics_view.setVisible(visible)
+        if visible:
+            self.refresh_diagnostics()
         self.save_settings()
 
-    def handle_gemini_error(self, error_message):
-        html_content = self.chat_display.toHtml()
-        think_html = "<p style=\"color:#8A2BE2;\">Win-AI: Думаю...</p>"
-        if html_content.strip().endswith(think_html.strip()):
-            last_think_index = html_content.rfind(think_html)
-            if last_think_index != -1:
-                html_content = html_content[:last_think_index]
-                self.chat_display.setHtml(html_content)
-        self.chat_display.append(f"<p style='color:#8A2BE2;'>{self.t('ai')}: {error_message}</p>")
+    def refresh_diagnostics(self):
+        columns = self.t('diagnostics_columns').split("|")
+        lines = [f"{columns[0]:<8}{columns[1]:<10}" + "".join(f"{column:>10}" for column in columns[2:])]
+        for record in reversed(self.recent_traces[-20:]):
+            spans = record["spans"]
+            cells = "".join(f"{spans[name]:>10.0f}" if name in spans else f"{'-':>10}"
+                            for name in RequestTrace.SPANS)
+            # Фоновые запросы (краткое содержание, наблюдение, поблочный анализ) помечены звёздочкой
+            marker = "" if record["kind"] == "chat" else " *"
+            if record.get("retries"):
+                marker += f" retry×{record['retries']}"
+            if record.get("hedged"):
+                marker += " hedge"
+            # Ответы из кэша в памяти не получают идентификатора запроса
+            request_label = "-" if record["request_id"] is None else f"#{record['request_id']}"
+            lines.append(f"{request_label:<8}{record['outcome']:<10}{cells}{marker}")
+        self.diagnostics_view.setPlainText("\n".join(lines))
+
+    def populate_devices(self):
+        self.microphones.enumerate_async()
+
+    def handle_devices_ready(self, devices):
+        # Индекс устройства мог измениться с прошлого запуска — ищем его по имени
+        if not self._selected_microphone_name:
+            # Настройки старых версий хранили только индекс
+            for index, name in devices:
+                if index == self._legacy_microphone_index:
+                    self._selected_microphone_name = name
+        if self._selected_microphone_name:
+            self.selected_microphone_index = self.microphones.index_for_name(self._selected_microphone_name)
+            if self.selected_microphone_index is None:
+                self._selected_microphone_name = None
+
+    def select_microphone(self, index):
+        self.selected_microphone_index = index
+        self._legacy_microphone_index = None
+        self._selected_microphone_name = None if index is None else self.microphones.device_name(index)
+        self.save_settings()
+        if self.microphones.threshold_for(index) is None and not self.recording_in_progress:
+            self.microphones.calibrate_async(index)
 
-        if self.chat_history and self.chat_history[-1].strip() == think_html.strip():
-            self.chat_history.pop()
-        self.chat_display.append(f"<p style='color:#8A2BE2;'>{self.t('ai')}: {error_message}</p>")
+    def recalibrate_microphone(self):
+        if self.recording_in_progress and self.audio_thread:
+            self.audio_thread.recalibrate()
+        elif not self.microphones.calibrate_async(self.selected_microphone_index):
+            self.chat_model.append_message(f"<p style='color:#888888;'>{self.t('ai')}: {self.t('mic_searching')}</p>")
 
-        self.send_button.setEnabled(True)
-        self.autoscroll_chat()
+    def handle_microphone_calibrated(self, device, threshold):
+        self.microphones.thresholds[device] = threshold
         self.save_settings()
+        self.chat_model.append_message(
+            f"<p style='color:#888888;'>{self.t('ai')}: {self.t('mic_calibrated', device=html.escape(device), threshold=threshold)}</p>")
+        self.autoscroll_chat()
 
-    def populate_devices(self):
-        pass #
+    def handle_calibration_failed(self, error):
+        self.chat_model.append_message(
+            f"<p style='color:red;'>{self.t('ai')}: {self.t('mic_calibration_failed', error=html.escape(error))}</p>")
 
     def toggle_audio_recording(self):
         if self.recording_in_progress:
@@ -1166,121 +4226,1052 @@ class OverlayPanel(QWidget):
         if self.recording_in_progress:
             return
         if not pyaudio:
-            self.chat_display.append("<p style='color:red;'>Не могу начать запись аудио: PyAudio не установлен.</p>")
+            self.chat_model.append_message("<p style='color:red;'>Не могу начать запись аудио: PyAudio не установлен.</p>")
             return
 
-        self.audio_thread = AudioWorkerThread(self)
+        self.audio_thread = AudioWorkerThread(self, speech_settings={
+            "speech_backends": self.speech_backends, "speech_models": self.speech_models},
+            direct_audio=self.voice_direct, device_index=self.selected_microphone_index,
+            energy_threshold=self.microphones.threshold_for(self.selected_microphone_index))
+        device_name = self.microphones.device_name(self.selected_microphone_index)
+        self.audio_thread.calibrated.connect(
+            lambda threshold: self.handle_microphone_calibrated(device_name, threshold))
         self.audio_thread.transcribed_text.connect(self.handle_transcribed_text)
+        self.audio_thread.phrase_audio.connect(self.handle_voice_audio)
         self.audio_thread.error_occurred.connect(self.handle_audio_error)
+        thread = self.audio_thread
+        self.audio_thread.finished.connect(lambda: self.handle_audio_finished(thread))
         self.audio_thread.start()
         self.recording_in_progress = True
         self.toggle_audio_button.setText(self.t("mic_on"))
         self.toggle_audio_button.setStyleSheet("QPushButton#toggleAudioButton.active { background-color: #dc3545; color: white; }")
         self.toggle_audio_button.setProperty("class", "active")
         self.toggle_audio_button.style().polish(self.toggle_audio_button)
-        self.chat_display.append(f"<p style='color:#8A2BE2;'>{self.t('ai')}: {self.t('listening')}</p>")
+        self.chat_model.append_message(f"<p style='color:#8A2BE2;'>{self.t('ai')}: {self.t('listening')}</p>")
 
     def stop_audio_recording(self):
-        if self.audio_thread and self.audio_thread.isRunning():
+        if self.audio_thread and self.recording_in_progress:
             self.audio_thread.stop()
-            self.recording_in_progress = False
-            self.toggle_audio_button.setProperty("class", "")
-            self.toggle_audio_button.style().polish(self.toggle_audio_button)
-            self.toggle_audio_button.setText(self.t("mic_off"))
+            self._reset_audio_button()
 
-            self.chat_display.append(
+            self.chat_model.append_message(
                 f"<p style='color:#8A2BE2;'>{self.t('ai')}: {self.t('recording_stopped')}</p>"
             )
+            if self.audio_thread.dropped_phrases:
+                self.chat_model.append_message(
+                    f"<p style='color:#888888;'>{self.t('ai')}: {self.t('phrases_dropped', count=self.audio_thread.dropped_phrases)}</p>")
+
+    def _reset_audio_button(self):
+        self.recording_in_progress = False
+        self.toggle_audio_button.setProperty("class", "")
+        self.toggle_audio_button.style().polish(self.toggle_audio_button)
+        self.toggle_audio_button.setText(self.t("mic_off"))
+
+    def handle_audio_finished(self, thread):
+        # stop() не ждёт поток, поэтому он удаляется здесь, когда действительно завершится
+        if thread is self.audio_thread:
+            self.audio_thread = None
+            if self.recording_in_progress:
+                self._reset_audio_button()
+        thread.deleteLater()
 
     def handle_transcribed_text(self, text):
         self.chat_input.setText(text)
         self.send_message_from_input()
 
+    def handle_voice_audio(self, data, mime_type):
+        self.send_message(self.t('voice_message'), audio_data=data, audio_mime_type=mime_type)
+
+    def show_audio_menu(self, pos):
+        menu = QMenu(self)
+        direct_action = menu.addAction(self.t('voice_direct'))
+        direct_action.setCheckable(True)
+        direct_action.setChecked(self.voice_direct)
+        direct_action.toggled.connect(self.set_voice_direct)
+
+        devices_menu = menu.addMenu(self.t('microphone'))
+        if self.microphones.devices is None:
+            devices_menu.addAction(self.t('mic_searching')).setEnabled(False)
+        else:
+            # Выбранное устройство применяется со следующего включения микрофона
+            for index, name in [(None, self.t('mic_default'))] + self.microphones.devices:
+                action = devices_menu.addAction(name)
+                action.setCheckable(True)
+                action.setChecked(index == self.selected_microphone_index)
+                action.triggered.connect(lambda checked, index=index: self.select_microphone(index))
+        menu.addAction(self.t('mic_recalibrate')).triggered.connect(self.recalibrate_microphone)
+        menu.exec_(self.toggle_audio_button.mapToGlobal(pos))
+
+    def set_voice_direct(self, enabled):
+        # Действует со следующего включения микрофона
+        self.voice_direct = enabled
+        self.save_settings()
+
     def handle_audio_error(self, error_message):
         QMessageBox.critical(self, self.t("audio_error_title"), error_message)
-        self.chat_display.append(f"<p style='color:red;'>Audio Error: {error_message}</p>")
+        self.chat_model.append_message(f"<p style='color:red;'>Audio Error: {error_message}</p>")
         self.stop_audio_recording()
 
 
 
+class MicrophoneManager(QObject):
+    """Список микрофонов и откалиброванные для них пороги громкости.
+
+    Устройства перечисляются один раз в фоне. Порог energy_threshold сохраняется по имени устройства
+    (индексы PyAudio могут меняться между запусками), поэтому запись начинается без калибровки.
+    """
+    DEFAULT_DEVICE = "default"
+    # [(индекс PyAudio, имя устройства)]
+    devices_ready = pyqtSignal(list)
+    # (имя устройства, порог)
+    calibrated = pyqtSignal(str, float)
+    calibration_failed = pyqtSignal(str)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.devices = None
+        self.thresholds = {}
+
+    def enumerate_async(self):
+        if self.devices is None:
+            threading.Thread(target=self._enumerate, daemon=True).start()
+
+    def _enumerate(self):
+        devices = []
+        if pyaudio:
+            audio = pyaudio.PyAudio()
+            try:
+                # Одно и то же устройство видно через несколько API Windows — берём только API по умолчанию
+                host_api = audio.get_default_host_api_info()['index']
+                for index in range(audio.get_device_count()):
+                    info = audio.get_device_info_by_index(index)
+                    if info.get('maxInputChannels', 0) > 0 and info.get('hostApi') == host_api:
+                        devices.append((index, info.get('name', str(index))))
+            except Exception as e:
+                print(f"Не удалось получить список микрофонов: {e}")
+            finally:
+                audio.terminate()
+        self.devices = devices
+        self.devices_ready.emit(devices)
+
+    def device_name(self, index):
+        for device_index, name in self.devices or ():
+            if device_index == index:
+                return name
+        return self.DEFAULT_DEVICE
+
+    def index_for_name(self, name):
+        for device_index, device_name in self.devices or ():
+            if device_name == name:
+                return device_index
+        return None
+
+    def threshold_for(self, index):
+        return self.thresholds.get(self.device_name(index))
+
+    def calibrate_async(self, index):
+        """Калибрует порог по фоновому шуму в отдельном потоке, не мешая интерфейсу.
+
+        Пока список устройств не готов, имя устройства неизвестно и порог сохранился бы не под тем ключом,
+        поэтому калибровка не запускается и возвращается False.
+        """
+        if self.devices is None:
+            return False
+        threading.Thread(target=self._calibrate, args=(index, self.device_name(index)), daemon=True).start()
+        return True
+
+    def _calibrate(self, index, name):
+        recognizer = sr.Recognizer()
+        try:
+            with sr.Microphone(device_index=index) as source:
+                recognizer.adjust_for_ambient_noise(source, duration=1)
+            self.calibrated.emit(name, recognizer.energy_threshold)
+        except Exception as e:
+            self.calibration_failed.emit(str(e))
+
+
+class SpeechBackend:
+    """Движок распознавания речи для одного языка.
+
+    Модель загружается один раз в load() и дальше переиспользуется всеми записями,
+    поэтому экземпляры получают через get_speech_backend(), а не создают напрямую.
+    """
+    name = ""
+
+    def __init__(self, language, model=None):
+        self.language = language
+        self.model = model
+
+    def load(self):
+        """Загружает модель; ошибка здесь означает, что движок недоступен."""
+        raise NotImplementedError
+
+    def transcribe(self, audio):
+        """Возвращает текст фразы (пустую строку, если речь не распознана)."""
+        raise NotImplementedError
+
+
+class GoogleSpeechBackend(SpeechBackend):
+    """Распознавание через сервис Google (нужен интернет)."""
+    name = "google"
+
+    def load(self):
+        self._recognizer = sr.Recognizer()
+
+    def transcribe(self, audio):
+        try:
+            return self._recognizer.recognize_google(audio, language=self.language)
+        except sr.UnknownValueError:
+            return ""
+
+
+class SphinxSpeechBackend(SpeechBackend):
+    """Офлайн-распознавание через CMU Sphinx (pocketsphinx); model — язык или путь к модели."""
+    name = "sphinx"
+
+    def load(self):
+        import pocketsphinx  # noqa: F401 — проверяем наличие пакета заранее, а не на первой фразе
+        self._recognizer = sr.Recognizer()
+
+    def transcribe(self, audio):
+        try:
+            return self._recognizer.recognize_sphinx(audio, language=self.model or self.language)
+        except sr.UnknownValueError:
+            return ""
+
+
+class VoskSpeechBackend(SpeechBackend):
+    """Офлайн-распознавание через Vosk; model — путь к распакованной модели (обязателен)."""
+    name = "vosk"
+    SAMPLE_RATE = 16000
+
+    def load(self):
+        # Без пути Vosk скачал бы модель из сети, а этот движок должен работать офлайн
+        if not self.model or not os.path.isdir(self.model):
+            raise RuntimeError(f"Для Vosk ({self.language}) укажите путь к распакованной модели "
+                               f"в speech_models в settings.json; сейчас: {self.model or 'не задан'}")
+        import vosk
+        vosk.SetLogLevel(-1)
+        self._vosk = vosk
+        self._model = vosk.Model(self.model)
+
+    def transcribe(self, audio):
+        recognizer = self._vosk.KaldiRecognizer(self._model, self.SAMPLE_RATE)
+        recognizer.AcceptWaveform(audio.get_raw_data(convert_rate=self.SAMPLE_RATE, convert_width=2))
+        return json.loads(recognizer.FinalResult()).get("text", "")
+
+
+class WhisperSpeechBackend(SpeechBackend):
+    """Офлайн-распознавание локальной моделью Whisper (faster-whisper, int8 на CPU); model — размер или путь."""
+    name = "whisper"
+    SAMPLE_RATE = 16000
+
+    def load(self):
+        import numpy
+        from faster_whisper import WhisperModel
+        self._numpy = numpy
+        self._model = WhisperModel(self.model or "small", device="cpu", compute_type="int8")
+        self._lock = threading.Lock()
+
+    def transcribe(self, audio):
+        raw = audio.get_raw_data(convert_rate=self.SAMPLE_RATE, convert_width=2)
+        samples = self._numpy.frombuffer(raw, dtype=self._numpy.int16).astype(self._numpy.float32) / 32768.0
+        with self._lock:
+            segments, _ = self._model.transcribe(samples, language=self.language[:2], beam_size=1)
+            return " ".join(segment.text.strip() for segment in segments)
+
+
+SPEECH_BACKENDS = {
+    backend.name: backend
+    for backend in (GoogleSpeechBackend, VoskSpeechBackend, WhisperSpeechBackend, SphinxSpeechBackend)
+}
+
+_speech_backends = {}
+_speech_backends_lock = threading.Lock()
+
+
+def get_speech_backend(engine, language, model=None):
+    """Загруженный движок распознавания; модель загружается при первом обращении и остаётся в памяти."""
+    key = (engine, language, model)
+    with _speech_backends_lock:
+        backend = _speech_backends.get(key)
+        if backend is None:
+            if engine not in SPEECH_BACKENDS:
+                raise ValueError(f"Неизвестный движок распознавания речи: {engine}")
+            backend = SPEECH_BACKENDS[engine](language, model)
+            backend.load()
+            _speech_backends[key] = backend
+        return backend
+
+
+def speech_backend_for(speech_settings, language):
+    """Движок для языка по настройкам speech_backends/speech_models из settings.json."""
+    engine = speech_settings.get("speech_backends", {}).get(language, "google")
+    model = speech_settings.get("speech_models", {}).get(engine, {}).get(language)
+    return get_speech_backend(engine, language, model)
+
+
 class AudioWorkerThread(QThread):
+    """Запись речи с микрофона.
+
+    Сам поток только слушает микрофон и складывает фразы в ограниченную очередь, а распознают их
+    отдельные потоки. Поэтому речь, сказанная во время распознавания предыдущей фразы, не теряется.
+    Расшифровки выдаются строго в порядке произнесения. Движок распознавания для каждого языка
+    выбирается по speech_settings (см. speech_backend_for).
+    """
     transcribed_text = pyqtSignal(str)
+    # (закодированная фраза, MIME-тип) — в режиме direct_audio фразы не распознаются, а уходят в модель
+    phrase_audio = pyqtSignal(bytes, str)
+    # Новый порог громкости после калибровки по фоновому шуму
+    calibrated = pyqtSignal(float)
     error_occurred = pyqtSignal(str)
+    MAX_QUEUED_PHRASES = 8
+    DIRECT_SAMPLE_RATE = 16000
 
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, recognition_workers=2, speech_settings=None, direct_audio=False,
+                 device_index=None, energy_threshold=None):
         super().__init__(parent)
         self.running = False
         self.recognizer = sr.Recognizer()
+        self.device_index = device_index
+        # Сохранённый порог: если он есть, калибровка перед записью не нужна
+        self.energy_threshold = energy_threshold
+        self._recalibrate = False
+        self.speech_settings = speech_settings or {}
+        self.direct_audio = direct_audio
+        self.recognition_workers = recognition_workers
+        self.phrases = queue.Queue(maxsize=self.MAX_QUEUED_PHRASES)
+        # Расшифровки, пришедшие раньше предыдущих фраз: номер фразы -> текст
+        self._results = {}
+        self._next_result = 0
+        self._results_lock = threading.Lock()
+        # Фразы, отброшенные из-за переполнения очереди
+        self.dropped_phrases = 0
+        # После первой неустранимой ошибки остальные фразы не распознаются и ошибка не повторяется
+        self._failed = threading.Event()
+
+    def _fail(self, message):
+        with self._results_lock:
+            if self._failed.is_set():
+                return
+            self._failed.set()
+        self.running = False
+        while True:
+            try:
+                self.phrases.get_nowait()
+            except queue.Empty:
+                break
+        self.error_occurred.emit(message)
 
     def run(self):
         self.running = True
         if not pyaudio:
-            self.error_occurred.emit("PyAudio не доступен. Невозможно использовать микрофон.")
-            self.running = False
+            self._fail("PyAudio не доступен. Невозможно использовать микрофон.")
             return
 
+        workers = []
+        if not self.direct_audio:
+            # Модель загружается, пока идёт калибровка микрофона; при повторной записи она уже в памяти
+            workers.append(threading.Thread(target=self._backend, args=(self._language(),), daemon=True))
+        for _ in range(self.recognition_workers):
+            workers.append(threading.Thread(target=self._recognize_phrases, daemon=True))
+        for worker in workers:
+            worker.start()
+
         try:
-            with sr.Microphone() as source:
-                self.recognizer.adjust_for_ambient_noise(source)
+            with sr.Microphone(device_index=self.device_index) as source:
+                if self.energy_threshold:
+                    self.recognizer.energy_threshold = self.energy_threshold
+                else:
+                    self._calibrate(source)
                 self.recognizer.dynamic_energy_threshold = False
 
+                phrase_number = 0
                 while self.running:
+                    if self._recalibrate:
+                        self._recalibrate = False
+                        self._calibrate(source)
                     try:
-                        audio = self.recognizer.listen(source, timeout=10, phrase_time_limit=15)
-                        lang = "ru-RU" if self.parent().current_language == "ru" else "en-US"
-                        text = self.recognizer.recognize_google(audio, language=lang)
-                        if text:
-                            self.transcribed_text.emit(text)
-                    except sr.UnknownValueError:
-                        pass
+                        # Короткое ожидание начала фразы, чтобы stop() не блокировался надолго
+                        audio = self.recognizer.listen(source, timeout=1, phrase_time_limit=15)
                     except sr.WaitTimeoutError:
-                        pass
-                    except sr.RequestError as e:
-                        self.error_occurred.emit(f"Не удалось получить результаты от сервиса Google Speech Recognition; проверьте подключение к интернету: {e}")
-                        self.running = False
+                        continue
                     except Exception as e:
-                        self.error_occurred.emit(f"Общая ошибка аудио во время обработки: {e}")
-                        self.running = False
-                    self.msleep(100)
+                        self._fail(f"Общая ошибка аудио во время обработки: {e}")
+                        break
+                    self._enqueue(phrase_number, audio)
+                    phrase_number += 1
+
+        except Exception as e:
+            self._fail(f"Ошибка инициализации микрофона: {e}. Убедитесь, что драйверы аудио корректны и микрофон доступен.")
+        finally:
+            # finished (и удаление объекта) — только когда распознаны все записанные фразы,
+            # иначе потоки распознавания обращались бы к уже удалённому объекту
+            for worker in workers:
+                worker.join()
+
+    def _calibrate(self, source):
+        self.recognizer.adjust_for_ambient_noise(source)
+        self.calibrated.emit(self.recognizer.energy_threshold)
+
+    def recalibrate(self):
+        """Перекалибровка между фразами, не прерывая запись."""
+        self._recalibrate = True
+
+    def _enqueue(self, phrase_number, audio):
+        try:
+            self.phrases.put_nowait((phrase_number, audio))
+            return
+        except queue.Full:
+            pass
+        # Распознавание не успевает за речью: отбрасываем самую старую фразу, а не свежую
+        try:
+            dropped_number, _ = self.phrases.get_nowait()
+            self.dropped_phrases += 1
+            self._deliver(dropped_number, None)
+        except queue.Empty:
+            pass
+        self.phrases.put_nowait((phrase_number, audio))
+
+    def _language(self):
+        return "ru-RU" if self.parent().current_language == "ru" else "en-US"
 
+    def _backend(self, language):
+        try:
+            return speech_backend_for(self.speech_settings, language)
         except Exception as e:
-            self.error_occurred.emit(f"Ошибка инициализации микрофона: {e}. Убедитесь, что драйверы аудио корректны и микрофон доступен.")
-            self.running = False
+            self._fail(f"Не удалось загрузить движок распознавания речи: {e}")
+            return None
+
+    def _recognize_phrases(self):
+        # Потоки распознавания дорабатывают уже записанные фразы и после остановки записи
+        while (self.running or not self.phrases.empty()) and not self._failed.is_set():
+            try:
+                phrase_number, audio = self.phrases.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            text = None
+            if self.direct_audio:
+                self._deliver(phrase_number, self._encode_phrase(audio))
+                continue
+            backend = self._backend(self._language())
+            try:
+                if backend is not None:
+                    text = backend.transcribe(audio)
+            except sr.RequestError as e:
+                self._fail(f"Не удалось получить результаты от сервиса Google Speech Recognition; проверьте подключение к интернету: {e}")
+            except Exception as e:
+                self._fail(f"Общая ошибка аудио во время обработки: {e}")
+            self._deliver(phrase_number, text)
+
+    def _encode_phrase(self, audio):
+        """16 кГц, 16 бит, моно: FLAC, если доступен кодировщик flac, иначе WAV."""
+        try:
+            return audio.get_flac_data(convert_rate=self.DIRECT_SAMPLE_RATE, convert_width=2), "audio/flac"
+        except (OSError, AssertionError):
+            return audio.get_wav_data(convert_rate=self.DIRECT_SAMPLE_RATE, convert_width=2), "audio/wav"
+
+    def _deliver(self, phrase_number, result):
+        with self._results_lock:
+            self._results[phrase_number] = result
+            while self._next_result in self._results:
+                ready = self._results.pop(self._next_result)
+                self._next_result += 1
+                if isinstance(ready, tuple):
+                    self.phrase_audio.emit(*ready)
+                elif ready:
+                    self.transcribed_text.emit(ready)
 
     def stop(self):
+        """Не ждёт потока: запись заканчивается после текущей фразы, finished приходит, когда очередь распознана."""
         self.running = False
-        self.wait()
 
 
+def load_batch_jobs(source):
+    """Задания пакетного режима: JSONL ({"prompt", "file", "language", "id"} или строка на строку) либо папка с файлами.
+
+    Для файла без prompt запрос подставляет BatchRunner на языке задания.
+    """
+    if os.path.isdir(source):
+        jobs = []
+        for name in sorted(os.listdir(source)):
+            path = os.path.join(source, name)
+            if os.path.isfile(path):
+                jobs.append({"id": name, "file": path})
+        return jobs
+
+    jobs = []
+    with open(source, 'r', encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            job = json.loads(line)
+            if isinstance(job, str):
+                job = {"prompt": job}
+            job.setdefault("id", number)
+            jobs.append(job)
+    return jobs
+
+
+class BatchRunner(QObject):
+    """Пакетная обработка запросов без окна.
+
+    Запросы идут через тот же RequestExecutor, что и в окне чата (кэш ответов, загрузка файлов,
+    сжатие изображений, поблочный анализ больших текстов). Одновременно выполняется не больше
+    запросов, чем позволяет исполнитель; результаты дописываются в JSONL по мере готовности.
+    """
+    finished = pyqtSignal()
+
+    def __init__(self, executor, jobs, output, language="ru", force_refresh=False,
+                 chunked_threshold=512 * 1024, chunk_chars=60000, chunk_parallel=3, parent=None):
+        super().__init__(parent)
+        self.executor = executor
+        self.jobs = list(jobs)
+        self.output = output
+        self.language = language
+        self.force_refresh = force_refresh
+        self.chunked_threshold = chunked_threshold
+        self.chunk_chars = chunk_chars
+        self.chunk_parallel = chunk_parallel
+        self.latencies = []
+        self.errors = 0
+        self.cached = 0
+        self.started = None
+        self.done = False
+        self._next_job = 0
+        # request_id -> (задание, время отправки)
+        self._in_flight = {}
+        # ChunkedAnalysisJob -> (задание, время отправки)
+        self._analyses = {}
+        self._retry_scheduled = False
+
+        executor.response_received.connect(self.handle_response)
+        executor.error_occurred.connect(self.handle_error)
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._fill()
+
+    def _fill(self):
+        self._retry_scheduled = False
+        while self._next_job < len(self.jobs) and not self.executor.is_full():
+            job = self.jobs[self._next_job]
+            try:
+                if not self._submit(job):
+                    break
+            except Exception as e:
+                self._write(job, time.perf_counter(), error=str(e))
+            self._next_job += 1
+
+        if self._next_job < len(self.jobs):
+            # Исполнитель занят чужими запросами, и ответа, который разбудит нас, не будет — повторим позже
+            if not self._in_flight and not self._analyses and not self._retry_scheduled:
+                self._retry_scheduled = True
+                QTimer.singleShot(20, self._fill)
+        elif not self._in_flight and not self._analyses and not self.done:
+            self.done = True
+            self.finished.emit()
+
+    def _submit(self, job):
+        started = time.perf_counter()
+        language = job.get("language", self.language)
+        language_instruction = language_instruction_for(language)
+        file_path = job.get("file")
+        if file_path and not job.get("prompt"):
+            texts = UI_TEXTS.get(language, UI_TEXTS["en"])
+            job["prompt"] = texts["batch_file_prompt"].format(name=os.path.basename(file_path))
+        prompt = job.get("prompt", "")
+        if (file_path and mime_type_for(file_path) == "text/plain"
+                and os.path.getsize(file_path) > self.chunked_threshold):
+            analysis = ChunkedAnalysisJob(self.executor, file_path, language_instruction, chunk_chars=self.chunk_chars,
+                                          max_parallel=self.chunk_parallel, parent=self)
+            analysis.finished.connect(lambda text, analysis=analysis: self._finish_analysis(analysis, text=text))
+            analysis.failed.connect(lambda error, analysis=analysis: self._finish_analysis(analysis, error=error))
+            self._analyses[analysis] = (job, started)
+            analysis.start()
+            return True
+
+        kwargs = file_prompt_kwargs(file_path) if file_path else {}
+        prompt_parts = build_prompt_parts(prompt, language_instruction, **kwargs)
+        attachments = [kwargs["file_data"]] if "file_data" in kwargs else []
+        cache_key, cache_fields = prompt_cache_key(prompt, language_instruction, kwargs.get("file_path"), attachments)
+        request_id = self.executor.submit(prompt_parts, cache_key=cache_key, force_refresh=self.force_refresh,
+                                          cache_fields=cache_fields)
+        if request_id is None:
+            return False
+        self._in_flight[request_id] = (job, started)
+        return True
+
+    def handle_response(self, request_id, text, cached):
+        entry = self._in_flight.pop(request_id, None)
+        if entry is not None:
+            self._write(*entry, text=text, cached=cached)
+        self._fill()
+
+    def handle_error(self, request_id, error_message):
+        entry = self._in_flight.pop(request_id, None)
+        if entry is not None:
+            self._write(*entry, error=error_message)
+        self._fill()
+
+    def _finish_analysis(self, analysis, text=None, error=None):
+        entry = self._analyses.pop(analysis, None)
+        analysis.deleteLater()
+        if entry is not None:
+            self._write(*entry, text=text, error=error)
+        self._fill()
+
+    def _write(self, job, started, text=None, error=None, cached=False):
+        latency = time.perf_counter() - started
+        record = {"id": job.get("id"), "prompt": job.get("prompt"), "file": job.get("file")}
+        if error is None:
+            record["text"] = text
+            record["cached"] = cached
+            self.latencies.append(latency)
+            self.cached += int(cached)
+        else:
+            record["error"] = error
+            self.errors += 1
+        record["latency_s"] = round(latency, 3)
+        self.output.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.output.flush()
+
+    def summary(self):
+        elapsed = max(1e-9, time.perf_counter() - self.started)
+        done = len(self.latencies) + self.errors
+        return (f"Выполнено запросов: {done} за {elapsed:.1f} с ({done / elapsed:.2f} запросов/с), "
+                f"ошибок: {self.errors}, из кэша: {self.cached}, "
+                f"задержка p50 {percentile(self.latencies, 0.5):.2f} с, p95 {percentile(self.latencies, 0.95):.2f} с")
+
+
+def run_batch(argv):
+    """python Win-AI.py --batch <prompts.jsonl | папка> [--output results.jsonl] [--concurrency 4]
+    [--language ru|en] [--no-cache]"""
+    parser = argparse.ArgumentParser(prog="Win-AI.py --batch")
+    parser.add_argument("source")
+    parser.add_argument("--output")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--language", choices=("ru", "en"))
+    parser.add_argument("--no-cache", action="store_true")
+    # Обрабатывается в __main__ до вызова run_batch; здесь только чтобы флаг можно было указать после --batch
+    parser.add_argument("--stub-model", action="store_true")
+    args = parser.parse_args(argv)
+
+    app = QCoreApplication(sys.argv)
+    settings_file = "settings.json"
+    settings = SettingsWriter(settings_file).load()
+    api_key = settings.get('api_key') or GEMINI_API_KEY
+    if MODEL_OVERRIDE is None and (not api_key or api_key == "YOUR_GOOGLE_GEMINI_API_KEY"):
+        print("API ключ не установлен: укажите его в settings.json или в переменной окружения GOOGLE_API_KEY.")
+        return 2
+    jobs = load_batch_jobs(args.source)
+
+    base_dir = os.path.dirname(settings_file)
+    executor = RequestExecutor(
+        model=MODEL_OVERRIDE or create_gemini_model(api_key), max_concurrency=args.concurrency, max_queued=args.concurrency,
+        response_cache=None if args.no_cache else ResponseCache(os.path.join(base_dir, "response_cache")),
+        file_uploader=FileUploader(os.path.join(base_dir, "uploads.json")))
+    executor.image_preprocessor = ImagePreprocessor(
+        os.path.join(base_dir, "image_cache"), settings.get('image_max_side', 2048),
+        settings.get('image_format', "JPEG"), settings.get('image_quality', 85))
+    configure_request_resilience(executor, settings)
+
+    output_path = args.output or os.path.splitext(args.source.rstrip("/\\"))[0] + ".results.jsonl"
+    with open(output_path, 'w', encoding='utf-8') as output:
+        runner = BatchRunner(executor, jobs, output, language=args.language or settings.get('language', 'ru'),
+                             chunked_threshold=settings.get('chunked_analysis_threshold_kb', 512) * 1024,
+                             chunk_chars=settings.get('chunked_analysis_chunk_chars', 60000),
+                             chunk_parallel=args.concurrency)
+        runner.finished.connect(app.quit)
+        runner.start()
+        if not runner.done:
+            app.exec_()
+        executor.shutdown()
+    print(f"{runner.summary()}\nРезультаты: {output_path}")
+    return 0 if runner.errors == 0 else 1
+
+
+def launch_message(argv):
+    """Что передать уже запущенному экземпляру: показать панель, а также запрос и файл, если они указаны.
+
+    python Win-AI.py [файл] [--prompt "вопрос"]
+    """
+    parser = argparse.ArgumentParser(prog="Win-AI.py")
+    parser.add_argument("file", nargs="?")
+    parser.add_argument("--prompt")
+    args, _ = parser.parse_known_args(argv)
+    message = {"show": True}
+    if args.prompt:
+        message["prompt"] = args.prompt
+    if args.file:
+        # Путь относительно каталога, из которого запущен второй экземпляр
+        message["file"] = os.path.abspath(args.file)
+    return message
+
+
+def forward_to_running_instance(message):
+    """Передаёт сообщение уже запущенному Win-AI. Возвращает False, если другого экземпляра нет."""
+    socket = QLocalSocket()
+    socket.connectToServer(INSTANCE_SERVER_NAME)
+    if not socket.waitForConnected(200):
+        return False
+    socket.write((json.dumps(message, ensure_ascii=False) + "\n").encode("utf-8"))
+    socket.waitForBytesWritten(1000)
+    socket.disconnectFromServer()
+    return True
+
+
+def run_local_client(argv):
+    """python Win-AI.py --send "вопрос" [--file путь] — отправляет запрос в запущенный Win-AI
+    и печатает ответ по мере поступления."""
+    parser = argparse.ArgumentParser(prog="Win-AI.py --send")
+    parser.add_argument("prompt", nargs="?", default="")
+    parser.add_argument("--file")
+    parser.add_argument("--timeout", type=float, default=300)
+    args = parser.parse_args(argv)
+
+    app = QCoreApplication(sys.argv)
+    socket = QLocalSocket()
+    socket.connectToServer(LOCAL_SERVER_NAME)
+    if not socket.waitForConnected(1000):
+        print("Win-AI не запущен или локальная точка входа отключена.")
+        return 2
+    message = {"prompt": args.prompt}
+    if args.file:
+        message["file"] = os.path.abspath(args.file)
+    socket.write((json.dumps(message, ensure_ascii=False) + "\n").encode("utf-8"))
+    socket.flush()
+
+    streamed = False
+    while socket.waitForReadyRead(int(args.timeout * 1000)):
+        while socket.canReadLine():
+            event = json.loads(bytes(socket.readLine()).decode("utf-8"))
+            if event.get("event") == "chunk":
+                streamed = True
+                print(event["text"], end="", flush=True)
+            elif event.get("event") == "done":
+                print("" if streamed else event["text"])
+                return 0
+            else:
+                print(f"Ошибка: {event.get('error')}")
+                return 1
+    print("Нет ответа от Win-AI.")
+    return 1
 
-class WorkerThread(QThread):
-    response_received = pyqtSignal(str)
-    error_occurred = pyqtSignal(str)
 
-    def __init__(self, model, prompt_parts):
-        super().__init__()
-        self.model = model
-        self.prompt_parts = prompt_parts
+class FirstPaintProbe(QObject):
+    """Для --report-first-paint: печатает время первой отрисовки виджета и завершает процесс."""
 
-    def run(self):
+    def __init__(self, widget):
+        super().__init__(widget)
+        self._reported = False
+        widget.installEventFilter(self)
+
+    def eventFilter(self, obj, event):
+        if event.type() == QEvent.Paint and not self._reported:
+            self._reported = True
+            # Отчёт после завершения отрисовки, а не в её начале
+            QTimer.singleShot(0, self._report)
+        return False
+
+    def _report(self):
+        print(f"FIRST_PAINT {time.time():.6f} {(time.perf_counter() - STARTUP_TIME) * 1000:.1f}", flush=True)
+        os._exit(0)
+
+
+def run_startup_benchmark(rounds=5):
+    """Время от запуска процесса до первой отрисовки окна чата.
+
+    python Win-AI.py --bench-startup (нужен сохранённый API-ключ, иначе при запуске откроется диалог ввода)
+    """
+    command = [sys.executable] + ([] if getattr(sys, 'frozen', False) else [os.path.abspath(__file__)])
+    totals = []
+    in_process = []
+    for _ in range(rounds):
+        started = time.time()
+        result = subprocess.run(command + ["--report-first-paint"], capture_output=True, text=True, timeout=120)
+        for line in result.stdout.splitlines():
+            if line.startswith("FIRST_PAINT "):
+                _, painted_at, since_import = line.split()
+                totals.append((float(painted_at) - started) * 1000)
+                in_process.append(float(since_import))
+                break
+        else:
+            print(f"Окно не отрисовалось: {result.stderr.strip()[-500:]}")
+            return 1
+    print(f"Запуск до первой отрисовки ({rounds} запусков): p50 {percentile(totals, 0.5):.0f} мс, "
+          f"min {min(totals):.0f} мс, max {max(totals):.0f} мс; "
+          f"из них после старта интерпретатора p50 {percentile(in_process, 0.5):.0f} мс")
+    return 0
+
+
+class RenderProbe(QObject):
+    """Получатель ответа для --bench-ui: отмечает первый фрагмент, итог и ближайшие после них отрисовки чата."""
+
+    def __init__(self, viewport):
+        super().__init__(viewport)
+        viewport.installEventFilter(self)
+        self.reset(time.perf_counter())
+
+    def reset(self, started):
+        self.started = started
+        self.first_chunk = None
+        self.first_render = None
+        self.finished = None
+        self.final_render = None
+        self.error = None
+
+    def chunk(self, text):
+        if self.first_chunk is None:
+            self.first_chunk = time.perf_counter()
+
+    def finish(self, text, cached=False):
+        self.finished = time.perf_counter()
+        if self.first_chunk is None:
+            self.first_chunk = self.finished
+
+    def fail(self, error):
+        self.error = error
+        self.finish("")
+
+    def eventFilter(self, obj, event):
+        if event.type() == QEvent.Paint:
+            # Время фиксируется после завершения отрисовки
+            QTimer.singleShot(0, self._painted)
+        return False
+
+    def _painted(self):
+        now = time.perf_counter()
+        if self.first_chunk is not None and self.first_render is None:
+            self.first_render = now
+        if self.finished is not None and self.final_render is None:
+            self.final_render = now
+
+
+def run_ui_benchmark(rounds=50, history_sizes=(10, 1000, 10000)):
+    """Сквозной замер окна чата с имитацией модели: send_message -> RequestExecutor -> отрисовка ответа.
+
+    Без окна и API-ключа: QT_QPA_PLATFORM=offscreen python Win-AI.py --bench-ui
+    Каждый размер истории замеряется в отдельном временном каталоге с заранее записанным журналом чата.
+    """
+    global MODEL_OVERRIDE
+    MODEL_OVERRIDE = SimulatedBackend(latency=0.05, tokens_per_second=400, chunk_tokens=8, reply_tokens=80,
+                                      jitter=0.2, seed=1)
+    original_dir = os.getcwd()
+    app = QApplication.instance()
+
+    for size in history_sizes:
+        work_dir = tempfile.mkdtemp(prefix="win-ai-bench-")
+        os.chdir(work_dir)
         try:
-            response = self.model.generate_content(self.prompt_parts, stream=False)
-            response.resolve()
-            self.response_received.emit(response.text)
+            with open("settings.json", 'w', encoding='utf-8') as f:
+                json.dump({"api_key": "simulated", "local_endpoint": False}, f)
+            journal = ChatJournal("chat_history.jsonl")
+            for index in range(size):
+                role = "user" if index % 2 == 0 else "ai"
+                text = f"Сообщение {index} " + "текст " * 20
+                journal.append(make_chat_record(role, text, f"<p style='color:#FFFFFF;'>{text}</p>"))
+            journal.close()
+
+            toggle_panel = TogglePanel()
+            panel = OverlayPanel(toggle_panel)
+            panel.show()
+            while panel._history_offset > 0:
+                panel.load_older_history()
+            while not panel.gemini_model:
+                app.processEvents(QEventLoop.AllEvents, 10)
+
+            probe = RenderProbe(panel.chat_display.viewport())
+            dispatch, first_render, final_render = [], [], []
+            errors = 0
+            for round_number in range(rounds):
+                started = time.perf_counter()
+                probe.reset(started)
+                panel.send_message(f"Вопрос {round_number}", listener=probe)
+                dispatch.append((time.perf_counter() - started) * 1000)
+                deadline = started + 30
+                while probe.final_render is None and time.perf_counter() < deadline:
+                    app.processEvents(QEventLoop.AllEvents, 5)
+                if probe.error is not None or probe.final_render is None:
+                    errors += 1
+                    continue
+                first_render.append((probe.first_render - started) * 1000)
+                final_render.append((probe.final_render - started) * 1000)
+
+            print(f"История {size} сообщений ({len(panel.chat_history)} загружено), {rounds} запросов, ошибок {errors}:")
+            for name, values in (("отправка", dispatch), ("первый фрагмент на экране", first_render),
+                                 ("ответ целиком на экране", final_render)):
+                print(f"  {name:>26}: p50 {percentile(values, 0.5):7.1f} мс, p95 {percentile(values, 0.95):7.1f} мс, "
+                      f"p99 {percentile(values, 0.99):7.1f} мс")
+            panel.close()
+            toggle_panel.close()
+            app.processEvents()
+        finally:
+            os.chdir(original_dir)
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return 0
+
+
+def run_stt_benchmark(fixtures_dir, language="ru-RU"):
+    """Сравнение задержки движков распознавания речи на записанных WAV-файлах.
+
+    python Win-AI.py --bench-stt fixtures/ru ru-RU
+    Модели офлайн-движков берутся из speech_models в settings.json.
+    """
+    settings = {}
+    if os.path.exists("settings.json"):
+        with open("settings.json", 'r', encoding='utf-8') as f:
+            settings = json.load(f)
+    clips = []
+    for name in sorted(os.listdir(fixtures_dir)):
+        if name.lower().endswith(".wav"):
+            with sr.AudioFile(os.path.join(fixtures_dir, name)) as source:
+                clips.append((name, sr.Recognizer().record(source)))
+    if not clips:
+        print(f"В {fixtures_dir} нет WAV-файлов")
+        return 1
+
+    for engine in SPEECH_BACKENDS:
+        model = settings.get('speech_models', {}).get(engine, {}).get(language)
+        started = time.perf_counter()
+        try:
+            backend = get_speech_backend(engine, language, model)
         except Exception as e:
-            self.error_occurred.emit(str(e))
+            print(f"{engine}: недоступен ({e})")
+            continue
+        load_ms = (time.perf_counter() - started) * 1000
+        latencies = []
+        for name, audio in clips:
+            started = time.perf_counter()
+            try:
+                text = backend.transcribe(audio)
+            except Exception as e:
+                text = f"<ошибка: {e}>"
+            latencies.append((time.perf_counter() - started) * 1000)
+            print(f"{engine:>8} {name}: {latencies[-1]:7.0f} мс  {text}")
+        print(f"{engine:>8}: загрузка {load_ms:.0f} мс, p50 {percentile(latencies, 0.5):.0f} мс, "
+              f"p95 {percentile(latencies, 0.95):.0f} мс, всего {sum(latencies) / 1000:.1f} с на {len(clips)} файлов")
+    return 0
+
+
+def run_capture_benchmark(rounds=30):
+    """Время от нажатия горячей клавиши до готового к отправке кадра.
+
+    Без окна: QT_QPA_PLATFORM=offscreen python Win-AI.py --bench-capture
+    """
+    capture = ScreenCapture(ImagePreprocessor(os.path.join(os.path.dirname("settings.json"), "image_cache")))
+    loop = QEventLoop()
+    results = {"screen": [], "region": []}
+    frame_sizes = []
+
+    def on_frame(capture_id, data, mime_type, timings):
+        timings["total_ms"] = (time.perf_counter() - timings["started"]) * 1000
+        results[current_mode].append(timings)
+        frame_sizes.append(len(data))
+        loop.quit()
+
+    capture.frame_ready.connect(on_frame)
+    capture.failed.connect(lambda capture_id, error: (print(f"Ошибка: {error}"), loop.quit()))
+    for current_mode in results:
+        for _ in range(rounds):
+            if current_mode == "screen":
+                capture.capture()
+            else:
+                started = time.perf_counter()
+                screen, pixmap = capture.grab_screen()
+                geometry = screen.geometry()
+                crop = QRect(geometry.width() // 4, geometry.height() // 4, geometry.width() // 2, geometry.height() // 2)
+                capture.encode(pixmap.toImage(), crop=crop, started=started)
+            loop.exec_()
+    capture.shutdown()
+
+    screen_size = QApplication.primaryScreen().geometry().size()
+    print(f"Экран {screen_size.width()}x{screen_size.height()}, {rounds} снимков на режим, "
+          f"средний кадр {sum(frame_sizes) // max(1, len(frame_sizes)) // 1024} КБ")
+    for mode, samples in results.items():
+        for stage in ("grab_ms", "encode_ms", "total_ms"):
+            values = [sample[stage] for sample in samples]
+            print(f"{mode:>6} {stage:>9}: p50 {percentile(values, 0.5):6.1f} мс, "
+                  f"p95 {percentile(values, 0.95):6.1f} мс, max {max(values, default=0):6.1f} мс")
+    return 0
+
+
+def run_hedge_benchmark(rounds=300):
+    """Задержка ответа модели с дублированием запросов и без него на имитации с медленным хвостом.
+
+    Без окна: QT_QPA_PLATFORM=offscreen python Win-AI.py --bench-hedge
+    Имитация: 20 мс до ответа (± 20 %), у 3 % вызовов — 500 мс; дубль не раньше чем через 10 мс.
+    Запросы идут по одному через submit и сигналы исполнителя, как в пакетном режиме: время считается
+    от submit до response_received, первые MIN_HEDGE_SAMPLES набирают статистику TTFT без дублей.
+    """
+    loop = QEventLoop()
+    for hedge in (False, True):
+        executor = RequestExecutor(SimulatedBackend(latency=0.02, tokens_per_second=10000, reply_tokens=8,
+                                                    jitter=0.2, seed=1, tail_rate=0.03, tail_latency=0.5))
+        executor.hedge_requests = hedge
+        executor.hedge_min_delay = 0.01
+        latencies = []
+        traces = []
+        errors = []
+        submitted = [0.0]
+        executor.response_received.connect(
+            lambda request_id, text, cached: latencies.append((time.perf_counter() - submitted[0]) * 1000))
+        executor.error_occurred.connect(lambda request_id, error_message: errors.append(error_message))
+        # request_traced — последний сигнал запроса, после него отправляется следующий
+        executor.request_traced.connect(lambda request_id, trace: (traces.append(trace), loop.quit()))
+        for round_number in range(rounds):
+            submitted[0] = time.perf_counter()
+            executor.submit([f"Вопрос {round_number}"])
+            loop.exec_()
+        executor.shutdown()
+        hedged = sum(trace.hedged for trace in traces)
+        print(f"{'с дублями' if hedge else 'без дублей':>10}: {rounds} запросов, дублей {hedged}, ошибок {len(errors)}, "
+              f"p50 {percentile(latencies, 0.5):.0f} мс, p95 {percentile(latencies, 0.95):.0f} мс, "
+              f"p99 {percentile(latencies, 0.99):.0f} мс")
+    return 0
 
 
 if __name__ == '__main__':
+    if '--bench-stt' in sys.argv:
+        arguments = sys.argv[sys.argv.index('--bench-stt') + 1:]
+        if not arguments:
+            print("Использование: python Win-AI.py --bench-stt <папка с WAV> [ru-RU|en-US]")
+            sys.exit(2)
+        sys.exit(run_stt_benchmark(*arguments[:2]))
+
     QCoreApplication.setAttribute(Qt.AA_EnableHighDpiScaling)
     QCoreApplication.setAttribute(Qt.AA_UseHighDpiPixmaps)
 
+    if '--send' in sys.argv:
+        sys.exit(run_local_client(sys.argv[sys.argv.index('--send') + 1:]))
+    if '--stub-model' in sys.argv:
+        MODEL_OVERRIDE = SimulatedBackend()
+    if '--batch' in sys.argv:
+        sys.exit(run_batch(sys.argv[sys.argv.index('--batch') + 1:]))
+    if '--bench-startup' in sys.argv:
+        sys.exit(run_startup_benchmark())
+
     app = QApplication(sys.argv)
+    if '--bench-capture' in sys.argv:
+        sys.exit(run_capture_benchmark())
+    if '--bench-ui' in sys.argv:
+        sys.exit(run_ui_benchmark())
+    if '--bench-hedge' in sys.argv:
+        sys.exit(run_hedge_benchmark())
+
+    # Второй запуск не создаёт новое окно, а передаёт аргументы уже работающему экземпляру
+    message = launch_message(sys.argv[1:])
+    if '--report-first-paint' not in sys.argv and forward_to_running_instance(message):
+        sys.exit(0)
 
     toggle_panel = TogglePanel()
     main_panel = OverlayPanel(toggle_panel) #
 
 
     toggle_panel.show_main_panel_signal.connect(main_panel.show_panel_animated)
+    main_panel.queue_launch_request(message)
+    if '--report-first-paint' in sys.argv:
+        probe = FirstPaintProbe(main_panel.chat_display.viewport())
 
     sys.exit(app.exec_())
@@ -0,0 +1,59 @@
+import importlib.util
+import json
+import os
+import time
+
+import pytest
+
+
+@pytest.fixture(scope="session")
+def win_ai():
+    """Модуль Win-AI.py (имя файла с дефисом, поэтому загружается по пути)."""
+    pytest.importorskip("PyQt5")
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Win-AI.py")
+    spec = importlib.util.spec_from_file_location("win_ai", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope="session")
+def qapp(win_ai):
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    return win_ai.QApplication.instance() or win_ai.QApplication([])
+
+
+@pytest.fixture
+def make_panel(win_ai, qapp, tmp_path, monkeypatch):
+    """Окно чата с имитацией модели в пустом каталоге; settings дописываются в settings.json перед запуском."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(win_ai, "MODEL_OVERRIDE", win_ai.SimulatedBackend(latency=0.01, seed=1))
+    panels = []
+
+    def make(**settings):
+        with open("settings.json", 'w', encoding='utf-8') as f:
+            json.dump(dict({"api_key": "simulated", "local_endpoint": False}, **settings), f)
+        toggle_panel = win_ai.TogglePanel()
+        panel = win_ai.OverlayPanel(toggle_panel)
+        panels.append((panel, toggle_panel))
+        return panel
+
+    yield make
+    for panel, toggle_panel in panels:
+        panel.close()
+        toggle_panel.close()
+    qapp.processEvents()
+
+
+@pytest.fixture
+def wait_for(qapp):
+    """Крутит цикл событий Qt, пока condition() не станет истинным (не дольше timeout секунд)."""
+    def wait(condition, timeout=5.0):
+        deadline = time.perf_counter() + timeout
+        while not condition():
+            assert time.perf_counter() < deadline, "timed out waiting for the event loop"
+            qapp.processEvents()
+            time.sleep(0.005)
+        return True
+
+    return wait
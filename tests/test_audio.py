@@ -0,0 +1,65 @@
+import threading
+import time
+import types
+
+
+class FakeMicrophone:
+    def __init__(self, device_index=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class FakeRecognizer:
+    """Отдаёт заданное число фраз, после чего запись останавливается, как по кнопке."""
+
+    def __init__(self, worker, phrases):
+        self.worker = worker
+        self.phrases = phrases
+        self.energy_threshold = 300
+        self.dynamic_energy_threshold = True
+
+    def listen(self, source, timeout=None, phrase_time_limit=None):
+        if self.phrases == 0:
+            self.worker.stop()
+            raise WaitTimeoutError()
+        self.phrases -= 1
+        return f"phrase {3 - self.phrases}"
+
+
+class WaitTimeoutError(Exception):
+    pass
+
+
+class SlowBackend:
+    def transcribe(self, audio):
+        time.sleep(0.2)
+        return audio
+
+
+def test_recording_finishes_only_after_queued_phrases_are_transcribed(win_ai, qapp, wait_for, monkeypatch):
+    fake_sr = types.SimpleNamespace(Recognizer=lambda: None, Microphone=FakeMicrophone,
+                                    WaitTimeoutError=WaitTimeoutError, RequestError=RuntimeError)
+    monkeypatch.setattr(win_ai, "sr", fake_sr)
+    monkeypatch.setattr(win_ai, "pyaudio", True)
+    monkeypatch.setattr(win_ai, "speech_backend_for", lambda settings, language: SlowBackend())
+
+    owner = win_ai.QObject()
+    owner.current_language = "ru"
+    worker = win_ai.AudioWorkerThread(owner, recognition_workers=1, energy_threshold=300)
+    worker.recognizer = FakeRecognizer(worker, phrases=3)
+    texts, errors = [], []
+    finished = threading.Event()
+    worker.transcribed_text.connect(texts.append)
+    worker.error_occurred.connect(errors.append)
+    worker.finished.connect(lambda: (finished.set(), texts.append("<finished>"), worker.deleteLater()))
+    worker.start()
+
+    wait_for(finished.is_set)
+    qapp.processEvents()
+    assert errors == []
+    assert texts == ["phrase 1", "phrase 2", "phrase 3", "<finished>"]
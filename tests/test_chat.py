@@ -0,0 +1,26 @@
+def test_reply_is_escaped_the_same_while_streaming_and_when_complete(win_ai, make_panel, wait_for, monkeypatch):
+    panel = make_panel(stream_responses=True)
+    wait_for(lambda: panel.gemini_model is not None)
+    # Медленный поток, чтобы текст успел показаться до завершения ответа
+    panel.request_executor.model = win_ai.SimulatedBackend(latency=0.01, tokens_per_second=20, chunk_tokens=4)
+    shown = []
+    show_in_slot = panel._show_in_slot
+
+    def record_slot(msg_id, html_text):
+        shown.append(html_text)
+        return show_in_slot(msg_id, html_text)
+
+    monkeypatch.setattr(panel, "_show_in_slot", record_slot)
+    panel.send_message("if a < b && c:\nreturn")
+    wait_for(lambda: not panel._replies)
+
+    record = panel.chat_history[-1]
+    assert record["role"] == "ai"
+    assert record["text"].endswith("if a < b && c:\nreturn")
+    expected = record["html"]
+    assert expected.endswith("<br>if a &lt; b &amp;&amp; c:<br>return</p>")
+    assert shown[-1] == expected
+    # Каждый показанный в потоке фрагмент — начало итогового HTML, без скачка разметки при завершении
+    streamed = [text for text in shown[:-1] if "Echo" in text]
+    assert streamed
+    assert all(expected.startswith(text[:-len("</p>")]) for text in streamed)
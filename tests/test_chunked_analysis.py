@@ -0,0 +1,34 @@
+def test_group_partials_always_shrinks(win_ai):
+    # Каждый результат длиннее половины лимита — раньше каждая группа состояла из одного результата
+    partials = ["x" * 700 for _ in range(7)]
+    groups = win_ai.group_partials(partials, 1000)
+    assert len(groups) <= len(partials) // 2
+    assert all(len(group) >= 2 for group in groups)
+    assert all(sum(len(text) for text in group) <= 1000 + len(group) * len("\n[...]") for group in groups)
+
+
+def test_group_partials_keeps_short_results_intact(win_ai):
+    partials = ["a" * 100, "b" * 100, "c" * 100]
+    assert win_ai.group_partials(partials, 1000) == [partials]
+
+
+def test_group_partials_merges_single_leftover(win_ai):
+    groups = win_ai.group_partials(["a" * 400, "b" * 400, "c" * 400], 500)
+    assert len(groups) == 1
+    assert len(groups[0]) == 3
+
+
+def test_reduce_falls_back_to_one_request_when_count_does_not_shrink(win_ai):
+    class Executor(win_ai.QObject):
+        response_received = win_ai.pyqtSignal(int, str, bool)
+        error_occurred = win_ai.pyqtSignal(int, str)
+
+    job = win_ai.ChunkedAnalysisJob(Executor(), "log.txt", "", chunk_chars=100)
+    stages = []
+    job._run_stage = lambda stage, prompts, on_done: stages.append(prompts)
+
+    job._reduce(["x" * 80] * 8)
+    assert len(stages[-1]) == 4
+    # Следующий раунд с тем же числом результатов — только один итоговый запрос
+    job._reduce(["x" * 80] * 8)
+    assert len(stages[-1]) == 1
@@ -0,0 +1,48 @@
+import json
+import uuid
+
+
+def endpoint_events(win_ai, panel, wait_for, message):
+    """Отправляет одну JSON-строку через QLocalSocket и собирает события до done или error."""
+    endpoint = win_ai.LocalEndpoint(f"win-ai-test-{uuid.uuid4().hex}", parent=panel)
+    endpoint.request_received.connect(panel.handle_endpoint_request)
+    assert endpoint.listen()
+    client = win_ai.QLocalSocket()
+    client.connectToServer(endpoint.name)
+    wait_for(lambda: client.state() == win_ai.QLocalSocket.ConnectedState)
+    client.write((json.dumps(message) + "\n").encode("utf-8"))
+    client.flush()
+    events = []
+
+    def read_events():
+        while client.canReadLine():
+            events.append(json.loads(bytes(client.readLine()).decode("utf-8")))
+        return events and events[-1]["event"] in ("done", "error")
+
+    wait_for(read_events)
+    client.disconnectFromServer()
+    endpoint.close()
+    return events
+
+
+def test_endpoint_streams_chunks_and_done(win_ai, make_panel, wait_for):
+    panel = make_panel(stream_responses=True)
+    wait_for(lambda: panel.gemini_model is not None)
+    events = endpoint_events(win_ai, panel, wait_for, {"prompt": "hello endpoint", "id": 7})
+    assert [event["event"] for event in events[:-1]] == ["chunk"] * (len(events) - 1)
+    assert len(events) > 1
+    done = events[-1]
+    assert done["event"] == "done"
+    assert done["id"] == 7
+    assert done["text"].endswith("hello endpoint")
+    assert "".join(event["text"] for event in events[:-1]) == done["text"]
+
+
+def test_endpoint_file_prompt_follows_ui_language(win_ai, make_panel, wait_for, tmp_path):
+    path = tmp_path / "notes.txt"
+    path.write_text("some notes", encoding="utf-8")
+    panel = make_panel(language="en")
+    wait_for(lambda: panel.gemini_model is not None)
+    events = endpoint_events(win_ai, panel, wait_for, {"file": str(path)})
+    assert events[-1]["event"] == "done"
+    assert "Analyze the contents of this file: notes.txt" in events[-1]["text"]
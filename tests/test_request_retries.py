@@ -0,0 +1,142 @@
+import threading
+import time
+
+import pytest
+
+
+class StatusError(Exception):
+    def __init__(self, message, code):
+        super().__init__(message)
+        self.code = code
+
+
+class ServiceUnavailable(Exception):
+    pass
+
+
+class ScriptedBackend:
+    """Модель, у которой поведение каждого вызова задано заранее: задержка до ответа, фрагменты или ошибка."""
+
+    def __init__(self, calls):
+        self.calls = list(calls)
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def generate_content(self, contents, stream=False, request_options=None):
+        with self._lock:
+            delay, result = self.calls[min(self.count, len(self.calls) - 1)]
+            self.count += 1
+        time.sleep(delay)
+        if isinstance(result, Exception):
+            raise result
+        return self._stream(result)
+
+    @staticmethod
+    def _stream(chunks):
+        for pause, text in chunks:
+            time.sleep(pause)
+            yield type("Chunk", (), {"text": text})()
+
+
+@pytest.fixture
+def executor(win_ai):
+    executor = win_ai.RequestExecutor(max_concurrency=2, max_queued=0)
+    executor.retry_backoff = 0.01
+    yield executor
+    executor.shutdown()
+
+
+def generate(win_ai, executor, model):
+    executor.model = model
+    request = win_ai.ModelRequest(1, ["Вопрос"], stream=True)
+    return executor._generate(request), request.trace
+
+
+def test_retryable_by_status_code_not_by_message(win_ai):
+    assert win_ai.is_retryable_error(StatusError("Service unavailable", 503))
+    assert win_ai.is_retryable_error(StatusError("Quota", 429))
+    assert not win_ai.is_retryable_error(StatusError("max_output_tokens must be below 500", 400))
+    assert not win_ai.is_retryable_error(ValueError("503 Service Unavailable"))
+
+
+def test_retryable_by_exception_type(win_ai):
+    assert win_ai.is_retryable_error(ServiceUnavailable("backend down"))
+    assert win_ai.is_retryable_error(ConnectionResetError())
+    assert win_ai.is_retryable_error(TimeoutError())
+    assert win_ai.is_retryable_error(win_ai.SimulatedBackendError("simulated"))
+
+
+def test_retry_delay_stays_within_backoff_cap(win_ai, executor):
+    executor.retry_backoff = 0.5
+    executor.retry_backoff_max = 8.0
+    for retry in range(10):
+        limit = min(executor.retry_backoff_max, executor.retry_backoff * 2 ** retry)
+        delays = [executor.retry_delay(retry) for _ in range(200)]
+        assert all(0 <= delay <= limit for delay in delays)
+    assert max(executor.retry_delay(20) for _ in range(200)) <= executor.retry_backoff_max
+
+
+def test_transient_error_is_retried(win_ai, executor):
+    model = ScriptedBackend([(0, StatusError("unavailable", 503)), (0, [(0, "ok")])])
+    text, trace = generate(win_ai, executor, model)
+    assert text == "ok"
+    assert trace.retries == 1
+
+
+def test_client_error_is_not_retried(win_ai, executor):
+    model = ScriptedBackend([(0, StatusError("limit is 500", 400)), (0, [(0, "ok")])])
+    with pytest.raises(StatusError):
+        generate(win_ai, executor, model)
+    assert model.count == 1
+
+
+def test_idle_timeout_resets_on_every_chunk(win_ai, executor):
+    executor.timeout_seconds = 0.2
+    model = ScriptedBackend([(0.05, [(0.1, f"{index} ") for index in range(6)])])
+    text, trace = generate(win_ai, executor, model)
+    assert text == "0 1 2 3 4 5 "
+
+
+def test_stalled_stream_times_out(win_ai, executor):
+    executor.timeout_seconds = 0.2
+    executor.max_retries = 0
+    model = ScriptedBackend([(0, [(0, "start "), (1.0, "late")])])
+    started = time.perf_counter()
+    with pytest.raises(TimeoutError):
+        generate(win_ai, executor, model)
+    assert time.perf_counter() - started < 0.8
+
+
+def test_total_timeout_caps_a_stream_that_keeps_going(win_ai, executor):
+    executor.timeout_seconds = 0.2
+    executor.total_timeout_seconds = 0.3
+    model = ScriptedBackend([(0, [(0.05, "x")] * 20)])
+    with pytest.raises(TimeoutError):
+        generate(win_ai, executor, model)
+
+
+def test_hedge_wins_over_stalled_attempt(win_ai, executor):
+    executor.hedge_requests = True
+    executor.hedge_min_delay = 0.01
+    executor._ttft_samples = [0.01] * executor.MIN_HEDGE_SAMPLES
+    model = ScriptedBackend([(1.0, [(0, "slow")]), (0, [(0, "fast")])])
+    started = time.perf_counter()
+    text, trace = generate(win_ai, executor, model)
+    assert text == "fast"
+    assert trace.hedged
+    assert time.perf_counter() - started < 0.5
+
+
+def test_hedge_is_skipped_without_a_free_slot(win_ai, executor):
+    executor.hedge_requests = True
+    executor.hedge_min_delay = 0.01
+    executor._ttft_samples = [0.01] * executor.MIN_HEDGE_SAMPLES
+    slots = executor._attempt_slots
+    # Остальные места заняты брошенными попытками других запросов
+    for _ in range(executor.ATTEMPTS_PER_REQUEST * executor.max_concurrency - 1):
+        slots.acquire()
+    model = ScriptedBackend([(0.2, [(0, "only")]), (0, [(0, "hedge")])])
+    text, trace = generate(win_ai, executor, model)
+    assert text == "only"
+    assert not trace.hedged
+    assert model.count == 1
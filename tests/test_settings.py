@@ -0,0 +1,29 @@
+import json
+
+
+def saved_settings(panel):
+    panel.settings_writer.flush()
+    with open("settings.json", 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def test_chat_history_migration_keeps_user_settings(make_panel):
+    panel = make_panel(chat_history="['<p>old</p>']", stream_responses=False, context_token_budget=1234,
+                       history_colors_migrated=True)
+    assert panel.stream_responses is False
+    assert panel.conversation.token_budget == 1234
+    settings = saved_settings(panel)
+    assert "chat_history" not in settings
+    assert settings["stream_responses"] is False
+    assert settings["context_token_budget"] == 1234
+
+
+def test_color_migration_keeps_user_settings_and_legacy_microphone(make_panel):
+    panel = make_panel(selected_microphone_index=3, stream_responses=False, speech_models={"vosk": {"ru-RU": "m"}})
+    assert panel._legacy_microphone_index == 3
+    assert panel.speech_models == {"vosk": {"ru-RU": "m"}}
+    settings = saved_settings(panel)
+    assert settings["history_colors_migrated"] is True
+    assert settings["selected_microphone_index"] == 3
+    assert settings["stream_responses"] is False
+    assert settings["speech_models"] == {"vosk": {"ru-RU": "m"}}
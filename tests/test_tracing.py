@@ -0,0 +1,60 @@
+import json
+import os
+
+
+def test_percentile(win_ai):
+    values = list(range(1, 101))
+    assert win_ai.percentile(values, 0.5) == 51
+    assert win_ai.percentile(values, 0.95) == 96
+    assert win_ai.percentile(values, 1.0) == 100
+    assert win_ai.percentile([], 0.95) == 0.0
+
+
+def test_trace_record_rounds_spans_and_marks_retries(win_ai):
+    trace = win_ai.RequestTrace(7)
+    trace.spans = {"queue_wait": 1.234, "model": 250.06}
+    trace.outcome = "ok"
+    trace.retries = 2
+    record = trace.to_record("chat")
+    assert record["spans"] == {"queue_wait": 1.2, "model": 250.1}
+    assert record["retries"] == 2
+    assert "hedged" not in record
+
+
+def test_trace_log_rotates_and_keeps_backups(win_ai, tmp_path):
+    path = str(tmp_path / "traces.jsonl")
+    log = win_ai.TraceLog(path, max_bytes=300, backups=2)
+    for request_id in range(30):
+        trace = win_ai.RequestTrace(request_id)
+        trace.outcome = "ok"
+        log.append(trace.to_record("chat"))
+    log.close()
+
+    assert sorted(os.listdir(tmp_path)) == ["traces.jsonl", "traces.jsonl.1", "traces.jsonl.2"]
+    assert all(os.path.getsize(tmp_path / name) <= 300 for name in os.listdir(tmp_path))
+    with open(path, encoding="utf-8") as f:
+        last_ids = [json.loads(line)["request_id"] for line in f]
+    assert last_ids[-1] == 29
+
+
+def test_memory_cache_hit_is_traced(make_panel, wait_for):
+    panel = make_panel()
+    wait_for(lambda: panel.gemini_model is not None)
+    panel.send_message("same question")
+    wait_for(lambda: len(panel.recent_traces) == 1 and not panel._replies)
+    panel.send_message("same question")
+    wait_for(lambda: len(panel.recent_traces) == 2)
+
+    first, cached = panel.recent_traces
+    assert first["outcome"] == "ok"
+    assert cached["outcome"] == "cached"
+    assert cached["request_id"] is None
+    assert set(cached["spans"]) >= {"payload_build", "render", "total"}
+    with open(panel.trace_log.path, 'r', encoding='utf-8') as f:
+        logged = [json.loads(line) for line in f]
+    assert [record["outcome"] for record in logged] == ["ok", "cached"]
+
+    panel.refresh_diagnostics()
+    rows = panel.diagnostics_view.toPlainText().splitlines()
+    assert rows[1].startswith("-       cached")
+    assert rows[2].startswith(f"#{first['request_id']}")